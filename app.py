@@ -4,18 +4,23 @@ import sys
 from json.decoder import JSONDecodeError
 import click
 from click import make_pass_decorator
-from voluptuous.error import Invalid
 import prefab.core as c
-import prefab.core.api as fab
+from prefab.core import instrument
 
 ## Errorcodes
 ERR_NO_CFG = -1
 ERR_INVALID_CFG = -2
+ERR_UNREACHABLE = -3
 
 class Context:
     """Holds entire application context, passed around in the program."""
     def __init__(self):
         self._verbose = self._config = None
+        self.config_path = None
+        # fabric env settings, applied once fabric is initialized
+        self.env = {}
+        # (use host store, breaker threshold, breaker cooldown), see '__host_store_env'
+        self.host_store = (True, 3, 300)
 
     @property
     def verbose(self):
@@ -34,33 +39,165 @@ pass_cli_ctx = make_pass_decorator(Context, ensure=True)
 @click.group()
 @click.option('--verbose', is_flag=True)
 @click.option('--config-path', default=path.join(getcwd(), 'prefab.json'), type=str)
+@click.option('--no-config-cache', is_flag=True, help="Always re-parse the config file.")
+@click.option('--parallel', type=click.IntRange(min=1), default=None,
+              help="Run tasks on up to N hosts concurrently.")
+@click.option('--host-timeout', type=click.FloatRange(min=0, min_open=True), default=None,
+              help="Abort tasks taking longer than this (seconds) on a host.")
+@click.option('--batch', default=None, metavar='N|N%',
+              help="Run tasks in consecutive batches of N hosts (or N% of the hosts).")
+@click.option('--max-failures', default='0', metavar='N|N%', show_default=True,
+              help="With --batch, skip the remaining batches once more hosts failed.")
+@click.option('--batch-pause', type=click.FloatRange(min=0), default=0,
+              help="With --batch, wait this long (seconds) between batches.")
+@click.option('--refresh-facts', is_flag=True,
+              help="Run @cached_fact tasks regardless of cached results, refreshing the cache.")
+@click.option('--max-connections', type=click.IntRange(min=1), default=None,
+              help="Keep at most N SSH connections open, closing the least recently used.")
+@click.option('--no-host-store', is_flag=True,
+              help="Don't order, skip or record hosts using the host store.")
+@click.option('--breaker-threshold', type=click.IntRange(min=0), default=3, show_default=True,
+              help="Skip hosts which failed this many times in a row (0 to never skip).")
+@click.option('--breaker-cooldown', type=click.FloatRange(min=0), default=300,
+              show_default=True, help="Retry skipped hosts this long (seconds) after they failed.")
+@click.option('-R', '--role', 'roles', multiple=True,
+              help="Target role (repeatable). Only hosts of these roles are resolved up-front.")
+@click.option('--profile', is_flag=True,
+              help="Time each phase & host, print a summary and write a JSON trace on exit.")
+@click.option('--trace-file', default='prefab-trace.json', type=str,
+              help="Where --profile writes the trace (Chrome trace event format).")
 @pass_cli_ctx
-def cli(cctx, verbose, config_path):
+def cli(cctx, verbose, config_path, no_config_cache, parallel, host_timeout, batch,
+        max_failures, batch_pause, refresh_facts, max_connections, no_host_store,
+        breaker_threshold, breaker_cooldown, roles, profile, trace_file):
     if verbose:
         cctx.verbose = verbose
+    if profile:
+        __start_profiling(trace_file)
+    cctx.config_path = config_path
     try:
-        cctx.config = c.parse_config(c.read_config(config_path))
+        with instrument.span('config.load'):
+            cctx.config = c.load_config(
+                config_path, use_cache=not no_config_cache, roles=list(roles) or None)
     except JSONDecodeError as exc:
         click.echo("Failed to parse config file, invalid JSON:", err=True)
         click.echo(c.fmt_json_err(exc), err=True)
         sys.exit(ERR_INVALID_CFG)
-    except Invalid as exc:
+    except Exception as exc: # pylint: disable=W0703
+        if not __is_schema_error(exc):
+            raise
         print("Unhandled error loading configuration")
         print(repr(exc))
         sys.exit(ERR_INVALID_CFG)
+    cctx.env.update(
+        prefab_parallel=parallel, prefab_timeout=host_timeout,
+        prefab_refresh_facts=refresh_facts, prefab_max_connections=max_connections)
+    cctx.host_store = (not no_host_store, breaker_threshold, breaker_cooldown)
+    if batch:
+        cctx.env['prefab_rolling'] = __rolling_settings(batch, max_failures, batch_pause)
+    if roles:
+        cctx.env['roles'] = list(roles)
+
+def __rolling_settings(batch, max_failures, pause):
+    """validate the --batch options, returning the settings of a rolling run."""
+    from prefab.core.scheduler import rolling_settings
+    def amount(spec):
+        """count ('10') or percentage ('10%') given on the command-line."""
+        return spec if spec.endswith('%') else int(spec) if spec.isdigit() else spec
+    try:
+        return rolling_settings(amount(batch), amount(max_failures), pause)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+def __host_store_env(cctx):
+    """env settings of the host store ('prefab_host_store', 'prefab_breaker')."""
+    (enabled, threshold, cooldown) = cctx.host_store
+    if not enabled:
+        return {'prefab_host_store': None, 'prefab_breaker': None}
+    from prefab.core import hoststore
+    return {
+        'prefab_host_store': hoststore.store,
+        'prefab_breaker': hoststore.Breaker(threshold, cooldown) if threshold else None
+    }
+
+def __is_schema_error(exc):
+    """True iff exc is a (voluptuous) validation error, imported only once an error occurs."""
+    from voluptuous.error import Invalid
+    return isinstance(exc, Invalid)
+
+def __fabric(cctx):
+    """Initialize fabric for a command connecting to hosts, returns 'prefab.core.api'.
+
+    Deferred until a command needs it, importing fabric (paramiko,
+    cryptography) dominates start-up time otherwise."""
+    import prefab.core.api as fab
     c.initialize(cctx.config)
+    fab.env.update(cctx.env)
+    fab.env.update(__host_store_env(cctx))
+    return fab
+
+def __start_profiling(trace_file):
+    """record timings from now on, reporting them once the command completes."""
+    recorder = instrument.Recorder()
+    instrument.subscribe(recorder)
+    def report():
+        instrument.unsubscribe(recorder)
+        click.echo(recorder.summary(), err=True)
+        recorder.write_trace(trace_file)
+        click.echo("trace written to '{}'".format(trace_file), err=True)
+    click.get_current_context().call_on_close(report)
+
+@cli.command()
+@pass_cli_ctx
+def compile(cctx): # pylint: disable=W0622
+    """Compile the config file into a binary form which loads faster.
+
+    Later runs load the compiled form for as long as the config file (and
+    the key files & variables it refers to) is unchanged."""
+    with instrument.span('config.compile'):
+        conf, out_path = c.compile_config(cctx.config_path)
+    click.echo("compiled {} hosts into '{}'".format(len(conf.get('hosts', {})), out_path))
+
+@cli.command()
+@click.option('--role', 'probe_roles', multiple=True,
+              help="Probe the hosts of this role (repeatable), defaults to -R or all hosts.")
+@click.option('--concurrency', type=click.IntRange(min=1), default=50,
+              help="Probe up to N hosts at a time.")
+@click.option('--timeout', type=click.FloatRange(min=0, min_open=True), default=5.0,
+              help="Time limit (seconds) of each stage (connect, banner, auth).")
+@click.option('--no-auth', is_flag=True, help="Only check TCP connect & the SSH banner.")
+@pass_cli_ctx
+def probe(cctx, probe_roles, concurrency, timeout, no_auth):
+    """Check which hosts are reachable & accept their configured credentials.
+
+    Reports the hosts failing a stage and latency percentiles per role."""
+    from prefab.core import probe as pr
+    roles = list(probe_roles) or cctx.env.get('roles')
+    try:
+        labels = pr.select_hosts(cctx.config, roles)
+    except KeyError as exc:
+        raise click.UsageError(exc.args[0])
+    results = pr.probe(
+        cctx.config, labels, concurrency=concurrency, timeout=timeout, auth=not no_auth,
+        store=__host_store_env(cctx)['prefab_host_store'])
+    click.echo(pr.format_report(cctx.config, results, roles))
+    if not all(res.ok for res in results):
+        sys.exit(ERR_UNREACHABLE)
 
 ##
 ## Playground
 
-#@fab.hosts("anton")
-@fab.roles("cupcakes")
-def hello():
-    fab.run("cat /etc/issue")
-
 @cli.command()
 @pass_cli_ctx
 def run(cctx):
+    fab = __fabric(cctx)
+
+    #@fab.hosts("anton")
+    @fab.roles("cupcakes")
+    @fab.cached_fact(ttl=3600)
+    def hello():
+        return fab.run("cat /etc/issue")
+
     if not cctx.verbose:
         print("Not verbose...")
     else:
@@ -73,9 +210,11 @@ def run(cctx):
 @pass_cli_ctx
 def debug(cctx):
     import json
+    from prefab.core.config.records import json_default
+    from prefab.core.fabenv import LazyRoledefs, LazyPasswords
     def pp(obj):
         """format obj as a string for pretty-printing."""
-        return json.dumps(obj, indent=2, sort_keys=True)
+        return json.dumps(obj, indent=2, sort_keys=True, default=json_default)
 
     print("Config parsed successfully, result:")
     print("---//---")
@@ -84,8 +223,8 @@ def debug(cctx):
     print("Config compiled into the following changes to fab env:")
     print("roledefs:")
     print("")
-    print(pp(fab.env['roledefs']))
+    print(pp(dict(LazyRoledefs(cctx.config))))
     print("passwords:")
     print("")
-    print(pp(fab.env.passwords))
+    print(pp(dict(LazyPasswords(cctx.config))))
     print("---//---")
@@ -0,0 +1,9 @@
+"""
+Micro-benchmarks for prefab internals.
+
+Run through the 'prefab-bench' command, e.g. 'prefab-bench hosts'.
+
+'prefab-bench config --output before.json' times the stages of loading
+synthetic inventories, 'prefab-bench compare before.json after.json'
+compares two such reports (e.g. across commits).
+"""
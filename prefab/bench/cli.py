@@ -0,0 +1,64 @@
+"""
+Entrypoint of the 'prefab-bench' command.
+"""
+import json
+import click
+from . import hosts, walk, config, startup
+
+@click.group()
+def main():
+    """Run prefab micro-benchmarks."""
+
+@main.command('hosts')
+def bench_hosts():
+    """host lookups against inventory size."""
+    hosts.report()
+
+@main.command('walk')
+def bench_walk():
+    """tree walking throughput & memory."""
+    walk.report()
+
+@main.command('startup')
+@click.option('--repeat', type=click.IntRange(min=1), default=5, help="Runs per target.")
+def bench_startup(repeat):
+    """import time of prefab's modules & the CLI."""
+    startup.report(repeat)
+
+@main.command('config')
+@click.option('--hosts', 'sizes', type=click.IntRange(min=1), multiple=True,
+              help="Inventory size (repeatable), defaults to {}.".format(
+                  ", ".join(str(size) for size in config.SIZES)))
+@click.option('--profiles', type=click.IntRange(min=0), default=10, help="Number of profiles.")
+@click.option('--roles', type=click.IntRange(min=1), default=None,
+              help="Number of roles, defaults to one per 50 hosts.")
+@click.option('--env-size', type=click.IntRange(min=0), default=8,
+              help="Number of entries in each profile & role environment.")
+@click.option('--repeat', type=click.IntRange(min=1), default=5, help="Samples per stage.")
+@click.option('--stage', 'stages', multiple=True, help="Only run this stage (repeatable).")
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), default=None,
+              help="Write the JSON report to this file ('-' for stdout, no table).")
+def bench_config(sizes, profiles, roles, env_size, repeat, stages, output):
+    """config loading stages against inventory size."""
+    results = config.run(
+        sizes=sizes or config.SIZES, repeat=repeat, only=stages,
+        n_profiles=profiles, n_roles=roles, env_size=env_size)
+    if output == '-':
+        click.echo(json.dumps(results, indent=2))
+        return
+    config.report(results)
+    if output:
+        with open(output, mode='w') as fp:
+            json.dump(results, fp, indent=2)
+
+@main.command('compare')
+@click.argument('base', type=click.File('r'))
+@click.argument('new', type=click.File('r'))
+@click.option('--threshold', type=click.FloatRange(min=0), default=0.1,
+              help="Relative change beyond which results are flagged.")
+def bench_compare(base, new, threshold):
+    """compare two JSON reports of the 'config' benchmarks."""
+    try:
+        config.report_comparison(json.load(base), json.load(new), threshold)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
@@ -0,0 +1,163 @@
+"""
+Benchmark the stages of loading a configuration against inventory size.
+
+Times reading, expanding, normalizing & validating synthetic inventories
+(see 'inventory') - through voluptuous & the compiled validators - compiling
+fabric's roledefs & passwords and host lookups. Results are reported as JSON, tagged with the environment they
+were measured in, such that runs across commits can be compared (see
+'compare').
+"""
+import os
+import json
+import shutil
+import platform
+import tempfile
+import subprocess
+from os import path
+from datetime import datetime, timezone
+from prefab.utils import fscache
+from prefab.core.config import core, parse, compiled, schemas as scc, confparse as cp
+from prefab.core.fabenv import _compile_roledefs, _compile_passwords
+from . import inventory
+from .util import sample, summarize, fmt_secs
+
+# bump when benchmarks are changed in ways making results incomparable
+VERSION = 1
+
+SIZES = (100, 1000, 10000)
+
+# number of host lookups timed per sample
+LOOKUPS = 1000
+
+def _git_revision():
+    """commit the benchmarks are run against, None if unknown."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=path.dirname(path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    """Describe the environment results are measured in."""
+    return {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': datetime.now(timezone.utc).replace(microsecond=0).isoformat(),
+    }
+
+def _lookups(conf, host_strings):
+    """fn looking up the label of each of 'host_strings'."""
+    def lookup():
+        for host_str in host_strings:
+            cp.host_label(conf, host_str)
+    return lookup
+
+def _stages(directory, params):
+    """(name, fn, setup, per-call divisor) of each stage, against an inventory described by 'params'."""
+    raw = inventory.generate(**params)
+    cfg_path = inventory.materialize(directory, raw)
+    var_env = inventory.var_env(directory)
+    expanded = parse.expand_vars(raw, var_env)
+    hosts = parse.normalize_hosts(expanded)
+    conf = parse.ParsedConfig(parse.normalize_roles(hosts))
+    cp.host_index(conf)
+    compiled_path = compiled.compiled_path(cfg_path)
+    src_stat = compiled.source_stat(os.stat(cfg_path))
+    compiled.dump(compiled_path, conf, src_stat, var_env)
+
+    labels = list(conf['hosts'])
+    step = max(1, len(labels) // LOOKUPS)
+    picked = [conf['hosts'][label] for label in labels[::step][:LOOKUPS]]
+    host_strings = [cp.host_string(entry) for entry in picked]
+    # 'user@address' lacking the (default) port, resolved through the address table
+    denormalized = [
+        '{}@{}'.format(entry['user'], entry['address'])
+        for entry in picked if int(entry['port']) == 22]
+
+    clear_stats = fscache.stats.clear
+    return [
+        ('read_config', lambda: core.read_config(cfg_path), None, 1),
+        ('expand_vars', lambda: parse.expand_vars(raw, var_env), None, 1),
+        ('normalize_hosts', lambda: parse.normalize_hosts(expanded), clear_stats, 1),
+        ('normalize_roles', lambda: parse.normalize_roles(hosts), None, 1),
+        ('validate_raw', lambda: scc.json_config(expanded), clear_stats, 1),
+        ('validate_parsed', lambda: scc.config(conf), clear_stats, 1),
+        ('validate_raw_compiled', lambda: scc.json_config_validator(expanded), clear_stats, 1),
+        ('validate_parsed_compiled', lambda: scc.config_validator(conf), clear_stats, 1),
+        ('parse_config', lambda: core.parse_config(raw, var_env), clear_stats, 1),
+        ('compile', lambda: compiled.dump(compiled_path, conf, src_stat, var_env), None, 1),
+        ('load_compiled', lambda: compiled.load(compiled_path, cfg_path, var_env), clear_stats, 1),
+        ('host_index', lambda: cp.build_host_index(conf), None, 1),
+        ('compile_roledefs', lambda: _compile_roledefs(conf), None, 1),
+        ('compile_passwords', lambda: _compile_passwords(conf), None, 1),
+        ('host_label', _lookups(conf, host_strings), None, len(host_strings)),
+        ('host_label_denormalized', _lookups(conf, denormalized), None, len(denormalized)),
+    ]
+
+def run(sizes=SIZES, repeat=5, only=None, **params):
+    """Run the benchmarks for each inventory size, returning the (JSON-serializable) report.
+
+    only   - names of the stages to run (None => all)
+    params - further parameters of the inventory (see 'inventory.generate')
+
+    Each result holds the min/median/mean time (seconds) of one call, host
+    lookups are reported per lookup."""
+    results = []
+    directory = tempfile.mkdtemp(prefix='prefab-bench-')
+    try:
+        for n_hosts in sizes:
+            inventory_params = dict(params, n_hosts=n_hosts)
+            for (name, fn, setup, per_call) in _stages(directory, inventory_params):
+                if only and name not in only:
+                    continue
+                stats = summarize([secs / per_call for secs in sample(fn, repeat, setup)])
+                results.append(dict(
+                    name=name, params=inventory_params, repeat=repeat, **stats))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {'version': VERSION, 'environment': environment(), 'results': results}
+
+def _key(result):
+    """identifies a benchmark across reports."""
+    return (result['name'], json.dumps(result['params'], sort_keys=True))
+
+def compare(base, new):
+    """Pair up the results of two reports, yielding (name, params, base median, new median).
+
+    Results present in only one of the reports are skipped."""
+    if base.get('version') != new.get('version'):
+        raise ValueError("reports were produced by different benchmark versions ({} vs {})".format(
+            base.get('version'), new.get('version')))
+    base_results = {_key(result): result for result in base['results']}
+    for result in new['results']:
+        base_result = base_results.get(_key(result))
+        if base_result is not None:
+            yield result['name'], result['params'], base_result['median'], result['median']
+
+def report(results):
+    """Print a table of the results of 'run'."""
+    print("{:<24} {:>8} {:>10} {:>10} {:>10}".format('stage', 'hosts', 'min', 'median', 'mean'))
+    for result in results['results']:
+        print("{:<24} {:>8} {} {} {}".format(
+            result['name'], result['params']['n_hosts'],
+            fmt_secs(result['min']), fmt_secs(result['median']), fmt_secs(result['mean'])))
+
+def report_comparison(base, new, threshold=0.1):
+    """Print the median times of two reports side by side, flagging changes beyond 'threshold'."""
+    env_base, env_new = base['environment'], new['environment']
+    print("base: {} ({})  new: {} ({})".format(
+        env_base.get('revision'), env_base.get('python'),
+        env_new.get('revision'), env_new.get('python')))
+    print("{:<24} {:>8} {:>10} {:>10} {:>8}".format('stage', 'hosts', 'base', 'new', 'ratio'))
+    for (name, params, base_median, new_median) in compare(base, new):
+        ratio = new_median / base_median if base_median else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' slower'
+        elif ratio < 1 - threshold:
+            flag = ' faster'
+        print("{:<24} {:>8} {} {} {:>7.2f}x{}".format(
+            name, params['n_hosts'], fmt_secs(base_median), fmt_secs(new_median), ratio, flag))
@@ -0,0 +1,48 @@
+"""
+Benchmark host lookups (host_string => label etc) against inventory size.
+
+Lookup cost should remain flat as the number of hosts grows.
+"""
+from prefab.core.config import confparse as cp
+from .util import measure, fmt_usecs
+
+SIZES = (10, 100, 1000, 10000)
+
+def inventory(n_hosts, hosts_per_role=50):
+    """Generate a parsed configuration of 'n_hosts' hosts."""
+    hosts = {
+        'host{}'.format(ndx): {
+            'address': '10.{}.{}.{}'.format(ndx >> 16, (ndx >> 8) & 0xff, ndx & 0xff),
+            'port': 22,
+            'user': 'root',
+            'method': 'password'
+        } for ndx in range(n_hosts)
+    }
+    labels = list(hosts)
+    roles = {
+        'role{}'.format(ndx): {'hosts': labels[ndx:ndx + hosts_per_role], 'env': {}}
+        for ndx in range(0, n_hosts, hosts_per_role)
+    }
+    return {'profiles': {}, 'hosts': hosts, 'roles': roles}
+
+def bench(n_hosts):
+    """time lookups against an inventory of 'n_hosts' hosts."""
+    conf = inventory(n_hosts)
+    label = 'host{}'.format(n_hosts - 1)
+    host_str = cp.host_string(cp.host_entry(conf, label))
+    cp.host_index(conf)
+    return {
+        'host_label': measure(lambda: cp.host_label(conf, host_str)),
+        'host_roles': measure(lambda: cp.host_roles(conf, label)),
+        'role_host_strings': measure(lambda: cp.role_host_strings(conf, 'role0')),
+    }
+
+def report():
+    """Print a table of lookup times per inventory size."""
+    print("{:>8} {:>12} {:>12} {:>18}".format(
+        'hosts', 'host_label', 'host_roles', 'role_host_strings'))
+    for n_hosts in SIZES:
+        res = bench(n_hosts)
+        print("{:>8} {} {} {:>18}".format(
+            n_hosts, fmt_usecs(res['host_label']), fmt_usecs(res['host_roles']),
+            fmt_usecs(res['role_host_strings'])))
@@ -0,0 +1,90 @@
+"""
+Synthetic inventories (raw configuration files) for benchmarking.
+
+Generated configs mix hosts referring to a profile with complete host
+entries, reference variables ('{home}', '{cwd}') to exercise expansion and
+give profiles & roles environments of a configurable size. Generation is
+deterministic, the same parameters always produce the same config.
+"""
+import os
+import json
+from os import path
+
+# path of the SSH key file referenced by key-based profiles, relative to '{home}'
+KEY_FILE = path.join('.ssh', 'id_bench')
+
+def _env(size, seed):
+    """environment of 'size' entries, some of which reference variables."""
+    return {
+        'var{}'.format(ndx): (
+            '{{cwd}}/app{}'.format(seed) if ndx % 3 == 0 else
+            seed * ndx if ndx % 3 == 1 else
+            bool(ndx % 2))
+        for ndx in range(size)
+    }
+
+def generate(n_hosts, n_profiles=10, n_roles=None, hosts_per_role=50, env_size=8,
+             complete_ratio=0.1):
+    """Generate a raw configuration.
+
+    n_hosts        - number of hosts
+    n_profiles     - number of profiles (alternating key- & password-based)
+    n_roles        - number of roles, defaults to one per 'hosts_per_role' hosts
+    hosts_per_role - number of hosts in each role (roles overlap if needed)
+    env_size       - number of entries in each profile & role environment
+    complete_ratio - fraction of hosts given as complete entries (not using a profile)
+
+    NOTE: expanding requires 'home' & 'cwd' variables (see 'var_env').
+    """
+    profiles = {
+        'profile{}'.format(ndx): {
+            'connection': (
+                {'method': 'key', 'user': 'deploy', 'port': 22}
+                if ndx % 2 == 0 else
+                {'method': 'password', 'user': 'admin', 'port': 2222}),
+            'env': _env(env_size, ndx)
+        } for ndx in range(n_profiles)
+    }
+    for ndx in range(0, n_profiles, 2):
+        profiles['profile{}'.format(ndx)]['connection']['keys'] = [
+            path.join('{home}', KEY_FILE)]
+
+    complete_every = int(1 / complete_ratio) if complete_ratio else None
+    def host(ndx):
+        address = '10.{}.{}.{}'.format(ndx >> 16, (ndx >> 8) & 0xff, ndx & 0xff)
+        if n_profiles == 0 or (complete_every and ndx % complete_every == 0):
+            return {'address': address, 'method': 'password', 'password': 's3cr3t{}'.format(ndx)}
+        return {'address': address, 'profile': 'profile{}'.format(ndx % n_profiles)}
+    hosts = {'host{}'.format(ndx): host(ndx) for ndx in range(n_hosts)}
+
+    labels = list(hosts)
+    if n_roles is None:
+        n_roles = max(1, -(-n_hosts // hosts_per_role))
+    roles = {}
+    for ndx in range(n_roles if labels else 0):
+        start = ndx * hosts_per_role
+        members = [
+            labels[(start + offset) % len(labels)]
+            for offset in range(min(hosts_per_role, len(labels)))]
+        roles['role{}'.format(ndx)] = (
+            members if ndx % 2 == 0 else {'hosts': members, 'env': _env(env_size, ndx)})
+    return {'profiles': profiles, 'hosts': hosts, 'roles': roles}
+
+def var_env(directory):
+    """Variable expansion environment with 'home' & 'cwd' set to 'directory'."""
+    return {'home': directory, 'cwd': directory}
+
+def materialize(directory, conf):
+    """Write 'conf' as 'prefab.json' to 'directory' along with the key file it references.
+
+    Returns the path of the config file."""
+    key_path = path.join(directory, KEY_FILE)
+    os.makedirs(path.dirname(key_path), exist_ok=True)
+    with open(key_path, mode='w') as fp:
+        fp.write("not a real key\n")
+    # as ssh would have it, see 'check_key_files'
+    os.chmod(key_path, 0o600)
+    cfg_path = path.join(directory, 'prefab.json')
+    with open(cfg_path, mode='w') as fp:
+        json.dump(conf, fp)
+    return cfg_path
@@ -0,0 +1,64 @@
+"""
+Benchmark start-up time: importing prefab's modules & running 'prefab --help'.
+
+Each target runs in a fresh interpreter, timing its wall-clock duration and
+recording which heavy dependencies (fabric, paramiko, voluptuous) got loaded.
+"""
+import os
+import sys
+import json
+import subprocess
+from os import path
+from .util import summarize, fmt_secs
+
+# directory holding app.py & the prefab package
+ROOT = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+
+HEAVY = ('fabric', 'paramiko', 'cryptography', 'voluptuous')
+
+# name => code run in a fresh interpreter
+TARGETS = (
+    ('python', 'pass'),
+    ('import prefab.core', 'import prefab.core'),
+    ('import app', 'import app'),
+    ('prefab --help', 'import app\ntry:\n    app.cli(["--help"])\nexcept SystemExit:\n    pass'),
+    ('import prefab.core.api', 'import prefab.core.api'),
+)
+
+_PROBE = '''
+import sys, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [mod for mod in {heavy!r} if mod in sys.modules]]))
+'''
+
+def _run(code):
+    """(seconds spent in 'code', heavy modules loaded) in a fresh interpreter."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    probe = "import json\n" + _PROBE.format(code=code, heavy=HEAVY)
+    out = subprocess.check_output(
+        [sys.executable, '-W', 'ignore', '-c', probe], env=env, cwd=ROOT,
+        stderr=subprocess.DEVNULL)
+    elapsed, loaded = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    return elapsed, loaded
+
+def bench(repeat=5):
+    """time each target 'repeat' times, returning name => (stats, heavy modules loaded)."""
+    results = {}
+    for (name, code) in TARGETS:
+        samples, loaded = [], []
+        for _ in range(repeat):
+            elapsed, loaded = _run(code)
+            samples.append(elapsed)
+        results[name] = (summarize(samples), loaded)
+    return results
+
+def report(repeat=5):
+    """Print the median start-up time & heavy modules loaded per target."""
+    print("{:<24} {:>10} {:>10}  {}".format('target', 'min', 'median', 'loads'))
+    for (name, (stats, loaded)) in bench(repeat).items():
+        print("{:<24} {} {}  {}".format(
+            name, fmt_secs(stats['min']), fmt_secs(stats['median']),
+            ", ".join(loaded) or '-'))
@@ -0,0 +1,19 @@
+"""
+Tests generating synthetic inventories.
+"""
+from prefab.core.config.core import parse_config, read_config
+from . import inventory
+
+def test_generate_deterministic():
+    """Ensure the same parameters produce the same inventory."""
+    assert inventory.generate(100) == inventory.generate(100)
+
+def test_generate_parses(tmp_path):
+    """Ensure generated inventories are valid configurations."""
+    raw = inventory.generate(120, n_profiles=4, hosts_per_role=50)
+    cfg_path = inventory.materialize(str(tmp_path), raw)
+    conf = parse_config(read_config(cfg_path), inventory.var_env(str(tmp_path)))
+    assert len(conf['hosts']) == 120
+    assert len(conf['roles']) == 3
+    assert all(len(role['hosts']) == 50 for role in conf['roles'].values())
+    assert {entry['method'] for entry in conf['hosts'].values()} == {'key', 'password'}
@@ -0,0 +1,41 @@
+"""
+Helpers shared by the benchmarks.
+"""
+from timeit import default_timer
+
+def measure(fn, number=1000):
+    """Return the mean time (seconds) of calling 'fn' 'number' times."""
+    start = default_timer()
+    for _ in range(number):
+        fn()
+    return (default_timer() - start) / number
+
+def fmt_usecs(secs):
+    """format duration (in seconds) as microseconds."""
+    return "{:10.2f}us".format(secs * 1e6)
+
+def sample(fn, repeat=5, setup=None):
+    """Return the times (seconds) of 'repeat' calls of 'fn', calling 'setup' (untimed) before each."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        fn()
+        times.append(default_timer() - start)
+    return times
+
+def summarize(times):
+    """min, median & mean of sampled times."""
+    ordered = sorted(times)
+    mid = len(ordered) // 2
+    median = ordered[mid] if len(ordered) % 2 else (ordered[mid - 1] + ordered[mid]) / 2
+    return {'min': ordered[0], 'median': median, 'mean': sum(ordered) / len(ordered)}
+
+def fmt_secs(secs):
+    """format duration (in seconds) with a fitting unit."""
+    if secs >= 1:
+        return "{:8.3f}s ".format(secs)
+    if secs >= 1e-3:
+        return "{:8.3f}ms".format(secs * 1e3)
+    return "{:8.3f}us".format(secs * 1e6)
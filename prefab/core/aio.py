@@ -0,0 +1,367 @@
+"""
+Asyncio execution backend, driving many hosts concurrently from one process.
+
+Fabric runs each host in a thread or forked process of its own, which caps
+the number of hosts handled at a time at a few hundred. Here, tasks are
+coroutines taking a 'Host' (offering run/sudo/put) and one event loop
+drives up to 'concurrency' hosts at a time:
+
+    async def uptime(host):
+        return await host.run("uptime")
+
+    results = aio.execute(conf, uptime, roles=['web'])  # label => result
+
+Connections are opened by a 'Transport'. 'AsyncSSHTransport' requires the
+optional 'asyncssh' package and logs in as configured for each host (see
+'fabenv.ssh_settings'), verifying host keys against the user's known_hosts.
+Output is not echoed, it is returned by run/sudo.
+
+Given a host store (see 'hoststore'), hosts are run fastest first, hosts
+whose circuit is open are skipped and connections are recorded - host keys
+recorded before are accepted as if known (see 'known_hosts_files').
+"""
+import os
+import shlex
+import asyncio
+from os import path
+from contextlib import asynccontextmanager
+from time import monotonic
+from .config import confparse as cp
+from .fabenv import ssh_settings, _host_password
+from .probe import select_hosts
+from .scheduler import HostResult, HostTimeoutError
+from .hoststore import known_host_name
+from .config.cache import cache_dir
+from . import instrument
+
+DEFAULT_CONCURRENCY = 1000
+
+# how host keys are checked (as ssh's StrictHostKeyChecking), see 'AsyncSSHTransport'
+HOST_KEY_CHECKING = ('yes', 'accept-new', 'no')
+
+class CommandResult(str):
+    """Output (stdout) of a command, like the result of fabric's run().
+
+    stderr      - error output of the command
+    return_code - exit status of the command
+    command     - command as given to run()/sudo()"""
+    def __new__(cls, stdout, stderr, return_code, command):
+        res = super().__new__(cls, stdout)
+        res.stderr = stderr
+        res.return_code = return_code
+        res.command = command
+        return res
+
+    @property
+    def failed(self):
+        """True iff the command exited with a non-zero status."""
+        return self.return_code != 0
+
+    @property
+    def succeeded(self):
+        """True iff the command exited with status 0."""
+        return not self.failed
+
+class CommandError(Exception):
+    """Raised when a command fails (unless run with 'warn_only')."""
+    def __init__(self, label, result):
+        super().__init__("command '{}' failed on '{}' with exit status {}".format(
+            result.command, label, result.return_code))
+        self.label = label
+        self.result = result
+
+class Connection:
+    """Connection to a host, opened by a 'Transport'."""
+    async def execute(self, command, stdin=None):
+        """Run 'command', feeding it 'stdin' (str), returning (stdout, stderr, exit status)."""
+        raise NotImplementedError
+
+    async def put(self, local_path, remote_path):
+        """Upload the file 'local_path' to 'remote_path'."""
+        raise NotImplementedError
+
+    async def close(self):
+        """Close the connection."""
+        raise NotImplementedError
+
+    def host_key(self):
+        """(key type, base64-encoded key) presented by the host, None if unknown."""
+        return None
+
+class Transport:
+    """Opens connections to hosts."""
+    async def connect(self, label, host_entry):
+        """Open a 'Connection' to the host 'label' (defined by 'host_entry')."""
+        raise NotImplementedError
+
+def _connect_options(host_entry):
+    """asyncssh.connect() options logging into the host of 'host_entry'.
+
+    Raises ValueError if the entry has no known login method or a password
+    login lacks its password (it cannot be prompted for)."""
+    settings = ssh_settings(host_entry)
+    if settings is None:
+        raise ValueError("Expected a password/key method for host, got method: '{}'".format(
+            host_entry.get('method', None)))
+    options = {
+        'host': host_entry['address'],
+        'port': int(host_entry['port']),
+        'username': host_entry['user'],
+    }
+    if host_entry['method'] == 'password':
+        password = _host_password(host_entry)
+        if password is None:
+            raise ValueError("no password configured for '{}'".format(cp.host_string(host_entry)))
+        options.update(password=password, client_keys=None, agent_path=None)
+    else:
+        options['client_keys'] = settings['keys'] or ()
+    return options
+
+class _AsyncSSHConnection(Connection):
+    """'Connection' over an asyncssh client connection."""
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def execute(self, command, stdin=None):
+        res = await self._conn.run(command, input=stdin, check=False)
+        return (res.stdout or '', res.stderr or '',
+                res.exit_status if res.exit_status is not None else -1)
+
+    async def put(self, local_path, remote_path):
+        async with self._conn.start_sftp_client() as sftp:
+            await sftp.put(local_path, remote_path)
+
+    async def close(self):
+        self._conn.close()
+        await self._conn.wait_closed()
+
+    def host_key(self):
+        key = self._conn.get_server_host_key()
+        if key is None:
+            return None
+        (key_type, data) = key.export_public_key('openssh').decode('ascii').split()[:2]
+        return key_type, data
+
+def known_hosts_files(conf=None, store=None):
+    """known hosts files to verify hosts against: the user's (~/.ssh/known_hosts, if any).
+
+    Given a 'hoststore.HostStore' 'store', the keys it recorded for the
+    hosts of 'conf' are exported (to prefab's cache directory) & included."""
+    user_known_hosts = path.join(path.expanduser('~'), '.ssh', 'known_hosts')
+    files = [user_known_hosts] if os.access(user_known_hosts, os.R_OK) else []
+    if store is not None:
+        exported = path.join(cache_dir(), 'known_hosts')
+        if store.write_known_hosts(conf, exported):
+            files.append(exported)
+    return files
+
+class AsyncSSHTransport(Transport):
+    """Transport connecting over SSH using asyncssh.
+
+    known_hosts       - known hosts file(s) to verify host keys against, by
+                        default the user's (see 'known_hosts_files')
+    host_key_checking - as ssh's StrictHostKeyChecking: 'yes' refuses hosts whose
+                        key is not known, 'accept-new' accepts hosts not known yet
+                        (refusing changed keys, like fabric's default) and 'no'
+                        accepts any key - passwords are then sent to any server
+    connect_timeout   - time limit (seconds) of connecting & logging in"""
+    def __init__(self, known_hosts=None, host_key_checking='yes', connect_timeout=30):
+        if host_key_checking not in HOST_KEY_CHECKING:
+            raise ValueError("host_key_checking must be one of {}, got '{}'".format(
+                ", ".join(HOST_KEY_CHECKING), host_key_checking))
+        try:
+            import asyncssh
+        except ImportError:
+            raise ImportError(
+                "the asyncio backend requires the 'asyncssh' package (pip install asyncssh)")
+        self._asyncssh = asyncssh
+        self.known_hosts = known_hosts
+        self.host_key_checking = host_key_checking
+        self.connect_timeout = connect_timeout
+        self._known = None
+
+    def _known_hosts(self):
+        """the known hosts (asyncssh.SSHKnownHosts), read once."""
+        if self._known is None:
+            files = self.known_hosts
+            if files is None:
+                files = known_hosts_files()
+            elif isinstance(files, str):
+                files = [files]
+            self._known = self._asyncssh.read_known_hosts(list(files))
+        return self._known
+
+    async def connect(self, label, host_entry):
+        options = _connect_options(host_entry)
+        known_hosts = None
+        if self.host_key_checking != 'no':
+            known_hosts = self._known_hosts()
+            port = options['port'] if options['port'] != 22 else None
+            if self.host_key_checking == 'accept-new' and not any(
+                    known_hosts.match(options['host'], '', port)[:3]):
+                # not known yet, any key is accepted
+                known_hosts = None
+        conn = await self._asyncssh.connect(
+            known_hosts=known_hosts, connect_timeout=self.connect_timeout, **options)
+        return _AsyncSSHConnection(conn)
+
+class Host:
+    """Operations on the host a task runs against, akin to fabric's run/sudo/put.
+
+    label - label of the host
+    entry - (parsed) host entry of the host"""
+    def __init__(self, label, entry, conn, warn_only=False):
+        self.label = label
+        self.entry = entry
+        self._conn = conn
+        self._warn_only = warn_only
+
+    @property
+    def host_string(self):
+        """host string of the host (as fabric would use)."""
+        return cp.host_string(self.entry)
+
+    async def _command(self, command, detail, stdin, warn_only):
+        """run 'command', raising 'CommandError' if it fails (unless warn_only)."""
+        with instrument.span('command', host=self.label, detail=detail):
+            stdout, stderr, status = await self._conn.execute(command, stdin)
+        result = CommandResult(stdout.rstrip('\r\n'), stderr.rstrip('\r\n'), status, detail)
+        if result.failed and not (self._warn_only if warn_only is None else warn_only):
+            raise CommandError(self.label, result)
+        return result
+
+    async def run(self, command, warn_only=None, stdin=None):
+        """Run 'command', feeding it 'stdin' (str, if given), returning its 'CommandResult'.
+
+        Raises 'CommandError' if the command fails, unless 'warn_only' (by
+        default as given to execute())."""
+        return await self._command(command, command, stdin, warn_only)
+
+    async def sudo(self, command, user=None, warn_only=None):
+        """Run 'command' through sudo (as 'user', root if None), returning its 'CommandResult'.
+
+        The configured password of password logins is given to sudo, other
+        logins must not require one."""
+        password = _host_password(self.entry)
+        args = ['sudo', '-S', '-p', ''] if password is not None else ['sudo', '-n']
+        args.append('-H')
+        if user is not None:
+            args.extend(['-u', user])
+        args.extend(['/bin/sh', '-c', command])
+        stdin = password + '\n' if password is not None else None
+        return await self._command(
+            " ".join(shlex.quote(arg) for arg in args), command, stdin, warn_only)
+
+    async def put(self, local_path, remote_path):
+        """Upload the file 'local_path' to 'remote_path'."""
+        with instrument.span('put', host=self.label, detail=remote_path):
+            await self._conn.put(local_path, remote_path)
+
+@asynccontextmanager
+async def session(conf, label, transport, warn_only=False, store=None):
+    """Connect to host 'label', yielding it as a 'Host'. The connection is closed on exit.
+
+    Connecting is recorded in the 'hoststore.HostStore' 'store', if given."""
+    entry = cp.host_entry(conf, label)
+    start = monotonic()
+    with instrument.span('connect', host=label):
+        try:
+            conn = await transport.connect(label, entry)
+        except Exception:
+            if store is not None:
+                store.record_failure(label)
+            raise
+    if store is not None:
+        key = conn.host_key()
+        store.record_success(label, connect=monotonic() - start, host_key=key and (
+            known_host_name(entry['address'], entry['port']),) + tuple(key))
+    try:
+        yield Host(label, entry, conn, warn_only)
+    finally:
+        await conn.close()
+
+async def _run_host(conf, label, task, args, kwargs, transport, warn_only, store):
+    """connect to host 'label' and run the task against it."""
+    async with session(conf, label, transport, warn_only, store) as host:
+        with instrument.span('execute', host=label):
+            return await task(host, *args, **kwargs)
+
+async def _run_limited(conf, label, task, args, kwargs, opts):
+    """run the task against host 'label' once within the concurrency limit, as a 'HostResult'."""
+    (limit, timeout, transport, warn_only, store) = opts
+    async with limit:
+        start = monotonic()
+        try:
+            result = await asyncio.wait_for(
+                _run_host(conf, label, task, args, kwargs, transport, warn_only, store), timeout)
+        except asyncio.TimeoutError:
+            return HostResult(label, None, monotonic() - start, HostTimeoutError(label, timeout),
+                              None)
+        except Exception as exc: # pylint: disable=W0703
+            return HostResult(label, None, monotonic() - start, exc, None)
+        return HostResult(label, result, monotonic() - start, None, None)
+
+def _task_hosts(conf, task, hosts, roles):
+    """labels of the hosts to run 'task' against."""
+    if hosts is None and roles is None:
+        roles = getattr(task, 'roles', None)
+        if not roles:
+            raise ValueError("no hosts or roles given to run '{}' against".format(
+                getattr(task, '__name__', task)))
+    labels = list(dict.fromkeys(hosts or ()))
+    if roles:
+        labels = list(dict.fromkeys(labels + select_hosts(conf, roles)))
+    for label in labels:
+        if label not in conf['hosts']:
+            raise KeyError("undefined host: {}".format(label))
+    return labels
+
+async def execute_iter(conf, task, *args, hosts=None, roles=None, concurrency=DEFAULT_CONCURRENCY,
+                       timeout=None, transport=None, warn_only=False, store=None, breaker=None,
+                       **kwargs):
+    """Run 'task(host, *args, **kwargs)' against hosts, yielding a 'HostResult' per host as it completes.
+
+    hosts       - labels of the hosts to run against
+    roles       - roles whose hosts to run against (if neither is given,
+                  those of the task's @roles decorator)
+    concurrency - max. number of hosts connected to at a time
+    timeout     - time limit (seconds) of each host, None for no limit
+    transport   - 'Transport' opening connections, defaults to 'AsyncSSHTransport'
+                  (accepting the host keys recorded by 'store' as known)
+    warn_only   - whether failing commands are returned rather than raising
+    store       - 'hoststore.HostStore' ordering hosts & recording connections
+    breaker     - 'hoststore.Breaker' settings of skipping hosts (with 'store')
+
+    Hosts are keyed by label, errors (exceptions raised by the task,
+    'HostTimeoutError' or 'hoststore.HostUnavailableError' of skipped hosts)
+    are reported as the host's error."""
+    labels = _task_hosts(conf, task, hosts, roles)
+    if store is not None:
+        refused = store.unavailable(labels, breaker)
+        for label in labels:
+            if label in refused:
+                yield HostResult(label, None, 0, refused[label], None)
+        labels = store.order(label for label in labels if label not in refused)
+    if transport is None:
+        transport = AsyncSSHTransport(known_hosts=known_hosts_files(conf, store))
+    opts = (asyncio.Semaphore(concurrency), timeout, transport, warn_only, store)
+    pending = [
+        asyncio.ensure_future(_run_limited(conf, label, task, args, kwargs, opts))
+        for label in labels]
+    try:
+        for done in asyncio.as_completed(pending):
+            yield await done
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+def execute(conf, task, *args, **kwargs):
+    """Run 'task' against hosts (see 'execute_iter'), returning label => result.
+
+    Hosts which failed map to the exception raised."""
+    async def collect():
+        return {
+            res.host: res.result if res.error is None else res.error
+            async for res in execute_iter(conf, task, *args, **kwargs)}
+    with instrument.span('task', detail=getattr(task, '__name__', task)):
+        return asyncio.run(collect())
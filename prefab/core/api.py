@@ -1,4 +1,6 @@
-from . fabcompat import initialize, _init_wrap_fns
+from . fabcompat import initialize, reload, execute_iter, rolling, _init_wrap_fns
+from . facts import cached_fact
+from . batching import batch
 from prefab.utils.decorators import run_once
 
 _init_wrap_fns()
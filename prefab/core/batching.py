@@ -0,0 +1,304 @@
+"""
+Batching of run() & sudo() calls into a single remote round trip.
+
+    with fab.batch():
+        issue = fab.run("cat /etc/issue")
+        kernel = fab.run("uname -r")
+    print(issue, kernel)
+
+Within the block, run() & sudo() calls on the current host are queued
+rather than run, returning 'BatchedResult' placeholders. The queued commands
+are run as one script, over one channel, once the block is left or as soon
+as one of the placeholders is used. Each command's output & exit code are
+delimited in the script's output, resolving to the usual results (output
+strings with 'failed', 'return_code', 'stderr' etc.).
+
+Commands are wrapped as fabric would when they are called - cd(), prefix(),
+shell_env() & sudo users apply as they were at the time of the call. A
+failing command stops the script & aborts, as run() would, unless called
+with warn_only/quiet (or env.warn_only set).
+
+NOTE: only run() & sudo() are queued, put(), get() & local() run right
+away - call 'flush()' on the batch first where their order matters. Calls
+passing 'stdout', 'stderr', 'timeout' or 'capture_buffer_size', or 'pty' /
+'combine_stderr' differing from the batch's, flush the queue & run on their own.
+"""
+import io
+import re
+import inspect
+from uuid import uuid4
+from contextlib import contextmanager
+import fabric.api
+import fabric.state
+import fabric.utils
+import fabric.operations
+import fabric.context_managers
+from .facts import _host_label
+from . import instrument
+
+# arguments of fabric's _run_command which cannot be batched (if given)
+_UNBATCHABLE = ('stdout', 'stderr', 'timeout', 'capture_buffer_size')
+
+# active batches, innermost last
+_batches = []
+
+# value of unresolved placeholders
+_PENDING = object()
+
+class BatchedCommandError(Exception):
+    """Raised resolving results of batched commands which were not run."""
+
+class BatchedResult:
+    """Placeholder result of a batched run()/sudo() call.
+
+    Using it (as a string, or any attribute of the result, e.g. 'failed')
+    runs the batch's queued commands first. 'value' is the actual result."""
+    __slots__ = ('_batch', '_value')
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._value = _PENDING
+
+    @property
+    def value(self):
+        """the command's result (runs the batch if pending)."""
+        if self._value is _PENDING:
+            self._batch.flush()
+        if isinstance(self._value, Exception):
+            raise self._value
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.value, name)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        if self._value is _PENDING:
+            return "<BatchedResult (pending)>"
+        return repr(self.value)
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __add__(self, other):
+        return self.value + other
+
+    def __radd__(self, other):
+        return other + self.value
+
+class _Queued:
+    """run()/sudo() call queued in a batch."""
+    __slots__ = ('command', 'wrapped', 'sudo', 'warn', 'quiet', 'result')
+
+    def __init__(self, command, wrapped, sudo, warn, quiet, result):
+        self.command = command
+        self.wrapped = wrapped
+        self.sudo = sudo
+        self.warn = warn
+        self.quiet = quiet
+        self.result = result
+
+class Batch:
+    """Queue of run()/sudo() calls on host 'host_string', run as one script."""
+    def __init__(self, host_string):
+        self.host_string = host_string
+        self.pty = True
+        self.combine_stderr = fabric.api.env.combine_stderr
+        self.pending = []
+
+    def accepts(self, params):
+        """True iff the call with (bound) 'params' can be queued."""
+        return (fabric.api.env.host_string == self.host_string
+                and all(params[arg] is None for arg in _UNBATCHABLE)
+                and params['pty'] == self.pty
+                and params['combine_stderr'] in (None, self.combine_stderr))
+
+    def merged(self):
+        """True iff the script's stderr arrives on its stdout (pty or combine_stderr)."""
+        return bool((self.pty and fabric.api.env.always_use_pty) or self.combine_stderr)
+
+    def add(self, params):
+        """Queue the call with (bound) 'params', returning its 'BatchedResult'."""
+        env = fabric.api.env
+        ops = fabric.operations
+        shell_escape = params['shell_escape']
+        if shell_escape is None:
+            shell_escape = env.get('shell_escape', True)
+        wrapped = ops._shell_wrap(
+            ops._prefix_env_vars(ops._prefix_commands(params['command'], 'remote')),
+            shell_escape, params['shell'],
+            ops._sudo_prefix(params['user'], params['group']) if params['sudo'] else None)
+        result = BatchedResult(self)
+        self.pending.append(_Queued(
+            params['command'], wrapped, params['sudo'],
+            bool(params['warn_only'] or params['quiet'] or env.warn_only),
+            params['quiet'], result))
+        return result
+
+    def discard(self):
+        """Drop the queued calls, their results raising 'BatchedCommandError'."""
+        queued, self.pending = self.pending, []
+        for cmd in queued:
+            cmd.result._value = BatchedCommandError(
+                "batched command '{}' was not run".format(cmd.command))
+
+    def flush(self):
+        """Run the queued calls (if any) as one script, resolving their results."""
+        if not self.pending:
+            return
+        queued, self.pending = self.pending, []
+        token = "__prefab_{}".format(uuid4().hex)
+        merged = self.merged()
+        script = _script(queued, token, merged)
+        with fabric.context_managers.settings(host_string=self.host_string):
+            detail = "batch({}): {}".format(len(queued), "; ".join(cmd.command for cmd in queued))
+            with instrument.span('command', host=_host_label(self.host_string), detail=detail):
+                (stdout, stderr, _) = fabric.operations._execute(
+                    channel=fabric.operations.default_channel(), command=script,
+                    pty=self.pty, combine_stderr=self.combine_stderr, invoke_shell=False,
+                    stdout=io.StringIO(), stderr=io.StringIO())
+            self._resolve(queued, _split(stdout, token), [] if merged else _split(stderr, token))
+
+    def _resolve(self, queued, stdout, stderr):
+        """Resolve the results of 'queued' from their (output, exit code) pairs."""
+        env = fabric.api.env
+        output = fabric.state.output
+        failures = []
+        for (ndx, cmd) in enumerate(queued):
+            if ndx >= len(stdout):
+                cmd.result._value = BatchedCommandError(
+                    "batched command '{}' was not run".format(cmd.command))
+                failures.append((cmd, None))
+                continue
+            (out, status) = stdout[ndx]
+            err = stderr[ndx][0] if ndx < len(stderr) else ""
+            which = 'sudo' if cmd.sudo else 'run'
+            if output.running and not cmd.quiet:
+                print("[{}] {}: {}".format(self.host_string, which, cmd.command))
+            if output.stdout and not cmd.quiet:
+                for line in out.splitlines():
+                    print("[{}] out: {}".format(self.host_string, line))
+            res = fabric.operations._AttributeString(out)
+            res.failed = status not in env.ok_ret_codes
+            res.command = cmd.command
+            res.real_command = cmd.wrapped
+            res.return_code = status
+            res.succeeded = not res.failed
+            res.stderr = err
+            cmd.result._value = res
+            if res.failed:
+                failures.append((cmd, res))
+        for (cmd, res) in failures:
+            _report(cmd, res)
+
+def _script(queued, token, merged):
+    """script running the 'queued' calls, delimiting their output by 'token' markers.
+
+    Each command runs in a subshell (such that e.g. 'exit' or 'cd' in
+    commands run without env.shell do not affect the others), followed by a
+    marker line holding its exit code - on stdout, and on stderr too unless
+    the streams are 'merged' (pty or combine_stderr), as markers would then
+    appear twice. Failing commands which are not to be tolerated end the
+    script."""
+    ok_codes = "|".join(str(code) for code in fabric.api.env.ok_ret_codes)
+    marker = "printf '\\n{}:%d\\n' $__prefab_rc".format(token)
+    lines = []
+    for cmd in queued:
+        lines.append("(\n{}\n)".format(cmd.wrapped))
+        if merged:
+            lines.append("__prefab_rc=$?; {}".format(marker))
+        else:
+            lines.append("__prefab_rc=$?; {0}; {0} >&2".format(marker))
+        if not cmd.warn:
+            lines.append("case $__prefab_rc in {}) ;; *) exit $__prefab_rc ;; esac".format(ok_codes))
+    return "\n".join(lines)
+
+def _split(text, token):
+    """(output, exit code) of each command from the script output 'text'."""
+    parts = re.split(r"(?:\r?\n)?{}:(\d+)(?:\r?\n|$)".format(token), text)
+    return [(parts[ndx].strip(), int(parts[ndx + 1])) for ndx in range(0, len(parts) - 1, 2)]
+
+def _report(cmd, res):
+    """Report the failure of batched command 'cmd', aborting unless tolerated."""
+    which = 'sudo' if cmd.sudo else 'run'
+    if res is None:
+        msg = "{}() batched command was not run!\n\nRequested: {}\nExecuted: {}".format(
+            which, cmd.command, cmd.wrapped)
+        fabric.utils.error(message=msg)
+        return
+    msg = "{}() received nonzero return code {} while executing!\n\nRequested: {}\nExecuted: {}".format(
+        which, res.return_code, cmd.command, cmd.wrapped)
+    if cmd.quiet:
+        manager = fabric.context_managers.quiet()
+    elif cmd.warn:
+        manager = fabric.context_managers.warn_only()
+    else:
+        manager = fabric.context_managers.settings()
+    with manager:
+        fabric.utils.error(message=msg, stdout=res, stderr=res.stderr)
+
+_signatures = {}
+
+def queue(run_command, command, args, kwargs):
+    """Queue the 'run_command' (fabric's _run_command) call in the active batch.
+
+    Returns its 'BatchedResult', None if the call is to be run right away
+    (no batch, or one for another host or not accepting the call)."""
+    if not _batches:
+        return None
+    batch = _batches[-1]
+    sig = _signatures.get(run_command)
+    if sig is None:
+        sig = _signatures[run_command] = inspect.signature(run_command)
+    bound = sig.bind(command, *args, **kwargs)
+    bound.apply_defaults()
+    if not batch.accepts(bound.arguments):
+        batch.flush()
+        return None
+    return batch.add(bound.arguments)
+
+@contextmanager
+def batch():
+    """Context queuing run()/sudo() calls on the current host, running them as one script.
+
+    Yields the 'Batch' ('flush()' runs the calls queued so far). Nested
+    blocks for the same host share the outer batch. Calls queued when the
+    block raises are not run."""
+    host_string = fabric.api.env.host_string
+    if _batches and _batches[-1].host_string == host_string:
+        yield _batches[-1]
+        return
+    current = Batch(host_string)
+    _batches.append(current)
+    try:
+        try:
+            yield current
+        except BaseException:
+            current.discard()
+            raise
+        current.flush()
+    finally:
+        _batches.remove(current)
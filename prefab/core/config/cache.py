@@ -0,0 +1,102 @@
+"""
+On-disk cache of parsed configurations.
+
+A cache entry holds the result of parsing (expanding, normalizing) the
+configuration file, keyed on a hash of the raw file contents and the
+environment used for variable expansion. Entries also record the
+size & mtime of every SSH key file the configuration refers to, such
+that changes to (or removal of) a key file invalidates the entry.
+
+Entries hold host passwords in plain text - they are readable by the
+current user only, as is the cache directory.
+"""
+import os
+import json
+import hashlib
+from os import path
+from .records import json_default
+
+# bump when the layout of cache entries or parsed configs change
+VERSION = 1
+
+def cache_dir():
+    """Directory in which cache entries are stored."""
+    return path.join(
+        os.environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache'),
+        'prefab')
+
+def cache_path(cfg_path, directory=None):
+    """Path of the cache entry for the config file at 'cfg_path'."""
+    name = hashlib.sha1(path.abspath(cfg_path).encode('utf-8')).hexdigest()
+    return path.join(directory or cache_dir(), name + '.json')
+
+def cache_key(raw_conf, var_env):
+    """Compute cache key from the raw config (bytes) & variable expansion env."""
+    digest = hashlib.sha256(raw_conf)
+    digest.update(json.dumps(var_env, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def referenced_files(conf):
+    """Return the (sorted) paths of all key files referenced by the parsed config."""
+    return sorted({
+        key_file
+        for host_entry in conf.get('hosts', {}).values()
+        for key_file in host_entry.get('keys', ())})
+
+def file_stats(paths):
+    """Map each path to its [mtime, size] - or None if it cannot be stat'ed."""
+    def stat(fpath):
+        try:
+            st = os.stat(fpath)
+            return [st.st_mtime_ns, st.st_size]
+        except OSError:
+            return None
+    return {fpath: stat(fpath) for fpath in paths}
+
+def open_private(fpath, mode='w'):
+    """Create & open the (new) file 'fpath' for writing, readable by the current user only."""
+    return open(os.open(fpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), mode=mode)
+
+def load(entry_path, key):
+    """Load the parsed config from the cache entry at 'entry_path'.
+
+    Returns None if the entry is missing, unreadable, stale (key mismatch)
+    or if any of the referenced key files changed since it was written."""
+    try:
+        with open(entry_path, mode='r') as fp:
+            entry = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get('version') != VERSION:
+        return None
+    if entry.get('key') != key:
+        return None
+    files = entry.get('files', {})
+    if file_stats(files) != files:
+        return None
+    return entry.get('config')
+
+def store(entry_path, key, conf):
+    """Write 'conf' to the cache entry at 'entry_path'.
+
+    Failing to write the entry is not an error, the cache is merely
+    an optimization."""
+    entry = {
+        'version': VERSION,
+        'key': key,
+        'files': file_stats(referenced_files(conf)),
+        'config': conf
+    }
+    tmp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+    try:
+        directory = path.dirname(entry_path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.chmod(directory, 0o700)
+        with open_private(tmp_path) as fp:
+            json.dump(entry, fp, default=json_default)
+        os.replace(tmp_path, entry_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
@@ -0,0 +1,172 @@
+"""
+Compiled (binary) form of parsed configurations.
+
+'prefab compile' writes the parsed configuration to a file next to the
+JSON source, which later runs memory-map instead of reading & parsing the
+source. Host entries, the bulk of large inventories, are decoded on first
+access (see 'LazyHosts'), such that loading cost does not grow with the
+size of each entry.
+
+Layout (little-endian):
+
+    header   see 'HEADER'
+    meta     marshal'ed dict: all sections but 'hosts', plus key file stats
+    labels   marshal'ed list of host labels
+    offsets  n_hosts + 1 offsets ('<Q', relative to the start of 'entries')
+    entries  one marshal'ed (profile, values) tuple per host
+
+Host entries referring to a profile store only their overrides, the
+profile's connection settings are shared once loaded (see 'HostRecord').
+
+The compiled form is only used while it is up to date - its header records
+the size & mtime of the source file and a digest of the variables used for
+expansion, while 'meta' records the stats of the key files referenced.
+Otherwise (and if the file is unreadable or written by another version
+of prefab or Python) callers fall back to the JSON source.
+"""
+import os
+import json
+import mmap
+import struct
+import hashlib
+import marshal
+from os import path
+from .records import HostRecord, LazyHosts, json_default
+from .cache import referenced_files, file_stats, open_private
+
+MAGIC = b'PFBC'
+
+# bump when the layout changes
+VERSION = 1
+
+# magic, version, marshal version, source mtime (ns), source size,
+# digest of the variable expansion env, number of hosts, length of meta & labels
+HEADER = struct.Struct('<4sHHqq32sIII')
+
+OFFSET = struct.Struct('<Q')
+
+def compiled_path(cfg_path):
+    """Path of the compiled form of the config file at 'cfg_path'."""
+    return path.splitext(cfg_path)[0] + '.pfc'
+
+def _env_digest(var_env):
+    """digest of the variable expansion environment."""
+    return hashlib.sha256(json.dumps(var_env, sort_keys=True).encode('utf-8')).digest()
+
+def source_stat(st):
+    """(mtime (ns), size) of the source file, given its os.stat() result."""
+    return st.st_mtime_ns, st.st_size
+
+def _source_stat(cfg_path):
+    """(mtime (ns), size) of the source file at 'cfg_path', None if it cannot be stat'ed."""
+    try:
+        return source_stat(os.stat(cfg_path))
+    except OSError:
+        return None
+
+def _encode_host(entry, profiles):
+    """marshal'ed (profile, values) of a host entry, 'values' being its overrides if it has a profile."""
+    profile = profiles.get(entry.get('profile'))
+    if isinstance(entry, HostRecord) and profile is not None and entry.base == profile['connection']:
+        return marshal.dumps((entry['profile'], entry.overrides))
+    return marshal.dumps((None, dict(entry)))
+
+def dump(out_path, conf, src_stat, var_env):
+    """Write the parsed configuration 'conf' in compiled form to 'out_path'.
+
+    src_stat    - (mtime (ns), size) of the source file 'conf' was parsed from (see 'source_stat')
+    var_env     - variables used to expand the source
+
+    The file is written atomically (replacing any previous one), readable by
+    the current user only - it holds host passwords as does the source."""
+    hosts = conf.get('hosts', {})
+    # plain JSON values, as in the cache (no host records, tuples)
+    meta = json.loads(json.dumps(
+        {key: val for (key, val) in conf.items() if key != 'hosts'}, default=json_default))
+    meta_blob = marshal.dumps({
+        'config': meta,
+        'files': file_stats(referenced_files(conf))})
+    labels = list(hosts)
+    labels_blob = marshal.dumps(labels)
+    profiles = meta.get('profiles', {})
+    entries = [_encode_host(hosts[label], profiles) for label in labels]
+
+    offsets, pos = [], 0
+    for entry in entries:
+        offsets.append(pos)
+        pos += len(entry)
+    offsets.append(pos)
+
+    header = HEADER.pack(
+        MAGIC, VERSION, marshal.version, src_stat[0], src_stat[1],
+        _env_digest(var_env), len(labels), len(meta_blob), len(labels_blob))
+    tmp_path = "{}.{}.tmp".format(out_path, os.getpid())
+    try:
+        with open_private(tmp_path, mode='wb') as fp:
+            fp.write(header)
+            fp.write(meta_blob)
+            fp.write(labels_blob)
+            fp.write(b''.join(OFFSET.pack(offset) for offset in offsets))
+            fp.writelines(entries)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def load(in_path, cfg_path, var_env):
+    """Load the compiled configuration at 'in_path', compiled from the source at 'cfg_path'.
+
+    Returns the configuration (a plain dict, whose hosts are decoded on
+    first access) - or None if the file is missing, unreadable, out of date
+    with respect to the source, 'var_env' or the referenced key files."""
+    try:
+        with open(in_path, mode='rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        return _load(buf, cfg_path, var_env)
+    except (ValueError, EOFError, TypeError, KeyError, struct.error):
+        return None
+
+def _load(buf, cfg_path, var_env):
+    """load the compiled configuration from the mapped file 'buf', see 'load'."""
+    (magic, version, marshal_version, src_mtime, src_size, env_digest,
+     n_hosts, meta_len, labels_len) = HEADER.unpack_from(buf)
+    if magic != MAGIC or version != VERSION or marshal_version != marshal.version:
+        return None
+    if _source_stat(cfg_path) != (src_mtime, src_size):
+        return None
+    if env_digest != _env_digest(var_env):
+        return None
+
+    view = memoryview(buf)
+    pos = HEADER.size
+    meta = marshal.loads(view[pos:pos + meta_len])
+    pos += meta_len
+    files = meta['files']
+    if file_stats(files) != files:
+        return None
+    labels = marshal.loads(view[pos:pos + labels_len])
+    pos += labels_len
+    offsets_start = pos
+    entries_start = offsets_start + (n_hosts + 1) * OFFSET.size
+    if len(labels) != n_hosts or len(buf) < entries_start:
+        raise ValueError("corrupt compiled config")
+
+    conf = meta['config']
+    profiles = conf.get('profiles', {})
+    def decode(label, ndx):
+        """decode the entry of the host at 'ndx'."""
+        start, = OFFSET.unpack_from(buf, offsets_start + ndx * OFFSET.size)
+        end, = OFFSET.unpack_from(buf, offsets_start + (ndx + 1) * OFFSET.size)
+        profile, values = marshal.loads(view[entries_start + start:entries_start + end])
+        if profile is None:
+            return values
+        return HostRecord(profiles[profile]['connection'], values)
+
+    conf['hosts'] = LazyHosts(dict(zip(labels, range(n_hosts))), decode)
+    return conf
@@ -1,13 +1,105 @@
 """
 Functionality for integrating with fabric(3)
 """
-from funcy.colls import omit, get_in
-from fabric import network as fnw
+from collections import namedtuple
+from itertools import islice
+from types import MappingProxyType
+from .records import LazyHosts
+
+# Precomputed lookup tables over a parsed configuration.
+#
+# labels       - host_string => tuple of host labels
+# addresses    - (user, address, port) => tuple of host labels
+# roles        - host label => tuple of roles in which the host participates
+# host_strings - host label => host_string
+#
+# Host strings/addresses map to tuples to retain the ability to detect
+# ambiguous entries (several labels describing the same connection).
+HostIndex = namedtuple('HostIndex', ['labels', 'addresses', 'roles', 'host_strings'])
+
+# [conf, tables, index, #hosts indexed] entries keyed by id(conf), holding on
+# to 'conf' ensures the id is not recycled while the entry is alive.
+__index_cache = {}
+__INDEX_CACHE_SIZE = 8
+
+def join_host_strings(user, host, port):
+    """'user@host:port' host string, as fabric.network.join_host_strings would.
+
+    Mirrored rather than imported, as importing fabric (paramiko) is slow.
+    IPv6 addresses are enclosed in square brackets."""
+    template = "{}@[{}]:{}" if host.count(':') > 1 else "{}@{}:{}"
+    return template.format(user, host, port)
 
 def host_string(host_entry):
     """compile host string from a (parsed) host_entry."""
-    return fnw.join_host_strings(
-        host_entry['user'], host_entry['address'], host_entry['port'])
+    return join_host_strings(host_entry['user'], host_entry['address'], host_entry['port'])
+
+def _new_index():
+    """Create empty lookup tables & the (read-only, live) index over them."""
+    tables = HostIndex(labels={}, addresses={}, roles={}, host_strings={})
+    return tables, HostIndex(*(MappingProxyType(table) for table in tables))
+
+def _index_hosts(tables, hosts):
+    """Add the (label, entry) pairs of 'hosts' to the lookup tables."""
+    labels, addresses, host_strings = tables.labels, tables.addresses, tables.host_strings
+    for (label, entry) in hosts:
+        host_str = host_string(entry)
+        host_strings[label] = host_str
+        labels[host_str] = labels.get(host_str, ()) + (label,)
+        address = (entry['user'], entry['address'], int(entry['port']))
+        addresses[address] = addresses.get(address, ()) + (label,)
+
+def _index_roles(tables, conf):
+    """Add the roles of each host referenced by the roles of 'conf' to the lookup tables."""
+    roles = tables.roles
+    for (role, role_entry) in conf.get('roles', {}).items():
+        for label in role_entry['hosts']:
+            roles[label] = roles.get(label, ()) + (role,)
+
+def _normalized_hosts(conf):
+    """label => entry of the hosts normalized so far (all hosts unless deferred)."""
+    hosts = conf.get('hosts', {})
+    return hosts.normalized if isinstance(hosts, LazyHosts) else hosts
+
+def build_host_index(conf):
+    """Build the lookup tables for the hosts & roles of 'conf'.
+
+    Hosts whose normalization is deferred (see 'LazyHosts') are left out.
+
+    NOTE: prefer 'host_index' which memoizes the result per config."""
+    tables, index = _new_index()
+    _index_hosts(tables, _normalized_hosts(conf).items())
+    _index_roles(tables, conf)
+    return index
+
+def host_index(conf):
+    """Retrieve the host index of 'conf', building it on first use.
+
+    Hosts normalized on demand since (see 'LazyHosts') are added to the
+    index as they appear.
+
+    NOTE: the configuration is treated as immutable once parsed, changes made
+    to 'conf' after the index is built are not reflected in the index."""
+    cached = __index_cache.get(id(conf))
+    if cached is None or cached[0] is not conf:
+        tables, index = _new_index()
+        _index_roles(tables, conf)
+        cached = [conf, tables, index, 0]
+        if len(__index_cache) >= __INDEX_CACHE_SIZE:
+            __index_cache.pop(next(iter(__index_cache)))
+        __index_cache[id(conf)] = cached
+    hosts = _normalized_hosts(conf)
+    if len(hosts) > cached[3]:
+        # normalized hosts are only ever appended, index the new ones
+        _index_hosts(cached[1], islice(hosts.items(), cached[3], None))
+        cached[3] = len(hosts)
+    return cached[2]
+
+def discard_host_index(conf):
+    """Drop the memoized host index of 'conf' (e.g. once it is replaced by a reloaded config)."""
+    cached = __index_cache.get(id(conf))
+    if cached is not None and cached[0] is conf:
+        del __index_cache[id(conf)]
 
 def host_entry(conf, label):
     """Retrieve entry defining the host identified by 'label'."""
@@ -15,26 +107,45 @@ def host_entry(conf, label):
 
 def host_roles(conf, label):
     """given a host label, return the roles in which it participates."""
-    roles = conf.get('roles', {})
-    return [
-        role for role in roles
-        if label in roles[role]['hosts']]
+    return list(host_index(conf).roles.get(label, ()))
+
+def _normalize_host_string(host_str):
+    """(user, address, port) of 'host_str', defaults filled in by fabric (env.user, ssh_config etc)."""
+    from fabric import network as fnw
+    user, address, port = fnw.normalize(host_str)
+    return user, address, int(port)
+
+def _lookup_labels(index, host_str):
+    """labels of the hosts matching 'host_str' (by host string or connection address)."""
+    labels = index.labels.get(host_str)
+    if labels is None:
+        # not a host_string compiled from the config, e.g. 'user@host'
+        labels = index.addresses.get(_normalize_host_string(host_str), ())
+    return labels
 
 def host_label(conf, host_str):
     """given a host label, return a single host-label (or fail)."""
-    user, address, port = fnw.normalize(host_str)
-    labels = {
-        k: v for (k, v) in conf['hosts'].items()
-        if v['user'] == user
-        and v['address'] == address
-        and v['port'] == int(port)}.keys()
+    labels = _lookup_labels(host_index(conf), host_str)
+    hosts = conf.get('hosts', {})
+    if not labels and isinstance(hosts, LazyHosts) and hosts.pending:
+        # may be defined by a host whose normalization was deferred - only
+        # hosts at the same address can match, normalize (just) those
+        address = _normalize_host_string(host_str)[1]
+        candidates = [
+            label for (label, raw) in hosts.pending_items()
+            if isinstance(raw, dict) and raw.get('address') == address]
+        for label in candidates:
+            hosts[label]
+        if candidates:
+            labels = _lookup_labels(host_index(conf), host_str)
     assert len(labels) == 1
-    return next(iter(labels))
+    return labels[0]
 
 def role_host_strings(conf, role_label):
-    """xx"""
-    return [
-        host_string(get_in(conf, ['hosts', label]))
-        for label in get_in(conf, ['roles', role_label, 'hosts'], [])]
-
-
+    """Resolve the host labels of role 'role_label' into host strings."""
+    hosts = conf.get('hosts', {})
+    labels = conf.get('roles', {}).get(role_label, {}).get('hosts', [])
+    for label in labels:
+        hosts[label] # normalize deferred hosts before (incrementally) indexing them
+    host_strings = host_index(conf).host_strings
+    return [host_strings[label] for label in labels]
@@ -6,6 +6,10 @@ import os
 import json
 from json.decoder import JSONDecodeError
 from . import parse
+from . import cache
+from . import diff
+from . import compiled
+from .records import compact_hosts
 
 def fmt_json_err(exc):
     """Create string describing the JSON decoder error."""
@@ -27,13 +31,166 @@ def read_config(cfg_path):
     with open(cfg_path, mode='r') as fp:
         return json.load(fp)
 
-def parse_config(raw_conf):
+def parse_config(raw_conf, var_env=None, roles=None):
     """Parse & transform config.
 
     Parses & checks the raw configuration file, transforming it
     into a form suitable for consumption by prefab.
+
+    If 'roles' is given, only the hosts referenced by these roles are
+    expanded & checked up-front. The remaining hosts are resolved on first
+    access, errors in their entries are raised at that point.
+    """
+    if var_env is None:
+        var_env = parse.make_var_env(os.environ, prefix="__")
+    if roles is None:
+        source = parse.expand_vars(raw_conf, var_env)
+        return parse.ParsedConfig(
+            parse.normalize_roles(parse.normalize_hosts(source)), source=source)
+
+    def expand_hosts(hosts):
+        """expand variables of the host entries (labels are expanded up-front)."""
+        return dict(zip(hosts, parse.expand_vars(list(hosts.values()), var_env)))
+    raw_hosts = raw_conf.get('hosts', {})
+    conf = parse.expand_vars(
+        {key: val for (key, val) in raw_conf.items() if key != 'hosts'}, var_env)
+    conf['hosts'] = dict(zip(parse.expand_vars(list(raw_hosts), var_env), raw_hosts.values()))
+    conf = parse.normalize_roles(conf)
+    wanted = dict.fromkeys(
+        label for role in roles for label in conf['roles'].get(role, {}).get('hosts', []))
+    return parse.ParsedConfig(parse.normalize_hosts(conf, only=wanted, expand=expand_hosts))
+
+def load_config(cfg_path, use_cache=True, cache_dir=None, roles=None):
+    """Read & parse the configuration file, reusing a cached result if possible.
+
+    The parsed configuration is cached on disk, keyed on the contents of the
+    file and the variables available for expansion. Cached entries are
+    also invalidated if any of the SSH key files referenced change.
+
+    If 'roles' is given, hosts not referenced by these roles are resolved on
+    demand (see 'parse_config'). Such partially parsed configs are not cached.
+
+    If the file has been compiled (see 'compile_config') and the compiled
+    form is up to date, it is loaded instead - without reading the file.
+
+    NOTE: raises the same errors as 'read_config' and 'parse_config'
+    """
+    var_env = parse.make_var_env(os.environ, prefix="__")
+    if use_cache:
+        conf = compiled.load(compiled.compiled_path(cfg_path), cfg_path, var_env)
+        if conf is not None:
+            return parse.ParsedConfig(conf)
+    with open(cfg_path, mode='rb') as fp:
+        raw_conf = fp.read()
+    if not use_cache:
+        return parse_config(json.loads(raw_conf), var_env, roles)
+
+    key = cache.cache_key(raw_conf, var_env)
+    entry_path = cache.cache_path(cfg_path, cache_dir)
+    conf = cache.load(entry_path, key)
+    if conf is None:
+        conf = parse_config(json.loads(raw_conf), var_env, roles)
+        if roles is None:
+            cache.store(entry_path, key, conf)
+        return conf
+    # entries are only ever written from validated configs
+    return parse.ParsedConfig(compact_hosts(conf))
+
+def compile_config(cfg_path, out_path=None):
+    """Parse the configuration file, writing it in compiled form for 'load_config' to use.
+
+    The compiled form is used by later runs until the configuration file,
+    the variables used for expansion or any of the key files referenced
+    change - then 'load_config' falls back to parsing the file.
+
+    out_path - where to write, defaults to 'compiled.compiled_path(cfg_path)'
+
+    Returns the parsed configuration & the path written to.
+
+    NOTE: raises the same errors as 'read_config' and 'parse_config'
     """
+    out_path = out_path or compiled.compiled_path(cfg_path)
     var_env = parse.make_var_env(os.environ, prefix="__")
-    return parse.normalize_roles(
-        parse.normalize_hosts(
-            parse.expand_vars(raw_conf, var_env)))
+    with open(cfg_path, mode='rb') as fp:
+        # stat'ed before reading, changes made while reading outdate the compiled form
+        src_stat = compiled.source_stat(os.fstat(fp.fileno()))
+        raw_conf = fp.read()
+    conf = parse_config(json.loads(raw_conf), var_env)
+    compiled.dump(out_path, conf, src_stat, var_env)
+    return conf, out_path
+
+def reparse_config(conf, raw_conf, var_env=None):
+    """Parse 'raw_conf', reusing the entries of the parsed config 'conf' which did not change.
+
+    Only profiles, hosts & roles whose (expanded) entries differ from those
+    'conf' was parsed from are resolved anew, along with the hosts referring
+    to a changed profile. Key files of these hosts are checked again.
+    If 'conf' holds no source (e.g. it was loaded from the cache or parsed
+    for a subset of roles), the new configuration is parsed in full.
+
+    Returns the new configuration & a 'ConfigDiff' describing how it differs from 'conf'.
+
+    NOTE: raises the same errors as 'parse_config'
+    """
+    if var_env is None:
+        var_env = parse.make_var_env(os.environ, prefix="__")
+    old_source = getattr(conf, 'source', None)
+    if old_source is None:
+        new_conf = parse_config(raw_conf, var_env)
+        return new_conf, diff.diff_configs(conf, new_conf)
+
+    source = parse.expand_vars(raw_conf, var_env)
+    def section(cfg, key):
+        """entries of section 'key' (profiles, hosts, roles) of 'cfg'."""
+        return cfg.get(key, {})
+
+    profile_changes = diff.diff_entries(section(old_source, 'profiles'), section(source, 'profiles'))
+    profiles = {
+        **{name: profile for (name, profile) in section(conf, 'profiles').items()
+           if name in section(source, 'profiles')},
+        **parse.normalize_profiles({
+            name: section(source, 'profiles')[name]
+            for name in profile_changes.added | profile_changes.changed})
+    }
+
+    old_hosts = section(conf, 'hosts')
+    raw_hosts = section(source, 'hosts')
+    raw_changes = diff.diff_entries(section(old_source, 'hosts'), raw_hosts)
+    stale = {
+        label: entry for (label, entry) in raw_hosts.items()
+        if label in raw_changes.added or label in raw_changes.changed
+        or (isinstance(entry, dict) and entry.get('profile') in profile_changes.touched)}
+    parse.check_key_files(stale, profiles, refresh=True)
+    resolved = parse.normalize_hosts({'hosts': stale}, profiles=profiles)['hosts']
+    hosts = {
+        label: resolved[label] if label in resolved else old_hosts[label]
+        for label in raw_hosts}
+
+    role_changes = diff.diff_entries(section(old_source, 'roles'), section(source, 'roles'))
+    roles = {
+        **{name: role for (name, role) in section(conf, 'roles').items()
+           if name in section(source, 'roles')},
+        **parse.normalize_roles({'hosts': hosts, 'roles': {
+            name: section(source, 'roles')[name]
+            for name in role_changes.added | role_changes.changed}})['roles']
+    }
+    missing_hosts = parse._check_role_refs({'hosts': hosts}, roles)
+    if missing_hosts:
+        raise parse.MissingHostsError(missing_hosts)
+
+    new_conf = parse.ParsedConfig(
+        {**source, 'profiles': profiles, 'hosts': hosts, 'roles': roles}, source=source)
+    return new_conf, diff.ConfigDiff(
+        profiles=diff.diff_entries(
+            section(conf, 'profiles'), profiles, profile_changes.changed),
+        hosts=diff.diff_entries(old_hosts, hosts, resolved.keys()),
+        roles=diff.diff_entries(section(conf, 'roles'), roles, role_changes.changed))
+
+def reload_config(cfg_path, conf):
+    """Read the configuration file anew, re-parsing only entries which changed relative to 'conf'.
+
+    Returns the new configuration & a 'ConfigDiff' describing the changes.
+
+    NOTE: raises the same errors as 'read_config' and 'parse_config'
+    """
+    return reparse_config(conf, read_config(cfg_path))
@@ -0,0 +1,46 @@
+"""
+Describe the differences between two parsed configurations.
+
+Used when reloading the configuration to tell which profiles, hosts and
+roles must be resolved anew & which derived state (roledefs, passwords,
+open connections) is affected.
+"""
+from collections import namedtuple
+
+class Changes(namedtuple('Changes', ['added', 'removed', 'changed'])):
+    """Labels of the entries added, removed & changed (frozensets)."""
+    __slots__ = ()
+
+    @property
+    def touched(self):
+        """labels of all entries which were added, removed or changed."""
+        return self.added | self.removed | self.changed
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+NO_CHANGES = Changes(frozenset(), frozenset(), frozenset())
+
+# Changes to the profiles, hosts & roles of a configuration
+ConfigDiff = namedtuple('ConfigDiff', ['profiles', 'hosts', 'roles'])
+
+def diff_entries(old, new, candidates=None):
+    """Compare the label => entry mappings 'old' & 'new'.
+
+    If given, only the entries of 'candidates' are compared, all other
+    entries present in both are assumed to be unchanged."""
+    old_keys, new_keys = old.keys(), new.keys()
+    if candidates is None:
+        candidates = old_keys & new_keys
+    return Changes(
+        added=frozenset(new_keys - old_keys),
+        removed=frozenset(old_keys - new_keys),
+        changed=frozenset(
+            label for label in candidates
+            if label in old and label in new and old[label] != new[label]))
+
+def diff_configs(old, new):
+    """Compare the profiles, hosts & roles of two parsed configurations."""
+    return ConfigDiff(*(
+        diff_entries(old.get(section, {}), new.get(section, {}))
+        for section in ConfigDiff._fields))
@@ -1,23 +1,34 @@
 """
 Functionality used to parse and create a canonical representation of the entries defined
 in the configuration file.
+
+NOTE: the schemas (and voluptuous) are imported by the functions validating
+entries, configs loaded from the cache never need them.
 """
+import re
 from os import getcwd
-from functools import reduce
-from funcy.colls import get_in, update_in
-from funcy.seqs import keep
-from voluptuous.error import Invalid
-from prefab.utils import walk
-from prefab import schema as sc
-from . import schemas as scc
+from string import Formatter
+from collections import namedtuple
+from functools import lru_cache
+from prefab.utils import walk, fscache
+from .records import HostRecord, LazyHosts
 
 class VarExpansionError(Exception):
     """Indicate string interpolation expansion error.
 
     Error which is raised if a config string references a variable
-    (string interpolation) which isn't defined in the environment."""
-    def __init__(self, env, varname, val):
-        super().__init__("Error encountered while expanding the configuration file. Configuration refers to unbound variable '{varname}'.".format(varname=varname))
+    (string interpolation) which isn't defined in the environment.
+
+    If several unbound variables are referenced, 'unbound' lists all
+    of them as (varname, value) pairs, 'varname' & 'value' describe the first."""
+    def __init__(self, env, varname, val, unbound=None):
+        self._unbound = unbound or [(varname, val)]
+        if len(self._unbound) == 1:
+            msg = "Configuration refers to unbound variable '{varname}'.".format(varname=varname)
+        else:
+            msg = "Configuration refers to unbound variables: {}.".format(", ".join(
+                "'{}' (in '{}')".format(name, value) for (name, value) in self._unbound))
+        super().__init__("Error encountered while expanding the configuration file. " + msg)
 
         self._env = env
         self._varname = varname
@@ -26,7 +37,7 @@ class VarExpansionError(Exception):
     @property
     def env(self):
         """The environment used satisfying variables"""
-        return self.env
+        return self._env
 
     @property
     def varname(self):
@@ -38,6 +49,11 @@ class VarExpansionError(Exception):
         """string which raised the exception."""
         return self._value
 
+    @property
+    def unbound(self):
+        """all (varname, value) pairs referring to unbound variables."""
+        return self._unbound
+
 def make_var_env(env, cwd=getcwd(), prefix='__'):
     """
     Given an environment (expressed as a dictionary), yield a environment for variable expansion.
@@ -49,29 +65,88 @@ def make_var_env(env, cwd=getcwd(), prefix='__'):
     var_env = {
         lstrip(k, prefix).lower(): v
         for (k, v) in env.items()
-        if k is str and k.startswith(prefix)
+        if isinstance(k, str) and k.startswith(prefix)
     }
     var_env['cwd'] = cwd
     var_env['home'] = env['HOME']
     return var_env
 
+__formatter = Formatter()
+
+# compiled template => (root variable names referenced, parsed template)
+Template = namedtuple('Template', ['varnames', 'parts'])
+
+@lru_cache(maxsize=4096)
+def compile_template(strval):
+    """Compile a str.format-style template, None if 'strval' is a literal string.
+
+    'parts' holds (literal_text, field_name, format_spec, conversion) tuples as
+    produced by 'string.Formatter().parse'. 'varnames' includes the variables
+    referenced by format specs (e.g. 'width' of '{a:{width}}')."""
+    if '{' not in strval and '}' not in strval:
+        return None
+    parts = tuple(__formatter.parse(strval))
+    varnames = []
+    for (_, field_name, spec, _) in parts:
+        if field_name is None:
+            continue
+        varnames.append(re.match(r'[^.\[]*', field_name).group())
+        if spec and '{' in spec:
+            varnames.extend(compile_template(spec).varnames)
+    return Template(tuple(varnames), parts)
+
+def render_template(template, var_env):
+    """Render compiled template using the variables of 'var_env'.
+
+    NOTE: all variables referenced by the template must be bound."""
+    out = []
+    for (literal, field_name, spec, conversion) in template.parts:
+        out.append(literal)
+        if field_name is not None:
+            obj, _ = __formatter.get_field(field_name, (), var_env)
+            obj = __formatter.convert_field(obj, conversion)
+            if spec and '{' in spec:
+                spec = render_template(compile_template(spec), var_env)
+            out.append(__formatter.format_field(obj, spec))
+    return ''.join(out)
+
 def expand_vars(conf, var_env):
     """
     Expand variables contained in configuration, with vars given from var_env.
 
     conf    - the configuration, can be a nested datastructure of dicts/sets/lists etc
     var_env - the environment used for expanding variables in strings
+
+    Strings without replacement fields are passed through untouched, repeated
+    strings are only expanded once. References to unbound variables are
+    collected across the entire configuration and reported together.
     """
+    expanded = {}
+    unbound = []
     def __expand_var(val):
         """expand vars in val iff val is a string."""
-        if isinstance(val, str):
-            try:
-                return val.format(**var_env)
-            except KeyError as exc:
-                # variable refers to undefined variables
-                raise VarExpansionError(var_env, exc.args[0], val)
-        return val
-    return walk.prewalk(__expand_var, conf)
+        if not isinstance(val, str):
+            return val
+        result = expanded.get(val)
+        if result is not None:
+            return result
+        template = compile_template(val)
+        if template is None:
+            result = val
+        else:
+            missing = [name for name in template.varnames if name not in var_env]
+            if missing:
+                unbound.extend((name, val) for name in missing)
+                result = val
+            else:
+                result = render_template(template, var_env)
+        expanded[val] = result
+        return result
+    result = walk.prewalk(__expand_var, conf)
+    if unbound:
+        varname, val = unbound[0]
+        raise VarExpansionError(var_env, varname, val, unbound=unbound)
+    return result
 
 class HostEntryError(Exception):
     """Base error indicating a malformatted host entry."""
@@ -119,44 +194,153 @@ class HostEntryProfileMissing(HostEntryError):
         """get label identifying the referenced profile."""
         return self.host_config['profile']
 
-def normalize_hosts(conf):
-    """ Resolve the host entries of the configuration file."""
+class KeyFilesError(Exception):
+    """Raised when SSH key files referenced by hosts are missing, unreadable or unprotected.
+
+    Problems are reported per key file, listing the hosts referring to it."""
+    def __init__(self, problems):
+        super().__init__("SSH key file(s) unusable: {}".format("; ".join(
+            "'{}' is {} (hosts: {})".format(fpath, reason, ", ".join(labels))
+            for (fpath, (reason, labels)) in sorted(problems.items()))))
+        self._problems = problems
+
+    @property
+    def problems(self):
+        """path => (reason, host labels) for each problematic key file."""
+        return self._problems
+
+def _host_key_files(host_config, profiles):
+    """key files a (raw) host entry will use, directly or through its profile."""
+    if not isinstance(host_config, dict):
+        return []
+    keys = host_config.get('keys')
+    if keys is None and isinstance(host_config.get('profile'), str):
+        profile = profiles.get(host_config['profile']) or {}
+        keys = profile.get('connection', {}).get('keys')
+    if not isinstance(keys, (list, tuple)):
+        return []
+    return [key for key in keys if isinstance(key, str)]
+
+def check_key_files(hosts, profiles, refresh=False):
+    """Check the distinct key files referenced by 'hosts' in one batch.
+
+    If 'refresh' is set, files are checked anew rather than reusing the
+    results cached from earlier checks.
+
+    Raises 'KeyFilesError' describing each missing or unreadable key file, as
+    well as those accessible by group or others - which ssh refuses to use."""
+    users = {}
+    for (label, host_config) in hosts.items():
+        for fpath in _host_key_files(host_config, profiles):
+            users.setdefault(fpath, []).append(label)
+    if refresh:
+        fscache.stats.forget(users)
+    problems = {}
+    for (fpath, fstat) in fscache.stats.prime(users).items():
+        if not fstat.isfile:
+            problems[fpath] = ('missing', users[fpath])
+        elif not fstat.readable:
+            problems[fpath] = ('unreadable', users[fpath])
+        elif fstat.mode & 0o077:
+            problems[fpath] = ('unprotected (mode {:04o})'.format(fstat.mode), users[fpath])
+    if problems:
+        raise KeyFilesError(problems)
+
+def _classify_host(host_config):
+    """Tag the shape of a (raw) host entry.
+
+    'profile'    - entry referring to a profile to merge with
+    'complete'   - fully typed-out entry, no profile
+    None         - malformed entry
+    """
+    if not isinstance(host_config, dict) or 'address' not in host_config:
+        return None
+    if 'profile' in host_config:
+        return 'profile'
+    if 'method' in host_config:
+        return 'complete'
+    return None
+
+def normalize_profiles(profiles):
+    """Validate the profile entries (label => profile), filling in defaults."""
+    from . import schemas as scc
+    return scc.profiles_validator(profiles)
+
+def normalize_hosts(conf, only=None, expand=None, profiles=None):
+    """ Resolve the host entries of the configuration file.
+
+    Each entry is classified once, merged with its profile (if any) and the
+    result is validated exactly once. Profiles & the key files referenced
+    by hosts are checked up-front.
+
+    Entries referring to a profile are represented by 'HostRecord's, storing
+    only the values which differ from the profile's connection settings.
+
+    only     - labels of the hosts to resolve up-front, the remaining hosts are
+               resolved on first access (see 'LazyHosts'). None => all hosts.
+    expand   - fn(label => raw entry) => label => entry, applied to host
+               entries before resolving them (e.g. to expand variables).
+    profiles - the (already validated) profiles to use in place of those of 'conf'.
+    """
+    from voluptuous.error import Invalid
+    from . import schemas as scc
+    if profiles is None:
+        profiles = normalize_profiles(conf.get('profiles', {}))
+    hosts = conf.get('hosts', {})
+    if only is not None:
+        hosts = {label: hosts[label] for label in only if label in hosts}
+    if expand is not None:
+        hosts = expand(hosts)
+    check_key_files(hosts, profiles)
+
     def normalize_host(label, host_config):
         """Given a host entry, resolve it provided."""
-        # already OK, skip
-        if sc.valid(scc.host, host_config):
-            return host_config
-
-        # malformed entry, incomplete & missing required entries
-        if not sc.valid(scc.json_host, host_config):
-            if 'address' not in host_config:
+        shape = _classify_host(host_config)
+        if shape is None:
+            if not isinstance(host_config, dict):
+                reason = None # will offer a generic default msg
+            elif 'address' not in host_config:
                 reason = "missing 'address' field"
-            elif 'profile' not in host_config:
-                reason = "missing 'profile' field. Incomplete entries must refer to a profile"
             else:
-                reason = None # will offer a generic default msg
+                reason = "missing 'profile' field. Incomplete entries must refer to a profile"
             raise HostEntryError(label, host_config, reason=reason)
 
-        # fetch referenced profile
-        profile = get_in(conf, ['profiles', host_config['profile']])
-        if not profile:
-            raise HostEntryProfileMissing(label, host_config)
+        if shape == 'profile':
+            profile = profiles.get(host_config['profile'])
+            if not profile:
+                raise HostEntryProfileMissing(label, host_config)
+            host_entry = {**profile['connection'], **host_config}
+            reason = (
+                "merging entry with profile '{}' does not produce a valid host entry"
+                .format(host_config['profile']))
+        else:
+            host_entry = host_config
+            reason = None
 
-        host_entry = {**profile['connection'], **host_config}
         try:
-            return scc.host(host_entry)
+            host_entry = scc.host_validator(host_entry)
         except Invalid as exc:
-            raise HostEntryError(
-                label, host_entry,
-                reason=(
-                    "merging entry with profile '{}' does not produce a valid host entry"
-                    .format(host_config['profile'])),
-                error=exc)
-    return update_in(
-        conf, ['hosts'],
-        lambda hosts: {
-            lbl: normalize_host(lbl, entry)
-            for (lbl, entry) in hosts.items()})
+            raise HostEntryError(label, host_entry, reason=reason, error=exc)
+        if shape == 'profile':
+            # share the profile's settings rather than copying them per host
+            return HostRecord.compact(host_entry, profile['connection'])
+        return host_entry
+
+    def normalize_deferred(label, host_config):
+        """resolve a host entry on first access, checking its key files."""
+        if expand is not None:
+            host_config = expand({label: host_config})[label]
+        check_key_files({label: host_config}, profiles)
+        return normalize_host(label, host_config)
+
+    normalized = {lbl: normalize_host(lbl, entry) for (lbl, entry) in hosts.items()}
+    return {
+        **conf,
+        'profiles': profiles,
+        'hosts': (
+            normalized if only is None
+            else LazyHosts(conf.get('hosts', {}), normalize_deferred, normalized))
+    }
 
 class MissingHostsError(Exception):
     """Raised when configuration refers one or more hosts who lacks a corresponding definition."""
@@ -167,27 +351,19 @@ class MissingHostsError(Exception):
         super().__init__(msg)
 
 def _check_role_refs(conf, role_entries):
-    def undefined_host(host_label):
-        """Returns input host label iff host could not be found in config."""
-        if not get_in(conf, ['hosts', host_label]):
-            return host_label
-        return False
-    def set_merge(myset, iterable):
-        """update set with contents of iterable and return it.
-
-        NOTE: in-place updates"""
-        myset.update(iterable)
-        return myset
-    hosts = reduce(
-        lambda acc, host_list: set_merge(acc, host_list),
-        map(lambda r: r['hosts'], role_entries.values()),
-        set())
-    return keep(undefined_host, hosts)
+    """Return the (sorted) labels of hosts referenced by roles, but not defined in 'conf'."""
+    hosts = conf.get('hosts', {})
+    return sorted({
+        label
+        for role_entry in role_entries.values()
+        for label in role_entry['hosts']
+        if label not in hosts})
 
 def normalize_roles(conf):
-    # check to see if the hosts referenced in
-    # the roles actually exist.
+    """Normalize role entries & check that all hosts they refer to are defined.
 
+    Raises 'MissingHostsError' if roles refer to undefined hosts."""
+    from . import schemas as scc
     def normalize_role(role_entry):
         """normalize roles into the dict-style representation.
 
@@ -198,13 +374,30 @@ def normalize_roles(conf):
         if isinstance(role_entry, list):
             return {'hosts': role_entry, 'env': {}}
         return role_entry
-    normalized_role_entries = {
+    normalized_role_entries = scc.roles_validator({
         label: normalize_role(role)
         for (label, role)
         in conf.get('roles', {}).items()
-    }
-    _check_role_refs(conf, normalized_role_entries)
+    })
+    missing_hosts = _check_role_refs(conf, normalized_role_entries)
+    if missing_hosts:
+        raise MissingHostsError(missing_hosts)
     return {
         **conf,
         **{'roles': normalized_role_entries}
     }
+
+class ParsedConfig(dict):
+    """Configuration which has been normalized & validated by 'parse_config'.
+
+    Consumers (e.g. 'initialize') may trust instances to conform to the
+    'config' schema without validating them again.
+
+    'source' holds the configuration as it was before normalization (with
+    variables expanded), allowing 'reparse_config' to tell which entries
+    changed. It is None if unavailable (e.g. configs loaded from the cache).
+
+    NOTE: the configuration must not be modified after parsing."""
+    def __init__(self, *args, source=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.source = source
@@ -0,0 +1,139 @@
+"""
+Compact representation of host entries.
+
+Normalized host entries referring to a profile are mostly made up of the
+profile's connection settings. Instead of materializing the merged entry
+per host, a 'HostRecord' references the (shared) profile connection
+settings and stores only the values which differ from it.
+"""
+from collections.abc import Mapping
+
+# interned key tuples, hosts overriding the same keys share one tuple
+__key_sets = {}
+
+def _intern_keys(keys):
+    """return the shared instance of the 'keys' tuple."""
+    return __key_sets.setdefault(keys, keys)
+
+class HostRecord(Mapping):
+    """Read-only host entry, a shared base mapping overlaid with per-host overrides.
+
+    Overrides are stored as a (shared, interned) tuple of keys and a tuple
+    of the corresponding values."""
+    __slots__ = ('_base', '_keys', '_values')
+
+    def __init__(self, base, overrides):
+        self._base = base
+        self._keys = _intern_keys(tuple(overrides))
+        self._values = tuple(overrides.values())
+
+    @classmethod
+    def compact(cls, entry, base):
+        """Create a record equal to 'entry', sharing all values equal to those of 'base'.
+
+        NOTE: 'entry' must hold every key of 'base'."""
+        return cls(base, {
+            k: v for (k, v) in entry.items()
+            if k not in base or base[k] != v})
+
+    @property
+    def base(self):
+        """the shared mapping (e.g. a profile's connection settings)."""
+        return self._base
+
+    @property
+    def overrides(self):
+        """values specific to this host."""
+        return dict(zip(self._keys, self._values))
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            return self._values[self._keys.index(key)]
+        return self._base[key]
+
+    def __contains__(self, key):
+        return key in self._keys or key in self._base
+
+    def __iter__(self):
+        yield from self._keys
+        for key in self._base:
+            if key not in self._keys:
+                yield key
+
+    def __len__(self):
+        return len(self._keys) + sum(1 for key in self._base if key not in self._keys)
+
+    def __repr__(self):
+        return "HostRecord({!r})".format(dict(self))
+
+def compact_hosts(conf):
+    """Convert the (normalized) host entries of 'conf' referring to a profile into host records."""
+    if isinstance(conf.get('hosts'), LazyHosts):
+        return conf
+    profiles = conf.get('profiles', {})
+    def compact(entry):
+        profile = profiles.get(entry.get('profile'))
+        if profile is None or isinstance(entry, HostRecord):
+            return entry
+        return HostRecord.compact(entry, profile['connection'])
+    return {
+        **conf,
+        'hosts': {label: compact(entry) for (label, entry) in conf.get('hosts', {}).items()}
+    }
+
+def json_default(obj):
+    """'default' hook for json.dump(s), serializing host records as plain dicts."""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+class LazyHosts(Mapping):
+    """Host entries which are normalized on first access (& memoized).
+
+    raw_hosts - label => raw host entry
+    normalize - fn(label, raw_entry) => normalized entry
+    hosts     - label => already normalized entries
+    """
+    def __init__(self, raw_hosts, normalize, hosts=None):
+        self._raw = raw_hosts
+        self._normalize = normalize
+        self._hosts = dict(hosts or {})
+
+    @property
+    def normalized(self):
+        """label => normalized entry of the hosts normalized so far, in order of normalization.
+
+        NOTE: only ever grows, entries are never removed or replaced."""
+        return self._hosts
+
+    @property
+    def pending(self):
+        """True iff some hosts have yet to be normalized."""
+        return len(self._hosts) < len(self._raw)
+
+    def pending_items(self):
+        """(label, raw entry) of each host yet to be normalized."""
+        return [(label, raw) for (label, raw) in self._raw.items() if label not in self._hosts]
+
+    def force(self):
+        """Normalize all remaining hosts."""
+        for label in self._raw:
+            self[label]
+
+    def __getitem__(self, label):
+        try:
+            return self._hosts[label]
+        except KeyError:
+            pass
+        entry = self._normalize(label, self._raw[label])
+        self._hosts[label] = entry
+        return entry
+
+    def __contains__(self, label):
+        return label in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
@@ -2,9 +2,9 @@
 Schema definitions collectively making up the config file
 """
 # pylint: disable-msg=C0103
-from os import path
 import voluptuous as v
 from prefab import schema as sc
+from prefab.utils import fscache
 
 port = v.All(int, v.Range(min=1, max=65535))
 env = sc.dictof(str, v.Any(str, int, float, bool, None))
@@ -24,7 +24,7 @@ host = v.All(
         # SSH Key Login
         sc.mapping({
             v.Required('method'): 'key',
-            v.Required('keys'): sc.non_empty(sc.seqof(sc.pred(path.isfile)))
+            v.Required('keys'): sc.non_empty(sc.seqof(sc.pred(fscache.isfile)))
         }),
         # Password Login
         sc.mapping({
@@ -55,7 +55,11 @@ profile = sc.mapping({
 
 role_entry = sc.mapping({
     v.Required('hosts'): sc.non_empty(sc.seqof(str)),
-    'env': env
+    'env': env,
+    # max. number of hosts to run tasks on concurrently
+    'parallel': v.All(int, v.Range(min=1)),
+    # max. time (seconds) a task may take on any one host
+    'timeout': v.All(v.Any(int, float), v.Range(min=0, min_included=False))
 })
 
 json_roles = sc.dictof(str, v.Any(
@@ -76,3 +80,14 @@ config = sc.mapping({
     'hosts': sc.dictof(str, host),
     'roles': sc.dictof(str, role_entry)
 })
+
+## Compiled validators
+#
+# Specialized versions of the schemas above (see 'prefab.schema.compiler'),
+# raising the same errors. Used when parsing configurations, where
+# voluptuous' exception-driven validation dominates on large inventories.
+host_validator = sc.compile_schema(host)
+profiles_validator = sc.compile_schema(sc.dictof(str, profile))
+roles_validator = sc.compile_schema(sc.dictof(str, role_entry))
+json_config_validator = sc.compile_schema(json_config)
+config_validator = sc.compile_schema(config)
@@ -0,0 +1,90 @@
+"""
+Tests caching of parsed configurations.
+"""
+import os
+import json
+import pytest
+from . import cache
+from .core import load_config
+
+@pytest.fixture
+def key_file(tmp_path):
+    """an SSH key file referenced by the config."""
+    fpath = tmp_path / "id_test"
+    fpath.write_text("key")
+    return str(fpath)
+
+@pytest.fixture
+def conf(key_file):
+    """a parsed configuration referencing 'key_file'."""
+    return {
+        'profiles': {},
+        'hosts': {
+            'vm1': {
+                'address': 'srv1.example.com', 'port': 22, 'user': 'root',
+                'method': 'key', 'keys': [key_file]
+            }
+        },
+        'roles': {}
+    }
+
+def test_cache_roundtrip(tmp_path, conf):
+    """Ensure stored entries are loaded back as-is."""
+    entry = cache.cache_path("prefab.json", str(tmp_path))
+    cache.store(entry, "k", conf)
+    assert cache.load(entry, "k") == conf
+
+def test_cache_private(tmp_path, conf):
+    """Ensure entries (holding passwords) & their directory are readable by the current user only."""
+    directory = tmp_path / "cache"
+    entry = cache.cache_path("prefab.json", str(directory))
+    cache.store(entry, "k", conf)
+    assert os.stat(entry).st_mode & 0o777 == 0o600
+    assert os.stat(str(directory)).st_mode & 0o777 == 0o700
+
+def test_cache_miss_key(tmp_path, conf):
+    """Ensure entries stored under another key are ignored."""
+    entry = cache.cache_path("prefab.json", str(tmp_path))
+    cache.store(entry, "k", conf)
+    assert cache.load(entry, "other") is None
+
+def test_cache_miss_missing(tmp_path):
+    """Ensure missing entries register as a miss."""
+    assert cache.load(cache.cache_path("prefab.json", str(tmp_path)), "k") is None
+
+@pytest.mark.parametrize("change", [
+    lambda fpath: open(fpath, 'a').write("more"),
+    os.remove
+])
+def test_cache_invalidate_key_file(tmp_path, conf, key_file, change):
+    """Ensure changes to referenced key files invalidate the entry."""
+    entry = cache.cache_path("prefab.json", str(tmp_path))
+    cache.store(entry, "k", conf)
+    change(key_file)
+    assert cache.load(entry, "k") is None
+
+@pytest.mark.parametrize("raw,var_env,other_raw,other_var_env", [
+    (b'{}', {'home': '/a'}, b'{} ', {'home': '/a'}),
+    (b'{}', {'home': '/a'}, b'{}', {'home': '/b'}),
+])
+def test_cache_key(raw, var_env, other_raw, other_var_env):
+    """Ensure the key reflects both file contents & the variable environment."""
+    assert cache.cache_key(raw, var_env) != cache.cache_key(other_raw, other_var_env)
+
+def test_load_config_var_env(tmp_path, monkeypatch):
+    """Ensure changing a '__' environment variable invalidates the cached config."""
+    cfg_path = tmp_path / "prefab.json"
+    cfg_path.write_text(json.dumps({
+        'profiles': {},
+        'hosts': {'vm1': {
+            'address': 'srv1', 'method': 'password', 'password': 'secret',
+            'user': '{deploy_user}'}},
+        'roles': {}
+    }))
+    def user():
+        conf = load_config(str(cfg_path), cache_dir=str(tmp_path / "cache"))
+        return conf['hosts']['vm1']['user']
+    monkeypatch.setenv('__DEPLOY_USER', 'alice')
+    assert user() == 'alice'
+    monkeypatch.setenv('__DEPLOY_USER', 'bob')
+    assert user() == 'bob'
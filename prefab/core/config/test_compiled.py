@@ -0,0 +1,100 @@
+"""
+Tests the compiled (binary) form of parsed configurations.
+"""
+import os
+import json
+import pytest
+from . import compiled
+from .core import parse_config, load_config, compile_config
+from .records import HostRecord
+
+VAR_ENV = {'home': '/home/user', 'cwd': '/srv'}
+
+@pytest.fixture
+def key_file(tmp_path):
+    """an SSH key file referenced by the config."""
+    fpath = tmp_path / "id_test"
+    fpath.write_text("key")
+    fpath.chmod(0o600)
+    return str(fpath)
+
+@pytest.fixture
+def cfg_path(tmp_path, key_file):
+    """path of a configuration file."""
+    fpath = tmp_path / "prefab.json"
+    fpath.write_text(json.dumps({
+        'profiles': {
+            'default': {'connection': {'method': 'key', 'keys': [key_file], 'port': 2222}}},
+        'hosts': {
+            'vm1': {'address': 'srv1', 'profile': 'default'},
+            'vm2': {'address': 'srv2', 'profile': 'default', 'user': 'admin'},
+            'vm3': {'address': 'srv3', 'method': 'password', 'password': 'secret'},
+        },
+        'roles': {'web': ['vm1', 'vm2'], 'db': {'hosts': ['vm3'], 'env': {'x': 1}}}
+    }))
+    return str(fpath)
+
+def compile_to(cfg_path, var_env=VAR_ENV):
+    """parse & compile the config at 'cfg_path', returning (parsed config, compiled path)."""
+    with open(cfg_path) as fp:
+        conf = parse_config(json.load(fp), var_env)
+    out_path = compiled.compiled_path(cfg_path)
+    compiled.dump(out_path, conf, compiled.source_stat(os.stat(cfg_path)), var_env)
+    return conf, out_path
+
+def test_compiled_roundtrip(cfg_path):
+    """Ensure the compiled form loads as the parsed config, decoding hosts on access."""
+    conf, out_path = compile_to(cfg_path)
+    loaded = compiled.load(out_path, cfg_path, VAR_ENV)
+    assert not loaded['hosts'].normalized
+    assert loaded == conf
+    assert isinstance(loaded['hosts']['vm2'], HostRecord)
+    assert loaded['hosts']['vm2'].overrides == conf['hosts']['vm2'].overrides
+    assert loaded['hosts']['vm1'].base is loaded['profiles']['default']['connection']
+
+def test_compiled_private(cfg_path):
+    """Ensure the compiled form (holding passwords) is readable by the current user only."""
+    _, out_path = compile_to(cfg_path)
+    assert os.stat(out_path).st_mode & 0o777 == 0o600
+
+def test_compiled_stale_source(cfg_path):
+    """Ensure the compiled form is ignored once the source changes."""
+    _, out_path = compile_to(cfg_path)
+    with open(cfg_path, mode='a') as fp:
+        fp.write(" ")
+    assert compiled.load(out_path, cfg_path, VAR_ENV) is None
+
+def test_compiled_stale_var_env(cfg_path):
+    """Ensure the compiled form is ignored if expanded with other variables."""
+    _, out_path = compile_to(cfg_path)
+    assert compiled.load(out_path, cfg_path, {**VAR_ENV, 'home': '/root'}) is None
+
+def test_compiled_stale_key_file(cfg_path, key_file):
+    """Ensure changes to referenced key files invalidate the compiled form."""
+    _, out_path = compile_to(cfg_path)
+    os.remove(key_file)
+    assert compiled.load(out_path, cfg_path, VAR_ENV) is None
+
+@pytest.mark.parametrize("garble", [
+    lambda data: b'',
+    lambda data: data[:compiled.HEADER.size + 10],
+    lambda data: b'XXXX' + data[4:],
+])
+def test_compiled_corrupt(cfg_path, garble):
+    """Ensure unreadable files register as a miss."""
+    _, out_path = compile_to(cfg_path)
+    with open(out_path, mode='rb') as fp:
+        data = fp.read()
+    with open(out_path, mode='wb') as fp:
+        fp.write(garble(data))
+    assert compiled.load(out_path, cfg_path, VAR_ENV) is None
+
+def test_load_config_compiled(cfg_path, tmp_path):
+    """Ensure 'load_config' prefers an up-to-date compiled form over the file."""
+    conf, out_path = compile_config(cfg_path)
+    assert out_path == compiled.compiled_path(cfg_path)
+    loaded = load_config(cfg_path, cache_dir=str(tmp_path / "cache"))
+    assert not loaded['hosts'].normalized
+    assert loaded == conf
+    # loaded without parsing the file, hence nothing was cached
+    assert not (tmp_path / "cache").exists()
@@ -5,6 +5,7 @@ some fabric-specific data structures.
 import pytest
 from prefab.test import data as testdata
 from . confparse import *
+from .records import LazyHosts
 
 @pytest.mark.parametrize("host_lbl,expected", [
     ("vm3", {'swarm-workers', 'swarm-managers'}),
@@ -54,4 +55,55 @@ def test_role_host_strings(role, members):
     """test ability to resolve a role into the host_strings of
     the hosts participating in the role."""
     assert set(role_host_strings(testdata.config, role)) == set(
-        [host_string(host_entry(testdata.config, member)) for member in members])
\ No newline at end of file
+        [host_string(host_entry(testdata.config, member)) for member in members])
+
+@pytest.mark.parametrize('host_str,label', [
+    ("root@51.15.210.243", "vm1"),
+    ("root@51.15.210.243:24", "vm2"),
+    ("appadmin@srv3.example.com:2202", "vm3")
+])
+def test_host_label_lookup_denormalized(host_str, label):
+    """test ability to resolve host_strings not compiled from the config (e.g. lacking a port)."""
+    assert host_label(testdata.config, host_str) == label
+
+def test_host_label_ambiguous():
+    """Ensure lookups matching several host entries are rejected."""
+    conf = {
+        'hosts': {
+            'a': testdata.config['hosts']['vm1'],
+            'b': testdata.config['hosts']['vm1']
+        },
+        'roles': {}
+    }
+    with pytest.raises(AssertionError):
+        host_label(conf, host_string(host_entry(conf, 'a')))
+
+def test_host_index_memoized():
+    """Ensure the host index is built once per configuration."""
+    assert host_index(testdata.config) is host_index(testdata.config)
+
+def test_host_index_lazy_hosts():
+    """Ensure hosts normalized after the index is built are added to it."""
+    conf = {
+        'hosts': LazyHosts(testdata.config['hosts'], lambda _, entry: entry),
+        'roles': testdata.config['roles']
+    }
+    index = host_index(conf)
+    assert not index.host_strings
+    assert role_host_strings(conf, 'swarm-managers') == [
+        host_string(testdata.config['hosts']['vm3'])]
+    assert list(index.host_strings) == ['vm3']
+    assert host_label(conf, host_string(testdata.config['hosts']['vm4'])) == 'vm4'
+    assert list(index.host_strings) == ['vm3', 'vm4']
+
+def test_host_label_lazy_hosts_candidates():
+    """Ensure looking up deferred hosts only normalizes those at the same address."""
+    conf = {
+        'hosts': LazyHosts(testdata.config['hosts'], lambda _, entry: entry),
+        'roles': testdata.config['roles']
+    }
+    with pytest.raises(AssertionError):
+        host_label(conf, 'root@gateway.example.com:22')
+    assert not conf['hosts'].normalized
+    assert host_label(conf, 'root@51.15.210.243:24') == 'vm2'
+    assert list(conf['hosts'].normalized) == ['vm1', 'vm2']
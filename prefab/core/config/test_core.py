@@ -0,0 +1,80 @@
+"""
+Tests re-parsing (reloading) the configuration file.
+"""
+import copy
+import pytest
+from .core import parse_config, reparse_config
+from .parse import MissingHostsError
+from .records import HostRecord
+from . import schemas as scc
+
+VAR_ENV = {'home': '/home/user', 'cwd': '/srv'}
+
+RAW = {
+    'profiles': {'default': {'connection': {'method': 'password', 'port': 2222}}},
+    'hosts': {
+        'vm1': {'address': 'srv1', 'profile': 'default'},
+        'vm2': {'address': 'srv2', 'profile': 'default'},
+        'vm3': {'address': 'srv3', 'method': 'password'},
+    },
+    'roles': {'web': ['vm1', 'vm2'], 'db': ['vm3']}
+}
+
+@pytest.fixture
+def conf():
+    """a parsed configuration."""
+    return parse_config(copy.deepcopy(RAW), VAR_ENV)
+
+@pytest.mark.parametrize("validate", [scc.config, scc.config_validator])
+def test_parsed_config_valid(conf, validate):
+    """Ensure (plain copies of) parsed configs, holding host records, pass the 'config' schema."""
+    assert isinstance(conf['hosts']['vm1'], HostRecord)
+    assert validate(dict(conf))['hosts']['vm1'] == dict(conf['hosts']['vm1'])
+
+def test_reparse_unchanged(conf):
+    """Ensure entries are reused as-is if nothing changed."""
+    new_conf, changes = reparse_config(conf, copy.deepcopy(RAW), VAR_ENV)
+    assert not any(changes)
+    assert all(new_conf['hosts'][lbl] is conf['hosts'][lbl] for lbl in conf['hosts'])
+    assert new_conf['roles']['web'] is conf['roles']['web']
+
+def test_reparse_host(conf):
+    """Ensure only changed hosts are resolved anew."""
+    raw = copy.deepcopy(RAW)
+    raw['hosts']['vm1']['address'] = 'srv1-new'
+    del raw['hosts']['vm3']
+    raw['hosts']['vm4'] = {'address': 'srv4', 'method': 'password'}
+    raw['roles']['db'] = ['vm4']
+    new_conf, changes = reparse_config(conf, raw, VAR_ENV)
+    assert changes.hosts == ({'vm4'}, {'vm3'}, {'vm1'})
+    assert changes.roles.changed == {'db'}
+    assert new_conf['hosts']['vm1']['address'] == 'srv1-new'
+    assert new_conf['hosts']['vm2'] is conf['hosts']['vm2']
+    assert new_conf == parse_config(raw, VAR_ENV)
+
+def test_reparse_profile(conf):
+    """Ensure hosts referring to a changed profile are resolved anew."""
+    raw = copy.deepcopy(RAW)
+    raw['profiles']['default']['connection']['port'] = 22
+    new_conf, changes = reparse_config(conf, raw, VAR_ENV)
+    assert changes.profiles.changed == {'default'}
+    assert changes.hosts.changed == {'vm1', 'vm2'}
+    assert isinstance(new_conf['hosts']['vm1'], HostRecord)
+    assert new_conf['hosts']['vm1']['port'] == 22
+    assert new_conf['hosts']['vm3'] is conf['hosts']['vm3']
+
+def test_reparse_missing_hosts(conf):
+    """Ensure unchanged roles referring to removed hosts are reported."""
+    raw = copy.deepcopy(RAW)
+    del raw['hosts']['vm3']
+    with pytest.raises(MissingHostsError):
+        reparse_config(conf, raw, VAR_ENV)
+
+def test_reparse_without_source(conf):
+    """Ensure configs lacking a source are parsed in full & compared."""
+    conf.source = None
+    raw = copy.deepcopy(RAW)
+    raw['hosts']['vm3']['port'] = 23
+    new_conf, changes = reparse_config(conf, raw, VAR_ENV)
+    assert changes.hosts.changed == {'vm3'} and not changes.roles
+    assert new_conf.source is not None
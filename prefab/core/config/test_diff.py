@@ -0,0 +1,20 @@
+"""
+Tests comparing parsed configurations.
+"""
+from .diff import diff_entries, diff_configs, NO_CHANGES
+
+def test_diff_entries():
+    """Ensure added, removed & changed entries are told apart."""
+    changes = diff_entries({'a': 1, 'b': 2, 'c': 3}, {'b': 2, 'c': 4, 'd': 5})
+    assert changes == ({'d'}, {'a'}, {'c'})
+    assert changes.touched == {'a', 'c', 'd'}
+
+def test_diff_entries_candidates():
+    """Ensure only candidates are compared."""
+    assert diff_entries({'a': 1, 'b': 2}, {'a': 3, 'b': 4}, ['b']).changed == {'b'}
+
+def test_diff_configs_unchanged():
+    """Ensure identical configs yield no changes."""
+    conf = {'profiles': {}, 'hosts': {'vm1': {}}, 'roles': {'r': {'hosts': ['vm1']}}}
+    assert diff_configs(conf, dict(conf)) == (NO_CHANGES,) * 3
+    assert not any(diff_configs(conf, dict(conf)))
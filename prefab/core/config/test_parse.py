@@ -0,0 +1,158 @@
+"""
+Tests parsing (expansion & normalization) of the configuration file.
+"""
+import os
+import pytest
+from .parse import (
+    expand_vars, compile_template, make_var_env, VarExpansionError, normalize_hosts, normalize_roles,
+    HostEntryError, HostEntryProfileMissing, MissingHostsError, KeyFilesError)
+from .core import parse_config
+
+VAR_ENV = {'home': '/home/user', 'cwd': '/srv', 'port': 22}
+
+@pytest.mark.parametrize("val,expected", [
+    ("{home}/.ssh/id_rsa", "/home/user/.ssh/id_rsa"),
+    ("{cwd}:{port:05d}", "/srv:00022"),
+    ("{port!r}", "22"),
+    ("{{literal}}", "{literal}"),
+    ("plain", "plain"),
+    (42, 42),
+])
+def test_expand_vars_leaf(val, expected):
+    """Ensure strings are expanded as str.format would."""
+    assert expand_vars(val, VAR_ENV) == expected
+
+def test_expand_vars_nested():
+    """Ensure keys & values of nested structures are expanded."""
+    conf = {'hosts': {'vm1': {'keys': ['{home}/a', '{home}/b']}}, '{cwd}': [1]}
+    assert expand_vars(conf, VAR_ENV) == {
+        'hosts': {'vm1': {'keys': ['/home/user/a', '/home/user/b']}}, '/srv': [1]}
+
+def test_expand_vars_literal_shared():
+    """Ensure subtrees without replacement fields are left untouched."""
+    conf = {'hosts': {'vm1': {'address': 'srv1.example.com'}}, 'keys': ['{home}/a']}
+    assert expand_vars(conf, VAR_ENV)['hosts'] is conf['hosts']
+
+def test_make_var_env():
+    """Ensure prefixed environment variables are available for expansion, lower-cased."""
+    env = {'HOME': '/home/user', '__DEPLOY_USER': 'admin', 'DEPLOY_HOST': 'srv1'}
+    assert make_var_env(env, cwd='/srv') == {
+        'deploy_user': 'admin', 'home': '/home/user', 'cwd': '/srv'}
+
+@pytest.mark.parametrize("val", ["plain", "srv1.example.com", ""])
+def test_compile_template_literal(val):
+    """Ensure strings without replacement fields compile to None."""
+    assert compile_template(val) is None
+
+def test_compile_template_varnames():
+    """Ensure root variable names are extracted from field names."""
+    assert compile_template("{home}/{a.b}/{c[0]}").varnames == ('home', 'a', 'c')
+
+def test_expand_vars_unbound_all():
+    """Ensure all unbound variables are reported at once."""
+    conf = {'a': '{missing}/x', 'b': ['{home}', '{other}', '{missing}/x']}
+    with pytest.raises(VarExpansionError) as exc:
+        expand_vars(conf, VAR_ENV)
+    assert exc.value.unbound == [('missing', '{missing}/x'), ('other', '{other}')]
+    assert exc.value.varname == 'missing'
+    assert exc.value.env is VAR_ENV
+    assert "'other'" in str(exc.value)
+
+def test_expand_vars_unbound_spec():
+    """Ensure unbound variables referenced by format specs are reported as such."""
+    assert compile_template("{a:{width}}").varnames == ('a', 'width')
+    assert expand_vars("{port:{width}}", {**VAR_ENV, 'width': 5}) == "   22"
+    with pytest.raises(VarExpansionError) as exc:
+        expand_vars("{port:{width}}", VAR_ENV)
+    assert exc.value.unbound == [('width', '{port:{width}}')]
+
+PROFILES = {
+    'default': {'connection': {'method': 'password', 'port': 2222}},
+}
+
+@pytest.mark.parametrize("entry,expected", [
+    # complete entries get their defaults filled in
+    ({'address': 'srv1', 'method': 'password'},
+     {'address': 'srv1', 'method': 'password', 'port': 22, 'user': 'root'}),
+    # entries referring to a profile are merged with it
+    ({'address': 'srv1', 'profile': 'default', 'user': 'admin'},
+     {'address': 'srv1', 'method': 'password', 'port': 2222, 'user': 'admin',
+      'profile': 'default'}),
+])
+def test_normalize_hosts(entry, expected):
+    """Ensure host entries are normalized into complete entries."""
+    conf = normalize_hosts({'profiles': PROFILES, 'hosts': {'vm1': entry}})
+    assert conf['hosts']['vm1'] == expected
+
+@pytest.mark.parametrize("entry,err,fragment", [
+    ({'method': 'password'}, HostEntryError, "missing 'address'"),
+    ({'address': 'srv1'}, HostEntryError, "missing 'profile'"),
+    ({'address': 'srv1', 'profile': 'bogus'}, HostEntryProfileMissing, "'bogus' not defined"),
+    ({'address': 'srv1', 'profile': 'default', 'port': 0}, HostEntryError, "merging entry"),
+])
+def test_normalize_hosts_err(entry, err, fragment):
+    """Ensure malformed host entries are reported."""
+    with pytest.raises(err) as exc:
+        normalize_hosts({'profiles': PROFILES, 'hosts': {'vm1': entry}})
+    assert fragment in str(exc.value)
+    assert exc.value.host_label == 'vm1'
+
+def test_normalize_roles():
+    """Ensure list-style roles are converted to the dict-style representation."""
+    conf = normalize_roles({'hosts': {'vm1': {}}, 'roles': {'r': ['vm1']}})
+    assert conf['roles'] == {'r': {'hosts': ['vm1'], 'env': {}}}
+
+def test_normalize_roles_missing_hosts():
+    """Ensure roles referring to undefined hosts are reported."""
+    with pytest.raises(MissingHostsError) as exc:
+        normalize_roles({'hosts': {'vm1': {}}, 'roles': {'r': ['vm1', 'vm9', 'vm8']}})
+    assert "['vm8', 'vm9']" in str(exc.value)
+
+def test_normalize_hosts_key_files(tmp_path):
+    """Ensure key files are checked & reported per file rather than per host."""
+    key = str(tmp_path / "id_rsa")
+    unprotected = str(tmp_path / "id_unprotected")
+    missing = str(tmp_path / "id_missing")
+    for (fpath, mode) in ((key, 0o600), (unprotected, 0o644)):
+        open(fpath, 'w').close()
+        os.chmod(fpath, mode)
+    profiles = {'keyed': {'connection': {'method': 'key', 'keys': [missing]}}}
+    hosts = {
+        'vm1': {'address': 'srv1', 'method': 'key', 'keys': [key]},
+        'vm2': {'address': 'srv2', 'profile': 'keyed'},
+        'vm3': {'address': 'srv3', 'profile': 'keyed'},
+        'vm4': {'address': 'srv4', 'method': 'key', 'keys': [key, unprotected]},
+    }
+    with pytest.raises(KeyFilesError) as exc:
+        normalize_hosts({'profiles': profiles, 'hosts': hosts})
+    assert exc.value.problems == {
+        missing: ('missing', ['vm2', 'vm3']),
+        unprotected: ('unprotected (mode 0644)', ['vm4'])}
+    assert "'{}' is unprotected (mode 0644) (hosts: vm4)".format(unprotected) in str(exc.value)
+
+def test_normalize_hosts_deferred():
+    """Ensure hosts not listed in 'only' are resolved (& checked) on first access."""
+    hosts = {
+        'vm1': {'address': 'srv1', 'method': 'password'},
+        'vm2': {'address': 'srv2'},
+    }
+    conf = normalize_hosts({'profiles': PROFILES, 'hosts': hosts}, only=['vm1'])
+    assert list(conf['hosts'].normalized) == ['vm1']
+    with pytest.raises(HostEntryError):
+        conf['hosts']['vm2']
+
+def test_parse_config_roles():
+    """Ensure only the hosts of the requested roles are resolved up-front."""
+    raw = {
+        'profiles': PROFILES,
+        'hosts': {
+            '{cwd}-vm1': {'address': '{cwd}', 'profile': 'default'},
+            'vm2': {'address': 'srv2', 'keys': ['{unbound}']},
+        },
+        'roles': {'web': ['{cwd}-vm1'], 'db': ['vm2']}
+    }
+    conf = parse_config(raw, VAR_ENV, roles=['web'])
+    assert list(conf['hosts'].normalized) == ['/srv-vm1']
+    assert conf['hosts']['/srv-vm1']['address'] == '/srv'
+    with pytest.raises(VarExpansionError):
+        conf['hosts']['vm2']
@@ -0,0 +1,61 @@
+"""
+Tests the compact host record representation.
+"""
+import json
+import pytest
+from .records import HostRecord, LazyHosts, compact_hosts, json_default
+from . import confparse as cp
+
+BASE = {'method': 'key', 'user': 'root', 'port': 22, 'keys': ['/home/smth/.ssh/id_scaleway']}
+ENTRY = {**BASE, 'address': 'srv1.example.com', 'profile': 'scaleway', 'port': 2222}
+
+def test_compact_stores_overrides():
+    """Ensure only values differing from the base are stored per host."""
+    record = HostRecord.compact(ENTRY, BASE)
+    assert record.overrides == {'address': 'srv1.example.com', 'profile': 'scaleway', 'port': 2222}
+    assert record.base is BASE
+
+def test_record_mapping():
+    """Ensure records behave as the merged (read-only) entry."""
+    record = HostRecord.compact(ENTRY, BASE)
+    assert record == ENTRY
+    assert dict(record) == ENTRY
+    assert len(record) == len(ENTRY)
+    assert set(record) == set(ENTRY)
+    assert record['port'] == 2222 and record.get('password') is None
+    assert 'keys' in record and 'password' not in record
+
+def test_record_host_string():
+    """Ensure records can be consumed by confparse."""
+    assert cp.host_string(HostRecord.compact(ENTRY, BASE)) == "root@srv1.example.com:2222"
+
+def test_compact_hosts():
+    """Ensure only hosts referring to a (defined) profile are compacted."""
+    conf = {
+        'profiles': {'scaleway': {'connection': BASE}},
+        'hosts': {'vm1': ENTRY, 'vm2': {**BASE, 'address': 'srv2.example.com'}}
+    }
+    compacted = compact_hosts(conf)
+    assert isinstance(compacted['hosts']['vm1'], HostRecord)
+    assert compacted['hosts']['vm1'].base is BASE
+    assert compacted['hosts']['vm2'] is conf['hosts']['vm2']
+
+def test_json_default():
+    """Ensure records serialize as plain dicts."""
+    record = HostRecord.compact(ENTRY, BASE)
+    assert json.loads(json.dumps(record, default=json_default)) == ENTRY
+    with pytest.raises(TypeError):
+        json.dumps(object(), default=json_default)
+
+def test_lazy_hosts():
+    """Ensure entries are normalized once, on first access."""
+    calls = []
+    def normalize(label, entry):
+        calls.append(label)
+        return {**entry, 'normalized': True}
+    hosts = LazyHosts({'vm1': {}, 'vm2': {}}, normalize, {'vm1': {'normalized': True}})
+    assert list(hosts) == ['vm1', 'vm2'] and 'vm2' in hosts and hosts.pending
+    assert hosts.pending_items() == [('vm2', {})]
+    assert hosts['vm2'] is hosts['vm2']
+    assert calls == ['vm2'] and not hosts.pending
+    assert list(hosts.normalized) == ['vm1', 'vm2']
@@ -0,0 +1,179 @@
+"""
+Pool of SSH connections shared across tasks.
+
+Replaces fabric's connection cache (fabric.state.connections) such that
+authenticated sessions are kept alive across successive execute() calls,
+keyed by host label rather than by host string. Connections idle for too
+long are closed, the number of open connections can be capped (closing
+the least recently used first) and pooled connections are health-checked
+before being handed out again.
+
+Given a host store (see 'hoststore'), connecting to a host records its
+latency, host key or failure, and hosts whose circuit is open are refused
+without trying to connect.
+"""
+from collections import OrderedDict
+from time import monotonic
+
+from fabric.network import HostConnectionCache, normalize, normalize_to_string
+from .hoststore import known_host_name
+from . import instrument
+
+class ConnectionPool(HostConnectionCache):
+    """Connection cache with idle eviction, a connection cap and health checks.
+
+    key_fn          - maps a host string to its pool key (the host label), may
+                      return None for hosts unknown to prefab (e.g. gateways),
+                      which are keyed by their normalized host string instead.
+    max_connections - max. number of open connections (None => unbounded)
+    idle_timeout    - close connections unused for this long (seconds, None => never)
+    check_interval  - probe connections idle for this long (seconds) before reuse
+    store_fn        - returns the 'hoststore.HostStore' connections to known hosts
+                      are recorded in (None if not recording)
+    breaker_fn      - returns the 'hoststore.Breaker' settings (None to never refuse)
+    max_connections_fn - returns the max. number of open connections, overriding
+                      'max_connections' unless None
+    """
+    def __init__(self, key_fn=None, max_connections=None, idle_timeout=300, check_interval=30,
+                 store_fn=None, breaker_fn=None, max_connections_fn=None):
+        super().__init__()
+        self.key_fn = key_fn
+        self.store_fn = store_fn
+        self.breaker_fn = breaker_fn
+        self.max_connections = max_connections
+        self.max_connections_fn = max_connections_fn
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        # pool key => host string used to connect, kept once the connection
+        # is closed such that pool keys (labels) can be reconnected
+        self._host_strings = {}
+        # pool key => time of last use, least recently used first
+        self._last_used = OrderedDict()
+
+    def _key(self, key):
+        """translate a host string (or existing pool key) into a pool key."""
+        if dict.__contains__(self, key) or key in self._host_strings:
+            return key
+        label = self.key_fn(key) if self.key_fn else None
+        return label if label is not None else normalize_to_string(key)
+
+    def _touch(self, pool_key):
+        self._last_used[pool_key] = monotonic()
+        self._last_used.move_to_end(pool_key)
+
+    def _healthy(self, pool_key, client):
+        """check if the pooled connection is still usable."""
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        idle = monotonic() - self._last_used.get(pool_key, 0)
+        if self.check_interval is not None and idle >= self.check_interval:
+            try:
+                transport.send_ignore()
+            except Exception: # pylint: disable=W0703
+                return False
+        return True
+
+    def discard(self, key):
+        """Close & remove the connection identified by 'key' (host string or label), if any."""
+        pool_key = self._key(key)
+        client = dict.pop(self, pool_key, None)
+        self._last_used.pop(pool_key, None)
+        if client is not None:
+            try:
+                client.close()
+            except Exception: # pylint: disable=W0703
+                pass
+
+    def evict_idle(self, keep=None):
+        """Close connections which have been idle for longer than 'idle_timeout'."""
+        if self.idle_timeout is None:
+            return
+        cutoff = monotonic() - self.idle_timeout
+        for pool_key, last_used in list(self._last_used.items()):
+            if last_used > cutoff:
+                break # remaining entries were used more recently
+            if pool_key != keep:
+                self.discard(pool_key)
+
+    def connect(self, key):
+        """
+        Force a new connection to 'key', evicting connections as needed to stay within limits.
+        """
+        pool_key = self._key(key)
+        host_str = self._host_strings.get(pool_key, key) if key == pool_key else key
+        self.discard(pool_key)
+        self.evict_idle()
+        limit = self._max_connections()
+        while limit and len(self._last_used) >= limit:
+            self.discard(next(iter(self._last_used)))
+        label = self.key_fn(host_str) if self.key_fn else None
+        store = self.store_fn() if self.store_fn and label is not None else None
+        if store is not None:
+            refused = store.unavailable([label], self.breaker_fn() if self.breaker_fn else None)
+            if refused:
+                raise refused[label]
+        start = monotonic()
+        with instrument.span('connect', host=pool_key):
+            try:
+                super().connect(host_str)
+            except Exception:
+                if store is not None:
+                    store.record_failure(label)
+                raise
+        if store is not None:
+            self._record_success(store, label, host_str, monotonic() - start)
+        self._host_strings[pool_key] = host_str
+        self._touch(pool_key)
+
+    def _max_connections(self):
+        """current cap on open connections (None => unbounded)."""
+        limit = self.max_connections_fn() if self.max_connections_fn else None
+        return self.max_connections if limit is None else limit
+
+    def close_all(self):
+        """Close & remove all connections, as they are (dead ones are not reconnected)."""
+        for pool_key in list(dict.keys(self)):
+            self.discard(pool_key)
+
+    def _record_success(self, store, label, host_str, latency):
+        """record the connection to host 'label' in the store, along with its host key."""
+        host_key = None
+        transport = dict.get(self, self._key(host_str)).get_transport()
+        key = transport.get_remote_server_key() if transport is not None else None
+        if key is not None:
+            _, address, port = normalize(host_str)
+            host_key = (known_host_name(address, port), key.get_name(), key.get_base64())
+        store.record_success(label, connect=latency, host_key=host_key)
+
+    def __getitem__(self, key):
+        """
+        Return a healthy connection for 'key', (re)connecting if required.
+        """
+        pool_key = self._key(key)
+        self.evict_idle(keep=pool_key)
+        client = dict.get(self, pool_key)
+        if client is None or not self._healthy(pool_key, client):
+            self.connect(key)
+            client = dict.__getitem__(self, pool_key)
+        self._touch(pool_key)
+        return client
+
+    def __setitem__(self, key, value):
+        return dict.__setitem__(self, self._key(key), value)
+
+    def __delitem__(self, key):
+        pool_key = self._key(key)
+        self._last_used.pop(pool_key, None)
+        return dict.__delitem__(self, pool_key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, self._key(key))
+
+    def clear(self):
+        """Forget all connections *without* closing them.
+
+        Used by forked workers, whose inherited connections belong to the parent."""
+        dict.clear(self)
+        self._last_used.clear()
+        self._host_strings.clear()
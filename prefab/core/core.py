@@ -3,5 +3,14 @@ The core prefab API
 """
 # pylint: disable=W0611
 
-from .fabcompat import initialize
-from .config.core import fmt_json_err, read_config, parse_config
+from .config.core import (
+    fmt_json_err, read_config, parse_config, load_config, compile_config, reparse_config,
+    reload_config)
+
+def initialize(conf):
+    """Initialize prefab, hooking into fabric (see 'fabcompat.initialize').
+
+    fabric (and with it paramiko) is imported on first use rather than
+    along with prefab.core, as it dominates start-up time."""
+    from .fabcompat import initialize as fab_initialize
+    return fab_initialize(conf)
@@ -0,0 +1,205 @@
+"""
+Push a file to many hosts, uploading it only where it differs.
+
+The file is hashed (SHA-256) once. Each host is checked with 'sha256sum'
+and skipped if its copy matches. Otherwise the file is transferred to a
+temporary path beside 'remote_path', verified & moved into place, such
+that hosts never see partial files.
+
+By default, the operator uploads to each host. With 'fanout', hosts which
+received the file serve it onward: the operator and every host holding the
+file each serve up to 'fanout' hosts at a time (copying with scp, run on
+the serving host), so the number of sources grows as the rollout
+progresses - a tree, rather than a star with the operator's link at its
+center. Hosts must then be able to log into one another (e.g. by keys
+authorized across the role). Hosts failing to receive the file from a peer
+fall back to being uploaded to by the operator.
+
+Serving hosts verify the host keys of the hosts they copy to: against their
+own known_hosts by default or, given a host store (see 'hoststore'),
+against the key the operator recorded for the host.
+
+Transfers run over the asyncio backend (see 'aio').
+"""
+import shlex
+import asyncio
+import hashlib
+from os import path
+from collections import namedtuple
+from time import monotonic
+from . import aio
+from . import instrument
+from .hoststore import known_host_name
+
+CHUNK_SIZE = 1 << 20
+
+TMP_SUFFIX = '.prefab-tmp'
+
+# values of ssh's StrictHostKeyChecking accepted for relays
+HOST_KEY_CHECKING = aio.HOST_KEY_CHECKING
+
+# How a host came to hold the file
+#
+# status - 'unchanged' (its copy already matched), 'uploaded' (by the
+#          operator) or 'relayed' (copied from another host)
+# source - label of the host it was copied from (None unless relayed)
+Delivery = namedtuple('Delivery', ['status', 'source'])
+
+class ChecksumMismatchError(Exception):
+    """Raised when the file transferred to a host does not match the local file."""
+    def __init__(self, label, expected, actual):
+        super().__init__("checksum of the file transferred to '{}' is {}, expected {}".format(
+            label, actual, expected))
+        self.label = label
+
+def file_digest(fpath):
+    """SHA-256 hex digest of the file 'fpath'."""
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def remote_digest(host, remote_path):
+    """SHA-256 hex digest of 'remote_path' on 'host', None if it cannot be read."""
+    res = await host.run("sha256sum -- {}".format(shlex.quote(remote_path)), warn_only=True)
+    if res.failed or not res:
+        return None
+    return res.split()[0]
+
+def _scp_command(entry, src_path, dst_path, host_key_checking='yes', known_host=None):
+    """command copying 'src_path' to 'dst_path' of the host of 'entry'.
+
+    known_host - known_hosts line of the host's key, which is then the only
+                 key accepted (written to a temporary known_hosts file)"""
+    scp = "scp -q -B -o StrictHostKeyChecking={} {}-P {} -- {} {}".format(
+        'yes' if known_host else host_key_checking,
+        '-o UserKnownHostsFile="$kh" ' if known_host else '',
+        int(entry['port']), shlex.quote(src_path),
+        shlex.quote("{}@{}:{}".format(entry['user'], entry['address'], dst_path)))
+    if not known_host:
+        return scp
+    return "kh=$(mktemp) && printf '%s\\n' {} > \"$kh\" && {}; rc=$?; rm -f \"$kh\"; exit $rc".format(
+        shlex.quote(known_host), scp)
+
+def _known_host(store, label, entry):
+    """known_hosts line of the key 'store' holds for host 'label', None if unknown."""
+    st = store.stats([label]).get(label)
+    host = known_host_name(entry['address'], entry['port'])
+    if st is None or st.key is None or st.key_host != host:
+        return None
+    return "{} {} {}".format(host, st.key_type, st.key)
+
+class _Rollout:
+    """state shared by the hosts receiving the file."""
+    def __init__(self, conf, local_path, remote_path, digest, transport, fanout,
+                 host_key_checking, store):
+        self.conf = conf
+        self.host_key_checking = host_key_checking
+        self.store = store
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.tmp_path = remote_path + TMP_SUFFIX
+        self.digest = digest
+        self.transport = transport
+        self.fanout = fanout
+        # sources able to serve a host, None being the operator. The hosts
+        # served last are preferred, sparing the operator's link
+        self.sources = asyncio.LifoQueue()
+        for _ in range(fanout):
+            self.sources.put_nowait(None)
+
+    async def relay(self, source, host):
+        """copy the file from host 'source' to the temporary path of 'host'."""
+        known_host = _known_host(self.store, host.label, host.entry) if self.store else None
+        command = _scp_command(
+            host.entry, self.remote_path, self.tmp_path, self.host_key_checking, known_host)
+        async with aio.session(self.conf, source, self.transport) as src:
+            with instrument.span('distribute.relay', host=host.label, detail=source):
+                await src.run(command)
+
+    async def upload(self, host):
+        """upload the local file to the temporary path of 'host'."""
+        with instrument.span('distribute.upload', host=host.label):
+            await host.put(self.local_path, self.tmp_path)
+
+    async def install(self, host):
+        """verify the file transferred to 'host' & move it into place."""
+        actual = await remote_digest(host, self.tmp_path)
+        if actual != self.digest:
+            await host.run("rm -f -- {}".format(shlex.quote(self.tmp_path)), warn_only=True)
+            raise ChecksumMismatchError(host.label, self.digest, actual)
+        await host.run("mv -f -- {} {}".format(
+            shlex.quote(self.tmp_path), shlex.quote(self.remote_path)))
+
+    async def transfer(self, host):
+        """transfer the file to 'host' from the next free source, returning its 'Delivery'."""
+        if not self.fanout:
+            await self.upload(host)
+            await self.install(host)
+            return Delivery('uploaded', None)
+        source = await self.sources.get()
+        if source is not None:
+            try:
+                await self.relay(source, host)
+                await self.install(host)
+            except Exception: # pylint: disable=W0703
+                # peer transfers are best-effort: retire the source & upload instead
+                pass
+            else:
+                self.sources.put_nowait(source)
+                return Delivery('relayed', source)
+        try:
+            await self.upload(host)
+            await self.install(host)
+            return Delivery('uploaded', None)
+        finally:
+            if source is None:
+                self.sources.put_nowait(source)
+
+    async def deliver(self, host):
+        """ensure 'host' holds the file, returning its 'Delivery'."""
+        if await remote_digest(host, self.remote_path) == self.digest:
+            delivery = Delivery('unchanged', None)
+        else:
+            await host.run("mkdir -p -- {}".format(
+                shlex.quote(path.dirname(self.remote_path) or '.')))
+            delivery = await self.transfer(host)
+        for _ in range(self.fanout):
+            self.sources.put_nowait(host.label)
+        return delivery
+
+def distribute(conf, local_path, remote_path, roles=None, hosts=None, concurrency=50,
+               fanout=0, timeout=None, transport=None, host_key_checking='yes', store=None):
+    """Ensure the hosts of 'roles'/'hosts' hold 'local_path' at 'remote_path'.
+
+    concurrency - max. number of hosts connected to at a time (by the operator)
+    fanout      - hosts served by each host holding the file, 0 to upload
+                  to every host from the operator (see module docs)
+    timeout     - time limit (seconds) of each host, None for no limit
+    transport   - 'aio.Transport' opening connections (see 'aio.execute')
+    host_key_checking - how serving hosts check host keys of unknown hosts (ssh's
+                  StrictHostKeyChecking): 'yes', 'accept-new' or 'no' (insecure)
+    store       - 'hoststore.HostStore' whose recorded host keys serving hosts
+                  accept (only), where known
+
+    Returns label => 'Delivery', hosts which failed map to the exception raised."""
+    if host_key_checking not in HOST_KEY_CHECKING:
+        raise ValueError("host_key_checking must be one of {}, got '{}'".format(
+            ", ".join(HOST_KEY_CHECKING), host_key_checking))
+    start = monotonic()
+    digest = file_digest(local_path)
+    instrument.record('distribute.hash', start, monotonic() - start, detail=local_path)
+    transport = transport or aio.AsyncSSHTransport(known_hosts=aio.known_hosts_files(conf, store))
+    rollout = {}
+    async def deliver(host):
+        # created within the event loop, which its queue is bound to
+        if 'state' not in rollout:
+            rollout['state'] = _Rollout(
+                conf, local_path, remote_path, digest, transport, fanout,
+                host_key_checking, store)
+        return await rollout['state'].deliver(host)
+    deliver.__name__ = 'distribute'
+    return aio.execute(
+        conf, deliver, hosts=hosts, roles=roles, concurrency=concurrency, timeout=timeout,
+        transport=transport)
@@ -2,11 +2,21 @@
 Compatibility patches for fabric(3)
 """
 # pylint: disable=W0611,C0103,W0212
+import sys
+from os import path
+from collections import namedtuple
 from functools import wraps
 
 import fabric
 import fabric.tasks
+import fabric.task_utils
 import fabric.decorators
+import fabric.utils
+import fabric.state
+import fabric.operations
+import fabric.context_managers
+import fabric.sftp
+import fabric.network
 
 from voluptuous.error import Invalid
 from funcy.colls import get_in
@@ -16,11 +26,24 @@ from prefab.core.config import confparse as cp
 from prefab.utils.decorators import run_once
 from .config import schemas as scc
 from .config import confparse as cp
+from .config.parse import ParsedConfig
+from .config.records import json_default
+from .config.cache import cache_dir
+from .fabenv import (
+    LazyRoledefs, LazyPasswords, ssh_settings, _compile_roledefs, _compile_passwords)
+from .config import diff
+from . import scheduler
+from . import hoststore
+from . import instrument
+from . import batching
+from . import facts
+from .connpool import ConnectionPool
 
 # references to the functions we'll wrap
 __fabric__execute = fabric.tasks._execute
 __fabric_execute = fabric.tasks.execute
 __fabric_hosts = fabric.decorators.hosts
+__fabric_run_command = fabric.operations._run_command
 
 # Wrap fabric.decorators.hosts
 # ---
@@ -53,7 +76,6 @@ def __hosts(*args):
 
 def _init_wrap_fns():
     """wrap fabric functions as necessary for integration."""
-    print("init wrap fns run")
     # wrap fabric's execute() function
     _wrap_execute.__doc__ = fabric.tasks.execute
     fabric.tasks.execute = _wrap_execute
@@ -67,6 +89,21 @@ def _init_wrap_fns():
     __hosts.__doc__ = __fabric_hosts
     fabric.decorators.hosts = __hosts
 
+    # time each remote command (run(), sudo()) run
+    fabric.operations._run_command = _wrap_run_command
+
+    # replace fabric's connection cache with a pool keyed by host label,
+    # modules importing 'connections' by name must be patched individually
+    pool = ConnectionPool(key_fn=_pool_key, store_fn=_host_store, breaker_fn=_breaker,
+                          max_connections_fn=_max_connections)
+    for module in (fabric.state, fabric.operations, fabric.context_managers, fabric.sftp):
+        module.connections = pool
+
+    # close pooled connections as they are, fabric's disconnect_all()
+    # would health-check (reconnecting dead ones) before closing them
+    for module in (fabric.network, fabric.tasks):
+        module.disconnect_all = _disconnect_all
+
 def _init_enrich_fab_env(conf):
     """enrich fabric environment object.
 
@@ -76,9 +113,10 @@ def _init_enrich_fab_env(conf):
     # install refernce to configuration data structure
     # other functions in this compatibility layer relies on its presence
     fabric.api.env['__prefab_conf'] = conf
-
-    fabric.api.env.roledefs = _compile_roledefs(conf)
-    fabric.api.env.passwords = _compile_passwords(conf)
+    # roles & passwords are compiled on first use, tasks targeting a
+    # single role only resolve the hosts of that role
+    fabric.api.env.roledefs = LazyRoledefs(conf)
+    fabric.api.env.passwords = LazyPasswords(conf)
 
 @run_once()
 def initialize(conf):
@@ -92,22 +130,107 @@ def initialize(conf):
           would break break initialization - leaving the config reference
           undefined afterwards.
     """
-    print("init run")
-    try:
-        scc.config(conf)
-    except Invalid as exc:
-        msg = "'conf' configuration object is not valid - aborting initialization"
-        import json
-        print(json.dumps(conf, indent=2, sort_keys=True))
-        sc.explain(scc.config, conf)
-        raise ValueError(msg) from exc
-    #_init_wrap_fns(fabric)
-    _init_enrich_fab_env(conf)
+    with instrument.span('initialize'):
+        try:
+            # configs produced by parse_config are already validated
+            if not isinstance(conf, ParsedConfig):
+                scc.config_validator(conf)
+        except Invalid as exc:
+            msg = "'conf' configuration object is not valid - aborting initialization"
+            import json
+            print(json.dumps(conf, indent=2, sort_keys=True, default=json_default))
+            sc.explain(scc.config, conf)
+            raise ValueError(msg) from exc
+        #_init_wrap_fns(fabric)
+        _init_enrich_fab_env(conf)
 
 
+def reload(conf, changes=None):
+    """Switch to the (re-parsed) configuration 'conf', patching fabric's env in place.
+
+    Only state derived from the entries which changed is invalidated: the
+    roledefs of affected roles, the passwords & pooled connections of changed
+    or removed hosts. Everything else (e.g. passwords entered at a prompt,
+    connections to unchanged hosts) is retained.
+
+    changes - 'ConfigDiff' between the current config & 'conf' (as returned by
+              'reload_config'), computed if not given.
+
+    NOTE: hosts already resolved by the @hosts decorator are not updated.
+    """
+    old_conf = _conf()
+    if changes is None:
+        changes = diff.diff_configs(old_conf, conf)
+    stale_hosts = changes.hosts.removed | changes.hosts.changed
+    old_index = cp.host_index(old_conf)
+    stale_roles = changes.roles.touched | {
+        role for label in stale_hosts for role in old_index.roles.get(label, ())}
+    stale_host_strings = [
+        old_index.host_strings[label] for label in stale_hosts
+        if label in old_index.host_strings]
+
+    fabric.api.env['__prefab_conf'] = conf
+    roledefs, passwords = fabric.api.env.roledefs, fabric.api.env.passwords
+    if isinstance(roledefs, LazyRoledefs):
+        roledefs.rebind(conf, stale_roles)
+    else:
+        fabric.api.env.roledefs = LazyRoledefs(conf)
+    if isinstance(passwords, LazyPasswords):
+        passwords.rebind(conf, stale_host_strings)
+    else:
+        fabric.api.env.passwords = LazyPasswords(conf)
+    pool = fabric.state.connections
+    if isinstance(pool, ConnectionPool):
+        for label in stale_hosts:
+            pool.discard(label)
+    cp.discard_host_index(old_conf)
+    return changes
+
 def _host_str_to_label(host_str):
     return cp.host_label(_conf(), host_str)
 
+def _pool_key(host_str):
+    """connection pool key of host_str: its host label, None if not a (single) known host."""
+    conf = fabric.api.env.get('__prefab_conf')
+    if conf is None:
+        return None
+    try:
+        return cp.host_label(conf, host_str)
+    except AssertionError:
+        return None
+
+def _host_store():
+    """host store recording connections ('env.prefab_host_store'), None if disabled.
+
+    On first use, the host keys known to the store are exported for fabric
+    to verify hosts against ('env.system_known_hosts', unless set)."""
+    env = fabric.api.env
+    store = env.get('prefab_host_store')
+    if store is not None and not env.get('prefab_known_hosts'):
+        known_hosts = path.join(cache_dir(), 'known_hosts')
+        env['prefab_known_hosts'] = known_hosts
+        if not env.get('system_known_hosts') and store.write_known_hosts(_conf(), known_hosts):
+            env['system_known_hosts'] = known_hosts
+    return store
+
+def _max_connections():
+    """max. number of pooled connections ('env.prefab_max_connections'), None if unbounded."""
+    return fabric.api.env.get('prefab_max_connections')
+
+def _disconnect_all():
+    """fabric's disconnect_all(), closing pooled connections without reconnecting dead ones."""
+    pool = fabric.state.connections
+    for key in list(pool.keys()):
+        if fabric.state.output.status:
+            sys.stdout.write("Disconnecting from {}... ".format(key))
+        pool.discard(key)
+        if fabric.state.output.status:
+            sys.stdout.write("done.\n")
+
+def _breaker():
+    """circuit breaker settings ('env.prefab_breaker'), None if hosts are never skipped."""
+    return fabric.api.env.get('prefab_breaker')
+
 def __config_ssh_env(host_str):
     """derive the env settings necessary to connect to host.
 
@@ -115,23 +238,23 @@ def __config_ssh_env(host_str):
     set given the host_entry's specification of the login method
     (password, key)."""
     label = cp.host_label(_conf(), host_str)
-    host_entry = cp.host_entry(_conf(), label)
-    method = host_entry.get('method', None)
-    if method not in ('password', 'key'):
-        raise Exception((
-            "Expected a password/key method for host, '{}'"
-            + "(label: '{}'), got method: '{}'").format(host_str, label, method))
-    if host_entry['method'] == 'password':
-        return {'no_agent': True, 'no_keys': True}
-    else: # key login
-        return {'no_agent': False, 'key_filename': None, 'keys': host_entry['keys']}
+    with instrument.span('ssh_env', host=label):
+        host_entry = cp.host_entry(_conf(), label)
+        settings = ssh_settings(host_entry)
+        if settings is None:
+            raise Exception((
+                "Expected a password/key method for host, '{}'"
+                + "(label: '{}'), got method: '{}'").format(
+                    host_str, label, host_entry.get('method', None)))
+        return settings
 
 def __resolve_hosts(*args):
     """resolves one/more hosts into their corresponding host_strings."""
     host_list = __coerce_to_iterable(args)
-    return [
-        cp.host_string(cp.host_entry(_conf(), label))
-        for label in host_list]
+    with instrument.span('resolve_hosts'):
+        return [
+            cp.host_string(cp.host_entry(_conf(), label))
+            for label in host_list]
 
 # wraps fabric's _execute function
 # ---
@@ -139,23 +262,49 @@ def __resolve_hosts(*args):
 # examines the corresponding host entry, and determines if this is a ssh
 # key- or password-based login, tweaking the fabric environment accordingly.
 def _wrap__execute(*args, **kwargs):
-    print("(wrapped) _execute")
     # https://github.com/mathiasertl/fabric/blob/master/fabric/tasks.py
     host_str = args[1] # host_string, as seen in source
-    # NOTE: not using 'clean_revert=True' (see link) to allow user-level overriding
-    # http://docs.fabfile.org/en/1.14/api/core/context_managers.html#fabric.context_managers.settings
-    with fabric.context_managers.settings(**__config_ssh_env(host_str)):
-        return __fabric__execute(*args, **kwargs)
+    my_env = args[2]
+    with instrument.span('execute', host=_pool_key(host_str), detail=my_env.get('command')):
+        # NOTE: not using 'clean_revert=True' (see link) to allow user-level overriding
+        # http://docs.fabfile.org/en/1.14/api/core/context_managers.html#fabric.context_managers.settings
+        with fabric.context_managers.settings(**__config_ssh_env(host_str)):
+            return __fabric__execute(*args, **kwargs)
 
-# wraps fabric's execute function
-# ---
-# 1) resolves host_list from host labels (as used in the configuration file)
-#    to host_strings, which fabric expects
-# 2) execute() yields a map of responses, encoded as
-#    host_string => return-value pairs.
-#    We translate the host_strings back into host labels
-def _wrap_execute(fn, *args, **kwargs):
-    print("(wrapped) execute")
+def _wrap_run_command(command, *args, **kwargs):
+    """fabric's _run_command (backing run() & sudo()), timing each command run.
+
+    Calls within a 'batching.batch()' block are queued instead."""
+    queued = batching.queue(__fabric_run_command, command, args, kwargs)
+    if queued is not None:
+        return queued
+    host = _pool_key(fabric.api.env.host_string) if fabric.api.env.host_string else None
+    with instrument.span('command', host=host, detail=command):
+        return __fabric_run_command(command, *args, **kwargs)
+
+def rolling(batch, max_failures=0, pause=0, order='label'):
+    """Decorator running the task across its hosts in batches, e.g. @rolling('25%').
+
+    batch        - hosts per batch, a count or a percentage of the task's hosts
+    max_failures - failed hosts tolerated (count or percentage) before the
+                   remaining batches are skipped
+    pause        - time (seconds) to wait between batches
+    order        - 'label' to run hosts ordered by their label, None to keep
+                   the order of the roles/hosts
+
+    Hosts of a batch run in parallel (capped by 'env.prefab_parallel', if set).
+    Rolling settings in fabric's env ('prefab_rolling', e.g. from the
+    command-line) take precedence. Use alongside @roles/@hosts."""
+    settings = scheduler.rolling_settings(batch, max_failures, pause, order)
+    def decorator(fn):
+        fn.rolling = settings
+        return fn
+    return decorator
+
+def __prepare_task(fn, kwargs):
+    """resolve host labels given to execute(), and those of the task's @hosts decorator.
+
+    NOTE: modifies 'kwargs' in-place."""
     host_list = kwargs.pop('hosts', None)
     if host_list:
         kwargs['hosts'] = __resolve_hosts(host_list)
@@ -175,13 +324,212 @@ def _wrap_execute(fn, *args, **kwargs):
     except AttributeError:
         pass
 
-    results = __fabric_execute(fn, *args, **kwargs)
+# wraps fabric's execute function
+# ---
+# 1) resolves host_list from host labels (as used in the configuration file)
+#    to host_strings, which fabric expects
+# 2) execute() yields a map of responses, encoded as
+#    host_string => return-value pairs.
+#    We translate the host_strings back into host labels
+def _wrap_execute(fn, *args, **kwargs):
+    with instrument.span('task', detail=getattr(fn, 'name', getattr(fn, '__name__', fn))):
+        __prepare_task(fn, kwargs)
+        results = __execute(fn, args, kwargs)
     # (host_string => return-value) pairs to (host_label => return-value)
     return {
         cp.host_label(_conf(), k): v
         for (k, v) in results.items()
     }
 
+def execute_iter(task, *args, **kwargs):
+    """Execute task like execute(), yielding a result per host as soon as it completes.
+
+    Yields 'HostResult' tuples of (label, result, duration, error, output), where
+    'error' is the exception raised on the host (None on success) and 'output'
+    is the output buffered while running on the host (None for hosts run in
+    turn, whose output is streamed as fabric does).
+
+    Unlike execute(), failing hosts do not abort the remaining hosts - it is
+    up to the caller to react to errors. Hosts run in parallel if configured
+    (see '_parallel_settings'), in batches if rolling (see 'rolling'), in turn
+    otherwise. Hosts skipped by the host store (see '__consult_store') are
+    yielded first. Each host's output is printed
+    as a block, each line prefixed by the host label, once the host completes
+    (disable by setting 'env.prefab_echo_output' to False).
+
+    NOTE: only callables/task objects are supported, not task names.
+          Tasks without any hosts yield nothing.
+    """
+    __prepare_task(task, kwargs)
+    plan = __plan(task, args, kwargs)
+    if not plan.hosts:
+        return
+    plan, unavailable = __consult_store(plan)
+    for (host_str, error) in unavailable.items():
+        yield scheduler.HostResult(_host_str_to_label(host_str), None, 0, error, None)
+    for res in __run_hosts(plan):
+        label = _host_str_to_label(res.host)
+        if res.output and fabric.api.env.get('prefab_echo_output', True):
+            _echo_output(label, res.output)
+        yield res._replace(host=label)
+
+def _echo_output(label, output):
+    """print the output of a host, each line prefixed by its label."""
+    prefix = "[{}] ".format(label)
+    sys.stdout.write("".join(prefix + line for line in output.splitlines(True)))
+    if not output.endswith("\n"):
+        sys.stdout.write("\n")
+    sys.stdout.flush()
+
+def _parallel_settings(roles):
+    """Determine the (pool_size, timeout) of a task running across 'roles'.
+
+    Settings in fabric's env ('prefab_parallel', 'prefab_timeout', e.g. from
+    the command-line) take precedence, otherwise the most restrictive of the
+    'parallel' and 'timeout' settings of the roles apply.
+
+    A pool size of None means the task should not be run in parallel."""
+    env = fabric.api.env
+    role_entries = [get_in(_conf(), ['roles', role], {}) for role in roles]
+    def setting(key, env_key):
+        """resolve setting from env, falling back to role settings."""
+        if env.get(env_key):
+            return env[env_key]
+        values = [entry[key] for entry in role_entries if entry.get(key)]
+        return min(values) if values else None
+    return setting('parallel', 'prefab_parallel'), setting('timeout', 'prefab_timeout')
+
+# How to run a task
+#
+# task       - fabric Task object
+# args       - positional arguments for the task
+# kwargs     - keyword arguments for the task (host/role selection stripped)
+# hosts      - host_strings to run the task on
+# env        - env settings for running the task (as used by fabric's _execute)
+# pool_size  - max. hosts to run on concurrently (None => serially)
+# timeout    - time budget (seconds) per host (None => unbounded)
+# rolling    - 'scheduler.Rolling' settings to run hosts in batches (None => all at once)
+TaskPlan = namedtuple(
+    'TaskPlan', ['task', 'args', 'kwargs', 'hosts', 'env', 'pool_size', 'timeout', 'rolling'])
+
+def __plan(task, args, kwargs):
+    """Resolve the hosts, roles & parallel settings of running 'task'."""
+    if fabric.tasks._is_task(task):
+        task_obj = task
+        command = task.name
+    else:
+        task_obj = fabric.tasks.WrappedCallableTask(task)
+        command = getattr(task, 'name', getattr(task, '__name__', None))
+    new_kwargs, hosts, roles, exclude_hosts = fabric.task_utils.parse_kwargs(kwargs)
+    all_hosts, effective_roles = task_obj.get_hosts_and_effective_roles(
+        hosts, roles, exclude_hosts, fabric.api.env)
+    pool_size, timeout = _parallel_settings(effective_roles)
+    rolling = fabric.api.env.get('prefab_rolling') or getattr(task_obj, 'rolling', None)
+    my_env = {
+        'clean_revert': True,
+        'command': command,
+        'all_hosts': all_hosts,
+        'effective_roles': effective_roles
+    }
+    return TaskPlan(task_obj, args, new_kwargs, all_hosts, my_env, pool_size, timeout, rolling)
+
+def __run_hosts(plan):
+    """Run the planned task, yielding a 'HostResult' (keyed by host_string) per host.
+
+    Output of hosts run in parallel (or rolling) is captured. Hosts run in
+    turn run in this process & stream their output as fabric does, such
+    that prompts (e.g. for passwords, by 'prompt()' or sudo) reach the user."""
+    def run_host(host_str):
+        """run task against a single host."""
+        return _wrap__execute(
+            plan.task, host_str, plan.env, plan.args, plan.kwargs, None, None, None)
+
+    if not (plan.pool_size or plan.rolling):
+        return scheduler.run_serial(run_host, plan.hosts)
+
+    def run_worker(host_str):
+        """(in worker process) run task against a single host."""
+        # connections inherited from the parent must not be shared
+        fabric.state.connections.clear()
+        with fabric.context_managers.settings(parallel=True, linewise=True):
+            try:
+                return run_host(host_str)
+            finally:
+                # forked workers exit without running atexit handlers
+                facts.cache.flush()
+    if not plan.rolling:
+        return scheduler.run(run_worker, plan.hosts, plan.pool_size, plan.timeout, capture=True)
+
+    hosts = plan.hosts
+    if plan.rolling.order == 'label':
+        hosts = sorted(
+            hosts, key=lambda host_str: scheduler.natural_key(_pool_key(host_str) or host_str))
+    batch_size = scheduler.batch_size(plan.rolling.batch, len(hosts))
+    pool_size = min(batch_size, plan.pool_size or batch_size)
+    def run_batch(batch):
+        """run the task against a batch of hosts in parallel."""
+        return scheduler.run(run_worker, batch, pool_size, plan.timeout, capture=True)
+    return scheduler.run_rolling(
+        run_batch, hosts, batch_size, scheduler.amount(plan.rolling.max_failures, len(hosts)),
+        plan.rolling.pause)
+
+def __consult_store(plan):
+    """Order the planned hosts fastest first & set aside those whose circuit is open.
+
+    Returns the plan of the remaining hosts & host_string => 'HostUnavailableError'
+    of the hosts set aside. Hosts of rolling runs keep their order."""
+    store = _host_store()
+    if store is None:
+        return plan, {}
+    labels = {host_str: _pool_key(host_str) for host_str in plan.hosts}
+    refused = store.unavailable([label for label in labels.values() if label], _breaker())
+    hosts = [host_str for host_str in plan.hosts if labels[host_str] not in refused]
+    if not plan.rolling:
+        hosts = store.order(hosts, key=lambda host_str: labels[host_str] or host_str)
+    return plan._replace(hosts=hosts), {
+        host_str: refused[labels[host_str]]
+        for host_str in plan.hosts if labels[host_str] in refused}
+
+def __execute(task, args, kwargs):
+    """Run task using prefab's scheduler if parallel or rolling, fabric's execute otherwise.
+
+    Returns a dictionary of host_string => return-value pairs. Hosts failing
+    (or timing out) map to the raised exception. If any host failed, fabric's
+    'error' is invoked (aborting unless 'env.warn_only' is set). Hosts whose
+    circuit is open (see 'hoststore') are skipped with a warning."""
+    if not (callable(task) or fabric.tasks._is_task(task)):
+        # task names are resolved by fabric
+        return __fabric_execute(task, *args, **kwargs)
+    plan = __plan(task, args, dict(kwargs))
+    if not ((plan.pool_size or plan.rolling) and plan.hosts):
+        return __fabric_execute(task, *args, **kwargs)
+
+    plan, unavailable = __consult_store(plan)
+    results, failed, skipped = dict(unavailable), [], []
+    if unavailable:
+        fabric.utils.warn("Skipping hosts known to be unreachable: {}".format(
+            ", ".join(sorted(err.label for err in unavailable.values()))))
+    for res in __run_hosts(plan):
+        label = _host_str_to_label(res.host)
+        if res.output:
+            _echo_output(label, res.output)
+        if isinstance(res.error, scheduler.BatchAbortedError):
+            skipped.append(label)
+            results[res.host] = res.error
+        elif res.error is not None:
+            failed.append(label)
+            results[res.host] = res.error
+        else:
+            results[res.host] = res.result
+    if failed:
+        msg = "One or more hosts failed while executing task '{}': {}".format(
+            plan.env['command'], ", ".join(sorted(failed)))
+        if skipped:
+            msg += "\nRemaining batches were skipped, hosts not run: {}".format(
+                ", ".join(sorted(skipped)))
+        fabric.utils.error(msg)
+    return results
+
 def _conf():
     """retrieve the conf."""
     return fabric.api.env['__prefab_conf']
@@ -192,38 +540,3 @@ def __coerce_to_iterable(args):
             and not isinstance(args[0], str)):
         return args[0]
     return args
-
-def _compile_roledefs(conf):
-    """Compile roledefs entry describing roles in fabric.
-
-    NOTE: install into 'env.roledefs'."""
-    def compile_role_entry(role_entry):
-        """creates a roledef entry in fabric's format.
-
-        Resolves the referenced host labels into actual host_strings (fabric)
-        and merges in the environment values.
-        """
-        return {
-            **role_entry.get('env', {}),
-            'hosts': [
-                cp.host_string(get_in(conf, ['hosts', label]))
-                for label in role_entry['hosts']]
-        }
-    return {
-        role: compile_role_entry(role_entry) for (role, role_entry) in conf['roles'].items()
-    }
-
-def _compile_passwords(conf):
-    """Compile dictionary of pre-filled host_string => password mappings.
-
-    Fabric allows passwords to be filled out ahead of time, but will prompt
-    for missing entries, expanding this dictionary as execution progresses.
-
-    NOTE: to be installed into 'env.passwords'.
-    """
-    return {
-        cp.host_string(host_entry): host_entry['password']
-        for (host_label, host_entry)
-        in conf['hosts'].items()
-        if host_entry['method'] == 'password' and host_entry.get('password')
-    }
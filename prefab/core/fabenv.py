@@ -0,0 +1,192 @@
+"""
+Fabric env structures (env.roledefs, env.passwords) derived from the configuration.
+
+Kept apart from 'fabcompat' such that they can be computed (e.g. by the
+'debug' command) without importing fabric.
+"""
+from .config import confparse as cp
+
+def _compile_role_entry(conf, role):
+    """creates a roledef entry in fabric's format.
+
+    Resolves the referenced host labels into actual host_strings (fabric)
+    and merges in the environment values.
+    """
+    return {
+        **conf['roles'][role].get('env', {}),
+        'hosts': cp.role_host_strings(conf, role)
+    }
+
+def _compile_roledefs(conf):
+    """Compile roledefs entry describing roles in fabric.
+
+    NOTE: install into 'env.roledefs'."""
+    return {role: _compile_role_entry(conf, role) for role in conf['roles']}
+
+def _host_password(host_entry):
+    """pre-filled password of the host entry, None if it has none."""
+    if host_entry['method'] == 'password':
+        return host_entry.get('password') or None
+    return None
+
+def ssh_settings(host_entry):
+    """fabric env settings for logging into the host of 'host_entry'.
+
+    Password logins disable the SSH agent & key lookup, key logins use the
+    entry's key files. Returns None if the entry specifies no known method."""
+    method = host_entry.get('method', None)
+    if method == 'password':
+        return {'no_agent': True, 'no_keys': True}
+    if method == 'key':
+        return {'no_agent': False, 'key_filename': None, 'keys': host_entry['keys']}
+    return None
+
+def _compile_passwords(conf):
+    """Compile dictionary of pre-filled host_string => password mappings.
+
+    Fabric allows passwords to be filled out ahead of time, but will prompt
+    for missing entries, expanding this dictionary as execution progresses.
+
+    NOTE: to be installed into 'env.passwords'.
+    """
+    return {
+        cp.host_string(host_entry): _host_password(host_entry)
+        for (host_label, host_entry)
+        in conf['hosts'].items()
+        if _host_password(host_entry)
+    }
+
+class LazyRoledefs(dict):
+    """Roledefs ('env.roledefs') compiling each role of 'conf' on first access.
+
+    Behaves like the dict produced by '_compile_roledefs', entries set
+    explicitly (e.g. by fabric's @roles decorator) take precedence."""
+    def __init__(self, conf):
+        super().__init__()
+        self._conf = conf
+
+    def __missing__(self, role):
+        if role not in self._conf['roles']:
+            raise KeyError(role)
+        entry = _compile_role_entry(self._conf, role)
+        dict.__setitem__(self, role, entry)
+        return entry
+
+    def __contains__(self, role):
+        return dict.__contains__(self, role) or role in self._conf['roles']
+
+    def __iter__(self):
+        yield from dict.__iter__(self)
+        for role in self._conf['roles']:
+            if not dict.__contains__(self, role):
+                yield role
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, role, default=None):
+        return self[role] if role in self else default
+
+    def rebind(self, conf, roles):
+        """Switch to 'conf', recompiling the entries of 'roles' on next access."""
+        self._conf = conf
+        for role in roles:
+            dict.pop(self, role, None)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(role, self[role]) for role in self]
+
+    def values(self):
+        return [self[role] for role in self]
+
+class LazyPasswords(dict):
+    """Passwords ('env.passwords') looking up each host's password on first access.
+
+    Fabric only ever queries the password of the host it connects to, so
+    single lookups resolve just that host. Iterating the mapping compiles
+    the passwords of all hosts (see '_compile_passwords')."""
+    def __init__(self, conf):
+        super().__init__()
+        self._conf = conf
+        self._complete = False
+
+    def _lookup(self, host_str):
+        """password of host_str as given by the configuration, None if unknown."""
+        try:
+            label = cp.host_label(self._conf, host_str)
+        except AssertionError:
+            return None
+        return _host_password(self._conf['hosts'][label])
+
+    def rebind(self, conf, host_strings):
+        """Switch to 'conf', looking up the passwords of 'host_strings' anew."""
+        self._conf = conf
+        self._complete = False
+        for host_str in host_strings:
+            dict.pop(self, host_str, None)
+
+    def _force(self):
+        """add the passwords of all hosts, keeping entries already set."""
+        if not self._complete:
+            for (host_str, password) in _compile_passwords(self._conf).items():
+                self.setdefault(host_str, password)
+            self._complete = True
+
+    def __missing__(self, host_str):
+        password = self._lookup(host_str)
+        if password is None:
+            raise KeyError(host_str)
+        dict.__setitem__(self, host_str, password)
+        return password
+
+    def __contains__(self, host_str):
+        return self.get(host_str) is not None
+
+    def get(self, host_str, default=None):
+        try:
+            return self[host_str]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        self._force()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._force()
+        return dict.__len__(self)
+
+    def __eq__(self, other):
+        self._force()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._force()
+        return dict.__repr__(self)
+
+    def keys(self):
+        self._force()
+        return dict.keys(self)
+
+    def items(self):
+        self._force()
+        return dict.items(self)
+
+    def values(self):
+        self._force()
+        return dict.values(self)
@@ -0,0 +1,234 @@
+"""
+Cache of facts gathered from hosts.
+
+Read-only inventory queries (e.g. running 'cat /etc/issue') yield the same
+result run after run. Tasks decorated with '@cached_fact(ttl=...)' are
+answered from a cache keyed by (host label, fact) while the cached result
+is younger than 'ttl' - hosts are only contacted on a miss. Facts are
+named after their task & a digest of its source, such that editing a fact
+invalidates its cached results.
+
+Facts are stored in a SQLite database in prefab's cache directory, which is
+shared by all processes - including the forked workers running tasks in
+parallel. Beyond 'max_entries', the least recently used facts are evicted.
+Lookups do not write to the database: the times facts were last used are
+collected & written in one go, when facts are stored, when workers complete
+and on exit.
+
+NOTE: only JSON-serializable results are cached. Strings (e.g. the output
+      returned by run()) are cached as plain strings, attributes such as
+      'return_code' are not retained. Failed commands are never cached.
+"""
+import os
+import json
+import atexit
+import hashlib
+import inspect
+import sqlite3
+from os import path
+from functools import wraps
+from time import time, monotonic
+import fabric.api
+from .config import confparse as cp
+from .config.cache import cache_dir
+from . import instrument
+
+MAX_ENTRIES = 10000
+
+# max. number of uses of facts collected before they are written
+MAX_PENDING_USES = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS facts (
+    label TEXT NOT NULL,
+    command TEXT NOT NULL,
+    value TEXT NOT NULL,
+    stored REAL NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (label, command)
+);
+CREATE INDEX IF NOT EXISTS facts_used ON facts (used);
+"""
+
+class FactCache:
+    """Persistent (host label, command) => value cache, evicting the least recently used entries.
+
+    db_path     - path of the SQLite database, defaults to 'facts.sqlite' in the cache directory
+    max_entries - max. number of facts kept
+
+    Failing to open or use the database is not an error, lookups miss and
+    results are not stored - the cache is merely an optimization."""
+    def __init__(self, db_path=None, max_entries=MAX_ENTRIES):
+        self.db_path = db_path or path.join(cache_dir(), 'facts.sqlite')
+        self.max_entries = max_entries
+        self._db = None
+        self._pid = None
+        # (label, command) => time of use, not yet written
+        self._used = {}
+
+    def _conn(self):
+        """connection to the database, opened once per process (None if it cannot be opened)."""
+        if self._pid != os.getpid():
+            # connections must not be shared with forked processes, uses
+            # pending in the parent are the parent's to write
+            self._db, self._pid, self._used = None, os.getpid(), {}
+            try:
+                os.makedirs(path.dirname(self.db_path) or '.', exist_ok=True)
+                db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+                db.executescript(_SCHEMA)
+                self._db = db
+            except (OSError, sqlite3.Error):
+                pass
+        return self._db
+
+    def _write_uses(self, db):
+        """write the pending uses of facts (within the caller's transaction)."""
+        used, self._used = self._used, {}
+        db.executemany(
+            "UPDATE facts SET used = ? WHERE label = ? AND command = ? AND used < ?",
+            [(now, label, command, now) for ((label, command), now) in used.items()])
+
+    def flush(self):
+        """Write the pending uses of facts, recording them as recently used."""
+        db = self._conn()
+        if db is None or not self._used:
+            return
+        try:
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                self._write_uses(db)
+        except sqlite3.Error:
+            pass
+
+    def get(self, label, command, ttl=None, default=None):
+        """Retrieve the fact 'command' of host 'label', 'default' if missing or older than 'ttl' seconds."""
+        db = self._conn()
+        if db is None:
+            return default
+        now = time()
+        try:
+            row = db.execute(
+                "SELECT value, stored FROM facts WHERE label = ? AND command = ?",
+                (label, command)).fetchone()
+            if row is None or (ttl is not None and row[1] + ttl <= now):
+                return default
+        except sqlite3.Error:
+            return default
+        self._used[(label, command)] = now
+        if len(self._used) >= MAX_PENDING_USES:
+            self.flush()
+        return json.loads(row[0])
+
+    def put(self, label, command, value):
+        """Store the fact 'command' of host 'label', evicting the least recently used facts as needed.
+
+        Returns True iff the fact was stored (i.e. 'value' is JSON-serializable)."""
+        db = self._conn()
+        if db is None:
+            return False
+        try:
+            data = json.dumps(value)
+        except (TypeError, ValueError):
+            return False
+        now = time()
+        try:
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                # uses count towards eviction
+                self._write_uses(db)
+                db.execute(
+                    "INSERT OR REPLACE INTO facts (label, command, value, stored, used) "
+                    "VALUES (?, ?, ?, ?, ?)", (label, command, data, now, now))
+                db.execute(
+                    "DELETE FROM facts WHERE rowid IN "
+                    "(SELECT rowid FROM facts ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+        except sqlite3.Error:
+            return False
+        return True
+
+    def invalidate(self, label=None, command=None):
+        """Forget the facts of host 'label' and/or of 'command' (all facts if neither is given)."""
+        db = self._conn()
+        if db is None:
+            return
+        clauses = [(col, val) for (col, val) in (('label', label), ('command', command))
+                   if val is not None]
+        where = " AND ".join("{} = ?".format(col) for (col, _) in clauses) or "1"
+        try:
+            db.execute("DELETE FROM facts WHERE " + where, [val for (_, val) in clauses])
+        except sqlite3.Error:
+            pass
+
+    def __len__(self):
+        db = self._conn()
+        if db is None:
+            return 0
+        try:
+            return db.execute("SELECT COUNT(*) FROM facts").fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+# cache consulted by '@cached_fact'
+cache = FactCache()
+atexit.register(lambda: cache.flush())
+
+_MISSING = object()
+
+def _host_label(host_str):
+    """label of the host 'host_str' refers to, the host string itself if not a (single) known host."""
+    conf = fabric.api.env.get('__prefab_conf')
+    if conf is None:
+        return host_str
+    try:
+        return cp.host_label(conf, host_str)
+    except AssertionError:
+        return host_str
+
+def _source_digest(fn):
+    """digest of the source of 'fn' (of its code, if the source is unavailable)."""
+    try:
+        source = inspect.getsource(fn).encode('utf-8')
+    except (OSError, TypeError):
+        code = fn.__code__
+        source = code.co_code + repr([
+            const for const in code.co_consts if not inspect.iscode(const)]).encode('utf-8')
+    return hashlib.sha1(source).hexdigest()[:12]
+
+def cached_fact(ttl=None, key=None):
+    """Decorator answering the task from the fact cache, running it only if not cached (or stale).
+
+    ttl - max. age (seconds) of cached results, None => never stale
+    key - name of the fact, defaults to the task's module & name along with a
+          digest of its source (editing the task invalidates its results).
+          Tasks given the same key share results. Arguments the task is
+          called with are part of the key.
+
+    Results are cached per host. Setting 'env.prefab_refresh_facts' (e.g.
+    --refresh-facts) runs the task regardless, refreshing the cache.
+    Use alongside @roles/@hosts, beneath @task."""
+    def decorator(fn):
+        name = key or "{}.{}@{}".format(fn.__module__, fn.__qualname__, _source_digest(fn))
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            env = fabric.api.env
+            if not env.host_string:
+                # not running against a host, nothing to key the fact on
+                return fn(*args, **kwargs)
+            label = _host_label(env.host_string)
+            command = name
+            if args or kwargs:
+                command += json.dumps([args, kwargs], sort_keys=True, default=repr)
+            if not env.get('prefab_refresh_facts'):
+                start = monotonic()
+                value = cache.get(label, command, ttl, _MISSING)
+                if value is not _MISSING:
+                    instrument.record(
+                        'fact.hit', start, monotonic() - start, host=label, detail=command)
+                    return value
+            value = fn(*args, **kwargs)
+            if not getattr(value, 'failed', False):
+                cache.put(label, command, value)
+            return value
+        return wrapper
+    return decorator
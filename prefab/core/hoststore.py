@@ -0,0 +1,279 @@
+"""
+Store of what was learned about each host across runs.
+
+Per host label, a SQLite database in prefab's cache directory records the
+SSH host key, connect & authentication latencies (moving averages), the
+time of the last success & failure and the number of (consecutive)
+failures. It is shared by all processes, including forked workers.
+
+Executors use it to:
+
+- order hosts: fastest first, hosts which failed recently last
+- skip known-dead hosts: once a host failed 'threshold' times in a row, its
+  circuit is open - it is skipped without trying to connect until
+  'cooldown' seconds passed since its last failure. The next attempt then
+  either closes the circuit again (on success) or re-opens it.
+- verify host keys: keys seen before are exported as a known_hosts file,
+  such that changed host keys are refused rather than silently accepted.
+"""
+import os
+import sqlite3
+from os import path
+from collections import namedtuple
+from time import time
+from fabric.exceptions import NetworkError
+from .config import confparse as cp
+from .config.cache import cache_dir
+
+# weight of the latest observation in the latency moving averages
+LATENCY_WEIGHT = 0.3
+
+# max. number of parameters per query
+_BATCH = 500
+
+_SCHEMA = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS hosts (
+    label TEXT PRIMARY KEY,
+    key_host TEXT,
+    key_type TEXT,
+    key TEXT,
+    connect_latency REAL,
+    auth_latency REAL,
+    successes INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    total_failures INTEGER NOT NULL DEFAULT 0,
+    last_success REAL,
+    last_failure REAL
+);
+"""
+
+# What is known about a host
+#
+# label           - host label
+# key_host        - address the host key was presented at, in known_hosts
+#                   notation (see 'known_host_name', None if unknown)
+# key_type        - type of its SSH host key, e.g. 'ssh-ed25519' (None if unknown)
+# key             - base64-encoded SSH host key (None if unknown)
+# connect_latency - moving average of the time (seconds) to connect (None if unknown)
+# auth_latency    - moving average of the time (seconds) to log in (None if unknown)
+# successes       - number of successful connections
+# failures        - number of consecutive failures (0 after a success)
+# total_failures  - number of failures
+# last_success    - time (epoch) of the last success (None if never)
+# last_failure    - time (epoch) of the last failure (None if never)
+HostStats = namedtuple('HostStats', [
+    'label', 'key_host', 'key_type', 'key', 'connect_latency', 'auth_latency', 'successes',
+    'failures', 'total_failures', 'last_success', 'last_failure'])
+
+# Circuit breaker settings
+#
+# threshold - consecutive failures opening a host's circuit
+# cooldown  - time (seconds) after the last failure before a host is tried again
+Breaker = namedtuple('Breaker', ['threshold', 'cooldown'])
+
+DEFAULT_BREAKER = Breaker(threshold=3, cooldown=300)
+
+class HostUnavailableError(NetworkError):
+    """Raised (as a result) for hosts skipped because their circuit is open.
+
+    A NetworkError, such that fabric's serial execute() handles it as any
+    unreachable host (skipped given 'env.skip_bad_hosts', aborting otherwise)."""
+    def __init__(self, label, failures, retry_in):
+        super().__init__(
+            "host '{}' skipped after {} consecutive failures, retried in {:.0f}s".format(
+                label, failures, retry_in))
+        self.label = label
+        self.failures = failures
+        self.retry_in = retry_in
+
+def known_host_name(address, port):
+    """name of the host at 'address' & 'port' in known_hosts files."""
+    port = int(port)
+    return address if port == 22 else "[{}]:{}".format(address, port)
+
+def _average(old, new):
+    """moving average of 'old' updated with the observation 'new' (None => unchanged)."""
+    if new is None:
+        return old
+    if old is None:
+        return new
+    return old + LATENCY_WEIGHT * (new - old)
+
+def _success(connect, auth, host_key):
+    """changes recording a success (see 'HostStore.record_success')."""
+    changes = {
+        'connect_latency': lambda st: _average(st.connect_latency, connect),
+        'auth_latency': lambda st: _average(st.auth_latency, auth),
+        'successes': lambda st: st.successes + 1,
+        'failures': lambda st: 0,
+        'last_success': lambda st: time(),
+    }
+    if host_key is not None:
+        for (ndx, col) in enumerate(('key_host', 'key_type', 'key')):
+            changes[col] = lambda st, ndx=ndx: host_key[ndx]
+    return changes
+
+# changes recording a failure
+_FAILURE = {
+    'failures': lambda st: st.failures + 1,
+    'total_failures': lambda st: st.total_failures + 1,
+    'last_failure': lambda st: time(),
+}
+
+class HostStore:
+    """Persistent host label => 'HostStats' store.
+
+    db_path - path of the SQLite database, defaults to 'hosts.sqlite' in the cache directory
+
+    Failing to open or use the database is not an error, hosts are then
+    treated as unknown - the store is merely an optimization."""
+    def __init__(self, db_path=None):
+        self.db_path = db_path or path.join(cache_dir(), 'hosts.sqlite')
+        self._db = None
+        self._pid = None
+
+    def _conn(self):
+        """connection to the database, opened once per process (None if it cannot be opened)."""
+        if self._pid != os.getpid():
+            # connections must not be shared with forked processes
+            self._db, self._pid = None, os.getpid()
+            try:
+                os.makedirs(path.dirname(self.db_path) or '.', exist_ok=True)
+                db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+                db.executescript(_SCHEMA)
+                self._db = db
+            except (OSError, sqlite3.Error):
+                pass
+        return self._db
+
+    def _update(self, updates):
+        """apply 'updates', (label, column => fn(HostStats) => value) pairs, in one transaction."""
+        db = self._conn()
+        if db is None:
+            return
+        try:
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                for (label, changes) in updates:
+                    db.execute("INSERT OR IGNORE INTO hosts (label) VALUES (?)", (label,))
+                    stats = HostStats(*db.execute(
+                        "SELECT * FROM hosts WHERE label = ?", (label,)).fetchone())
+                    values = {col: fn(stats) for (col, fn) in changes.items()}
+                    db.execute("UPDATE hosts SET {} WHERE label = ?".format(
+                        ", ".join("{} = ?".format(col) for col in values)),
+                               list(values.values()) + [label])
+        except sqlite3.Error:
+            pass
+
+    def record_success(self, label, connect=None, auth=None, host_key=None):
+        """Record a successful connection to host 'label'.
+
+        connect  - time (seconds) it took to connect (None if not measured)
+        auth     - time (seconds) it took to log in (None if not measured)
+        host_key - (key host, key type, base64-encoded key) presented by the host, if
+                   known. Key host being its address (see 'known_host_name')"""
+        self._update([(label, _success(connect, auth, host_key))])
+
+    def record_failure(self, label):
+        """Record a failure to connect to (or log into) host 'label'."""
+        self._update([(label, _FAILURE)])
+
+    def record_many(self, outcomes):
+        """Record the (label, ok, connect, auth) outcomes of many hosts at once."""
+        self._update([
+            (label, _success(connect, auth, None) if ok else _FAILURE)
+            for (label, ok, connect, auth) in outcomes])
+
+    def stats(self, labels):
+        """label => 'HostStats' of those of 'labels' known to the store."""
+        db = self._conn()
+        if db is None:
+            return {}
+        labels = list(labels)
+        found = {}
+        try:
+            for ndx in range(0, len(labels), _BATCH):
+                batch = labels[ndx:ndx + _BATCH]
+                for row in db.execute("SELECT * FROM hosts WHERE label IN ({})".format(
+                        ", ".join("?" * len(batch))), batch):
+                    found[row[0]] = HostStats(*row)
+        except sqlite3.Error:
+            return {}
+        return found
+
+    def order(self, labels, key=None):
+        """'labels' ordered fastest first, hosts failing recently last.
+
+        Hosts with consecutive failures come last (fewest first), hosts of
+        unknown latency after those of known latency. 'key' maps each
+        element of 'labels' to its host label (e.g. for host strings)."""
+        labels = list(labels)
+        stats = self.stats({key(lbl) if key else lbl for lbl in labels})
+        def rank(lbl):
+            st = stats.get(key(lbl) if key else lbl)
+            if st is None:
+                return (0, 1, 0)
+            latency = st.connect_latency
+            return (st.failures, latency is None, latency or 0)
+        return sorted(labels, key=rank)
+
+    def unavailable(self, labels, breaker=DEFAULT_BREAKER, now=None):
+        """label => 'HostUnavailableError' of those of 'labels' whose circuit is open."""
+        if not breaker or not breaker.threshold:
+            return {}
+        now = time() if now is None else now
+        skipped = {}
+        for (label, st) in self.stats(labels).items():
+            if st.failures >= breaker.threshold and st.last_failure is not None:
+                retry_in = st.last_failure + breaker.cooldown - now
+                if retry_in > 0:
+                    skipped[label] = HostUnavailableError(label, st.failures, retry_in)
+        return skipped
+
+    def write_known_hosts(self, conf, fpath):
+        """Write the host keys of the hosts of 'conf' to 'fpath' (known_hosts format).
+
+        Keys presented at an address other than the host's current one are
+        omitted. Returns True iff any keys were written."""
+        stats = self.stats(conf.get('hosts', {}))
+        lines = []
+        for (label, st) in sorted(stats.items()):
+            if st.key is None:
+                continue
+            entry = cp.host_entry(conf, label)
+            host = known_host_name(entry['address'], entry['port'])
+            if host == st.key_host:
+                lines.append("{} {} {}\n".format(host, st.key_type, st.key))
+        if not lines:
+            return False
+        tmp_path = "{}.{}.tmp".format(fpath, os.getpid())
+        try:
+            os.makedirs(path.dirname(fpath) or '.', exist_ok=True)
+            with open(tmp_path, mode='w') as fp:
+                fp.writelines(lines)
+            os.replace(tmp_path, fpath)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def forget(self, label=None):
+        """Forget what is known about host 'label' (all hosts if None)."""
+        db = self._conn()
+        if db is None:
+            return
+        try:
+            if label is None:
+                db.execute("DELETE FROM hosts")
+            else:
+                db.execute("DELETE FROM hosts WHERE label = ?", (label,))
+        except sqlite3.Error:
+            pass
+
+# store used by the executors (when enabled, see 'env.prefab_host_store')
+store = HostStore()
@@ -0,0 +1,211 @@
+"""
+Timing instrumentation of prefab's phases (config loading, host resolution,
+connecting, running commands etc).
+
+Code wraps phases in 'span(phase, host)', which reports an 'Event' with
+monotonic timings to each subscribed hook. Without subscribers, spans cost
+next to nothing. Events raised in forked workers (see 'scheduler') are sent
+back to & replayed in the parent.
+
+'Recorder' is a hook collecting events into a summary table and a JSON
+trace (Chrome trace event format, viewable in chrome://tracing or Perfetto).
+"""
+import os
+import json
+from collections import namedtuple, OrderedDict
+from functools import wraps
+from time import monotonic
+
+# A timed phase
+#
+# phase    - name of the phase, e.g. 'connect'
+# host     - label of the host the phase concerns (None if not host-specific)
+# start    - time.monotonic() at the start of the phase
+# duration - duration (seconds)
+# error    - description of the exception which ended the phase (None on success)
+# detail   - further description, e.g. the command run (None if not applicable)
+# pid      - id of the process in which the phase ran
+Event = namedtuple('Event', ['phase', 'host', 'start', 'duration', 'error', 'detail', 'pid'])
+
+_hooks = []
+
+def subscribe(hook):
+    """Call 'hook(event)' for each event from now on."""
+    _hooks.append(hook)
+
+def unsubscribe(hook):
+    """Stop calling 'hook' for events."""
+    _hooks.remove(hook)
+
+def enabled():
+    """True iff any hooks are subscribed (i.e. events are recorded)."""
+    return bool(_hooks)
+
+def emit(event):
+    """Report 'event' to all hooks."""
+    for hook in list(_hooks):
+        hook(event)
+
+def record(phase, start, duration, host=None, error=None, detail=None):
+    """Report a phase timed by the caller."""
+    if _hooks:
+        emit(Event(phase, host, start, duration, error, detail, os.getpid()))
+
+def _describe(exc):
+    """short description of an exception."""
+    msg = str(exc)
+    return "{}: {}".format(type(exc).__name__, msg) if msg else type(exc).__name__
+
+class span:
+    """Context manager timing the enclosed block as 'phase', optionally of 'host'.
+
+    Exceptions raised within the block are recorded & re-raised."""
+    __slots__ = ('phase', 'host', 'detail', 'start')
+
+    def __init__(self, phase, host=None, detail=None):
+        self.phase = phase
+        self.host = host
+        self.detail = detail
+        self.start = None
+
+    def __enter__(self):
+        if _hooks:
+            self.start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.start is not None:
+            record(
+                self.phase, self.start, monotonic() - self.start, host=self.host,
+                error=_describe(exc) if exc is not None else None, detail=self.detail)
+        return False
+
+    def __call__(self, fn):
+        """time each call of 'fn' as this phase."""
+        phase, host, detail = self.phase, self.host, self.detail
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(phase, host, detail):
+                return fn(*args, **kwargs)
+        return wrapper
+
+def buffer_events():
+    """Divert all further events into the returned list, rather than to the hooks.
+
+    Used by forked workers, whose events are sent back to (& replayed in) the parent."""
+    events = []
+    _hooks[:] = [events.append]
+    return events
+
+def replay(events):
+    """Report events buffered in a worker (see 'buffer_events') to the hooks."""
+    for event in events or ():
+        emit(Event(*event))
+
+# Aggregate timings of a phase or host
+#
+# count   - number of events
+# total   - summed duration (seconds)
+# max     - longest duration (seconds)
+# slowest - host of the longest event (None if not host-specific)
+# errors  - number of events ending in an error
+Stats = namedtuple('Stats', ['count', 'total', 'max', 'slowest', 'errors'])
+
+def _aggregate(events):
+    """Stats over 'events'."""
+    slowest = max(events, key=lambda event: event.duration)
+    return Stats(
+        count=len(events),
+        total=sum(event.duration for event in events),
+        max=slowest.duration,
+        slowest=slowest.host,
+        errors=sum(1 for event in events if event.error is not None))
+
+class Recorder:
+    """Hook collecting events, summarizing them per phase & per host."""
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def phases(self):
+        """phase => Stats, in order of first occurrence."""
+        groups = OrderedDict()
+        for event in self.events:
+            groups.setdefault(event.phase, []).append(event)
+        return OrderedDict((phase, _aggregate(events)) for (phase, events) in groups.items())
+
+    def hosts(self, phase=None):
+        """host => Stats of its events (only those of 'phase', if given), slowest first."""
+        groups = {}
+        for event in self.events:
+            if event.host is not None and (phase is None or event.phase == phase):
+                groups.setdefault(event.host, []).append(event)
+        stats = ((host, _aggregate(events)) for (host, events) in groups.items())
+        return OrderedDict(sorted(stats, key=lambda item: item[1].total, reverse=True))
+
+    def summary(self, top=10):
+        """Format the per-phase timings and the 'top' slowest hosts as a table."""
+        rows = [('phase', 'count', 'total', 'mean', 'max', 'slowest host', 'errors')]
+        for (phase, stats) in self.phases().items():
+            rows.append((
+                phase, str(stats.count), _fmt_secs(stats.total),
+                _fmt_secs(stats.total / stats.count), _fmt_secs(stats.max),
+                stats.slowest or '-', str(stats.errors)))
+        lines = _fmt_table(rows)
+        hosts = list(self.hosts().items())[:top]
+        if hosts:
+            rows = [('host', 'events', 'total', 'max', 'errors')]
+            rows.extend(
+                (host, str(stats.count), _fmt_secs(stats.total), _fmt_secs(stats.max),
+                 str(stats.errors))
+                for (host, stats) in hosts)
+            lines.append("")
+            lines.extend(_fmt_table(rows))
+        return "\n".join(lines)
+
+    def trace(self):
+        """Events in Chrome's trace event format (timestamps in µs, relative to the first event).
+
+        Each host gets a track ("thread") of its own, named after its label."""
+        origin = min((event.start for event in self.events), default=0)
+        tids = OrderedDict()
+        def trace_event(event):
+            tid = tids.setdefault((event.pid, event.host), len(tids) + 1) if event.host else 0
+            args = {key: getattr(event, key) for key in ('host', 'error', 'detail')}
+            return {
+                'name': event.phase,
+                'cat': 'prefab',
+                'ph': 'X',
+                'ts': round((event.start - origin) * 1e6, 1),
+                'dur': round(event.duration * 1e6, 1),
+                'pid': event.pid,
+                'tid': tid,
+                'args': {key: val for (key, val) in args.items() if val is not None}
+            }
+        trace_events = [trace_event(event) for event in self.events]
+        trace_events.extend(
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': host}}
+            for ((pid, host), tid) in tids.items())
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def write_trace(self, fpath):
+        """Write the JSON trace (see 'trace') to 'fpath'."""
+        with open(fpath, mode='w') as fp:
+            json.dump(self.trace(), fp)
+
+def _fmt_secs(secs):
+    """format a duration for display."""
+    if secs >= 1:
+        return "{:.2f}s".format(secs)
+    return "{:.1f}ms".format(secs * 1000)
+
+def _fmt_table(rows):
+    """format rows (the first being the header) as aligned columns."""
+    widths = [max(len(row[col]) for row in rows) for col in range(len(rows[0]))]
+    return [
+        "  ".join(
+            cell.ljust(width) if col == 0 else cell.rjust(width)
+            for (col, (cell, width)) in enumerate(zip(row, widths))).rstrip()
+        for row in rows]
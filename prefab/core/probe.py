@@ -0,0 +1,224 @@
+"""
+Check which hosts are reachable & accept their configured credentials.
+
+'probe' checks many hosts concurrently (asyncio, at most 'concurrency' at
+a time), running these stages against each host in turn:
+
+    tcp    - a TCP connection to its address & port can be established
+    banner - the server identifies itself as an SSH server
+    auth   - logging in as configured succeeds (password or keys, see
+             'fabenv.ssh_settings')
+
+Authentication is left to paramiko, which blocks - it runs in a thread
+pool on a connection of its own. The latency of each stage is recorded,
+such that roles can be summarized by latency percentiles before rolling
+out (see 'summarize').
+"""
+import math
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from .config import confparse as cp
+from .fabenv import ssh_settings, _host_password
+from .instrument import _fmt_secs, _fmt_table
+from . import instrument
+
+STAGES = ('tcp', 'banner', 'auth')
+
+PERCENTILES = (50, 90, 99)
+
+# lines servers may send before identifying themselves (RFC 4253, 4.2)
+MAX_PRE_BANNER_LINES = 20
+
+# Outcome of probing one host
+#
+# label   - host label
+# ok      - True iff all stages run succeeded
+# failed  - stage which failed (None if ok)
+# error   - description of the failure (None if ok)
+# banner  - SSH identification string sent by the server (None if not received)
+# latency - stage => duration (seconds) of the stages which succeeded
+ProbeResult = namedtuple('ProbeResult', ['label', 'ok', 'failed', 'error', 'banner', 'latency'])
+
+class ProbeError(Exception):
+    """Raised when a stage of probing a host fails."""
+    def __init__(self, stage, msg):
+        super().__init__(msg)
+        self.stage = stage
+
+def select_hosts(conf, roles=None):
+    """Labels of the hosts of 'roles' (of all hosts if None), without duplicates.
+
+    Raises KeyError if any of 'roles' is not defined."""
+    if roles is None:
+        return list(conf.get('hosts', {}))
+    defined = conf.get('roles', {})
+    missing = [role for role in roles if role not in defined]
+    if missing:
+        raise KeyError("undefined roles: {}".format(", ".join(missing)))
+    return list(dict.fromkeys(label for role in roles for label in defined[role]['hosts']))
+
+async def _read_banner(reader):
+    """read the SSH identification string, skipping lines sent before it."""
+    for _ in range(MAX_PRE_BANNER_LINES + 1):
+        line = await reader.readline()
+        if not line:
+            raise ProbeError('banner', "connection closed before sending an SSH banner")
+        if line.startswith(b'SSH-'):
+            return line.rstrip(b'\r\n').decode('utf-8', 'replace')
+    raise ProbeError('banner', "no SSH banner within the first {} lines".format(
+        MAX_PRE_BANNER_LINES + 1))
+
+def _authenticate(host_entry, timeout):
+    """log into the host of 'host_entry' (blocking), raising 'ProbeError' on failure."""
+    import paramiko
+    settings = ssh_settings(host_entry)
+    if settings is None:
+        raise ProbeError('auth', "unknown login method '{}'".format(host_entry.get('method')))
+    password = _host_password(host_entry)
+    if host_entry['method'] == 'password' and password is None:
+        raise ProbeError('auth', "no password configured, a task would prompt for it")
+    client = paramiko.SSHClient()
+    try:
+        client.load_system_host_keys()
+    except OSError:
+        pass
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(
+            host_entry['address'], port=int(host_entry['port']), username=host_entry['user'],
+            password=password, key_filename=settings.get('keys'),
+            allow_agent=not settings['no_agent'], look_for_keys=not settings.get('no_keys'),
+            timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+    except paramiko.AuthenticationException as exc:
+        raise ProbeError('auth', "authentication failed: {}".format(exc))
+    except (paramiko.SSHException, OSError) as exc:
+        raise ProbeError('auth', "{}: {}".format(type(exc).__name__, exc))
+    finally:
+        client.close()
+
+async def _probe_host(label, host_entry, limit, executor, timeout, auth):
+    """run the stages of probing a host, returning its 'ProbeResult'."""
+    latency, banner = {}, None
+    def done(stage, start):
+        """record the completion of 'stage'."""
+        latency[stage] = monotonic() - start
+        instrument.record('probe.' + stage, start, latency[stage], host=label)
+
+    async with limit:
+        start = monotonic()
+        try:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host_entry['address'], int(host_entry['port'])),
+                    timeout)
+            except TimeoutError:
+                raise ProbeError('tcp', "timed out after {}s".format(timeout))
+            except OSError as exc:
+                raise ProbeError('tcp', exc.strerror or str(exc) or type(exc).__name__)
+            done('tcp', start)
+
+            start = monotonic()
+            try:
+                banner = await asyncio.wait_for(_read_banner(reader), timeout)
+            except TimeoutError:
+                raise ProbeError('banner', "timed out after {}s".format(timeout))
+            except OSError as exc:
+                raise ProbeError('banner', str(exc) or type(exc).__name__)
+            finally:
+                writer.close()
+            done('banner', start)
+
+            if auth:
+                start = monotonic()
+                await asyncio.get_running_loop().run_in_executor(
+                    executor, _authenticate, host_entry, timeout)
+                done('auth', start)
+        except ProbeError as exc:
+            instrument.record(
+                'probe.' + exc.stage, start, monotonic() - start, host=label, error=str(exc))
+            return ProbeResult(label, False, exc.stage, str(exc), banner, latency)
+    return ProbeResult(label, True, None, None, banner, latency)
+
+async def _probe_all(conf, labels, concurrency, timeout, auth):
+    """probe the hosts of 'labels' concurrently."""
+    limit = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return await asyncio.gather(*(
+            _probe_host(label, cp.host_entry(conf, label), limit, executor, timeout, auth)
+            for label in labels))
+
+def probe(conf, labels, concurrency=50, timeout=5.0, auth=True, store=None):
+    """Probe the hosts of 'labels', returning a 'ProbeResult' per host (in order of 'labels').
+
+    concurrency - max. number of hosts probed at a time
+    timeout     - time limit (seconds) of each stage
+    auth        - whether to log in, otherwise only TCP connect & banner are checked
+    store       - 'hoststore.HostStore' recording the outcome & latencies of each host
+    """
+    with instrument.span('probe'):
+        results = asyncio.run(_probe_all(conf, labels, concurrency, timeout, auth))
+    if store is not None:
+        store.record_many(
+            (res.label, res.ok, res.latency.get('tcp'), res.latency.get('auth'))
+            for res in results)
+    return results
+
+def percentile(values, pct):
+    """Nearest-rank percentile 'pct' (0-100] of the sorted, non-empty 'values'."""
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+# Probe results of a role
+#
+# role    - name of the role ('*' for all hosts probed)
+# hosts   - number of hosts probed
+# ok      - number of hosts passing all stages
+# latency - stage => (p50, p90, p99) latencies (seconds) of the hosts completing the stage
+RoleSummary = namedtuple('RoleSummary', ['role', 'hosts', 'ok', 'latency'])
+
+def _summarize(role, results):
+    """'RoleSummary' over 'results'."""
+    latency = {}
+    for stage in STAGES:
+        values = sorted(res.latency[stage] for res in results if stage in res.latency)
+        if values:
+            latency[stage] = tuple(percentile(values, pct) for pct in PERCENTILES)
+    return RoleSummary(role, len(results), sum(1 for res in results if res.ok), latency)
+
+def summarize(conf, results, roles=None):
+    """Summarize the results per role (those of 'roles', all roles if None) & over all hosts.
+
+    Roles none of whose hosts were probed are omitted."""
+    by_label = {res.label: res for res in results}
+    summaries = []
+    for role in (conf.get('roles', {}) if roles is None else roles):
+        members = [
+            by_label[label] for label in conf['roles'][role]['hosts'] if label in by_label]
+        if members:
+            summaries.append(_summarize(role, members))
+    summaries.append(_summarize('*', results))
+    return summaries
+
+def format_report(conf, results, roles=None):
+    """Format the failed hosts & per-role latency percentiles as tables."""
+    lines = []
+    failed = [res for res in results if not res.ok]
+    if failed:
+        rows = [('host', 'stage', 'error')]
+        rows.extend((res.label, res.failed, res.error) for res in failed)
+        lines.extend(_fmt_table(rows))
+        lines.append("")
+    summaries = summarize(conf, results, roles)
+    stages = [stage for stage in STAGES if any(stage in sm.latency for sm in summaries)]
+    rows = [('role', 'hosts', 'ok', 'failed') + tuple(
+        "{} p{}".format(stage, pct) for stage in stages for pct in PERCENTILES)]
+    for summary in summaries:
+        rows.append((summary.role, str(summary.hosts), str(summary.ok),
+                     str(summary.hosts - summary.ok)) + tuple(
+                         _fmt_secs(secs) if secs is not None else '-'
+                         for stage in stages
+                         for secs in summary.latency.get(stage, (None,) * len(PERCENTILES))))
+    lines.extend(_fmt_table(rows))
+    return "\n".join(lines)
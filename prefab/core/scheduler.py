@@ -0,0 +1,334 @@
+"""
+Bounded, process-based scheduler for running work against many hosts.
+
+Fabric keeps its state (env, connections) in process-global variables, so
+concurrent tasks cannot share a process. Instead each host is handled by a
+forked worker process, at most 'pool_size' of which are alive at a time.
+Results are yielded as soon as each host finishes, and hosts exceeding
+their time budget are terminated.
+
+'run_rolling' splits hosts into consecutive batches (e.g. to update a
+large role with controlled throughput), skipping the remaining batches
+once too many hosts failed.
+"""
+import io
+import os
+import re
+import sys
+import math
+import tempfile
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import namedtuple, deque
+from time import monotonic, sleep
+from . import instrument
+
+# Outcome of running on one host
+#
+# host     - host identifier, as handed to the scheduler
+# result   - return value of the work function (None on error)
+# duration - wall-clock time (seconds) spent on the host
+# error    - exception raised on the host (None on success)
+# output   - output (stdout & stderr) produced on the host, None unless captured
+HostResult = namedtuple('HostResult', ['host', 'result', 'duration', 'error', 'output'])
+
+class HostTimeoutError(Exception):
+    """Raised (as a result) when work on a host exceeds its time budget."""
+    def __init__(self, host, timeout):
+        super().__init__("host '{}' timed out after {}s".format(host, timeout))
+        self._host = host
+        self._timeout = timeout
+
+    @property
+    def host(self):
+        """host which timed out."""
+        return self._host
+
+    @property
+    def timeout(self):
+        """the time budget (seconds) which was exceeded."""
+        return self._timeout
+
+class RemoteError(Exception):
+    """Stand-in for exceptions which could not be sent back from a worker."""
+
+class WorkerDiedError(Exception):
+    """Raised (as a result) when a worker exits without reporting a result."""
+    def __init__(self, host, exitcode):
+        super().__init__(
+            "worker for host '{}' exited unexpectedly (exit code: {})".format(host, exitcode))
+        self._host = host
+        self._exitcode = exitcode
+
+    @property
+    def host(self):
+        """host whose worker died."""
+        return self._host
+
+    @property
+    def exitcode(self):
+        """exit code of the worker process."""
+        return self._exitcode
+
+def _flush_output():
+    """flush python-level buffers of stdout & stderr."""
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+def _redirect_output(fobj):
+    """send stdout & stderr, including that of subprocesses, to 'fobj'.
+
+    Returns the state to hand to '_restore_output' to undo the redirection."""
+    _flush_output()
+    saved = (os.dup(1), os.dup(2), sys.stdout, sys.stderr)
+    os.dup2(fobj.fileno(), 1)
+    os.dup2(fobj.fileno(), 2)
+    sys.stdout = sys.stderr = io.TextIOWrapper(
+        io.FileIO(1, 'w', closefd=False), encoding='utf-8', errors='replace', write_through=True)
+    return saved
+
+def _restore_output(saved):
+    """undo '_redirect_output'."""
+    _flush_output()
+    stdout_fd, stderr_fd, sys.stdout, sys.stderr = saved
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    os.close(stdout_fd)
+    os.close(stderr_fd)
+
+def _read_output(fobj):
+    """read (& close) captured output."""
+    fobj.seek(0)
+    output = fobj.read().decode('utf-8', errors='replace')
+    fobj.close()
+    return output
+
+def _run_worker(work_fn, host, conn, output):
+    """body of the worker process, reports outcome of 'work_fn(host)' over 'conn'.
+
+    Instrumentation events raised in the worker are sent along, to be replayed in the parent."""
+    if output is not None:
+        _redirect_output(output) # worker exits afterwards, never restored
+    events = instrument.buffer_events() if instrument.enabled() else None
+    try:
+        outcome = (work_fn(host), None, events)
+    except BaseException as exc: # pylint: disable=W0703
+        # SystemExit (abort()) included, it is a failure of this host only
+        outcome = (None, exc, events)
+    try:
+        conn.send(outcome)
+    except Exception: # pylint: disable=W0703
+        # result/exception could not be pickled
+        err = outcome[1] or sys.exc_info()[1]
+        conn.send((None, RemoteError(
+            "".join(traceback.format_exception_only(type(err), err)).strip()), events))
+    finally:
+        conn.close()
+
+class _Job:
+    """A worker process handling a single host."""
+    __slots__ = ('host', 'process', 'conn', 'output', 'started', 'deadline')
+
+    def __init__(self, ctx, work_fn, host, timeout, capture):
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+        self.host = host
+        self.conn = recv_conn
+        # created by the parent, such that output survives the worker being killed
+        self.output = tempfile.TemporaryFile() if capture else None
+        self.process = ctx.Process(
+            target=_run_worker, args=(work_fn, host, send_conn, self.output), name=str(host))
+        self.process.start()
+        send_conn.close()
+        self.started = monotonic()
+        self.deadline = self.started + timeout if timeout else None
+
+    def result(self):
+        """collect the outcome of the (finished) worker."""
+        try:
+            result, error, events = self.conn.recv()
+        except (EOFError, OSError):
+            self.process.join()
+            result, error, events = None, WorkerDiedError(self.host, self.process.exitcode), None
+        instrument.replay(events)
+        self.conn.close()
+        self.process.join()
+        return HostResult(
+            self.host, result, monotonic() - self.started, error, self.collect_output())
+
+    def kill(self, timeout):
+        """terminate the worker for exceeding its time budget."""
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+        return HostResult(
+            self.host, None, monotonic() - self.started, HostTimeoutError(self.host, timeout),
+            self.collect_output())
+
+    def collect_output(self):
+        """output captured from the worker (None if not capturing)."""
+        if self.output is None:
+            return None
+        return _read_output(self.output)
+
+def run(work_fn, hosts, pool_size, timeout=None, capture=False):
+    """Run 'work_fn(host)' for each host, yielding a 'HostResult' per host as it finishes.
+
+    At most 'pool_size' hosts are processed at any one time. If 'timeout' (seconds)
+    is given, hosts taking longer are terminated and reported as failing with
+    'HostTimeoutError'. If 'capture' is set, the output of each host is buffered
+    and reported with its result rather than written to stdout/stderr.
+
+    NOTE: 'work_fn' runs in a forked process, it need not be picklable but its
+          return value (and exceptions) must be.
+    """
+    if pool_size < 1:
+        raise ValueError("'pool_size' must be at least 1")
+    ctx = multiprocessing.get_context('fork')
+    pending = deque(hosts)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < pool_size:
+                job = _Job(ctx, work_fn, pending.popleft(), timeout, capture)
+                running[job.conn] = job
+
+            deadlines = [job.deadline for job in running.values() if job.deadline]
+            wait_for = max(0, min(deadlines) - monotonic()) if deadlines else None
+            for conn in wait(list(running), timeout=wait_for):
+                yield running.pop(conn).result()
+
+            now = monotonic()
+            for conn, job in list(running.items()):
+                if job.deadline and job.deadline <= now:
+                    del running[conn]
+                    yield job.kill(timeout)
+    finally:
+        # consumer stopped early (or raised), don't leave workers behind
+        for job in running.values():
+            job.process.terminate()
+            job.process.join()
+            job.conn.close()
+            job.collect_output()
+
+def run_serial(work_fn, hosts, capture=False):
+    """Run 'work_fn(host)' for each host in turn, in-process, yielding a 'HostResult' per host.
+
+    Counterpart to 'run' for when hosts should not be processed in parallel,
+    exceptions (incl. SystemExit) are reported as the host's error. If 'capture' is
+    set, the output of each host is buffered as with 'run'.
+
+    NOTE: capturing redirects this process' stdout & stderr for the duration,
+          prompts for user input would not be seen - don't capture interactive work."""
+    for host in hosts:
+        output = tempfile.TemporaryFile() if capture else None
+        saved = _redirect_output(output) if output is not None else None
+        started = monotonic()
+        try:
+            result, error = work_fn(host), None
+        except (Exception, SystemExit) as exc: # pylint: disable=W0703
+            result, error = None, exc
+        finally:
+            if saved is not None:
+                _restore_output(saved)
+        yield HostResult(
+            host, result, monotonic() - started, error,
+            _read_output(output) if output is not None else None)
+
+# Settings of running hosts in batches (see 'run_rolling')
+#
+# batch        - hosts per batch, a count or a percentage of all hosts (e.g. '25%')
+# max_failures - failed hosts tolerated before the remaining batches are skipped,
+#                a count or a percentage of all hosts
+# pause        - time (seconds) to wait between batches
+# order        - 'label' to run hosts ordered by their label, None to keep their order
+Rolling = namedtuple('Rolling', ['batch', 'max_failures', 'pause', 'order'])
+
+def _check_amount(spec, name):
+    """validate a count (int >= 0) or percentage ('N%', 0 < N <= 100), returning it."""
+    if isinstance(spec, str) and spec.endswith('%'):
+        try:
+            pct = float(spec[:-1])
+        except ValueError:
+            pct = None
+        if pct is not None and 0 < pct <= 100:
+            return spec
+    elif isinstance(spec, int) and not isinstance(spec, bool) and spec >= 0:
+        return spec
+    raise ValueError("'{}' must be a count or a percentage ('N%'), got {!r}".format(name, spec))
+
+def rolling_settings(batch, max_failures=0, pause=0, order='label'):
+    """Validate the settings of a rolling run, returning them as 'Rolling'.
+
+    Raises ValueError on invalid settings."""
+    _check_amount(batch, 'batch')
+    if batch == 0:
+        raise ValueError("'batch' must be at least 1")
+    _check_amount(max_failures, 'max_failures')
+    if pause < 0:
+        raise ValueError("'pause' must not be negative")
+    if order not in ('label', None):
+        raise ValueError("'order' must be 'label' or None, got {!r}".format(order))
+    return Rolling(batch, max_failures, pause, order)
+
+def amount(spec, total):
+    """Resolve a count or percentage (see 'Rolling') of 'total' hosts into a count.
+
+    Percentages round down."""
+    if isinstance(spec, str):
+        return math.floor(total * float(spec[:-1]) / 100)
+    return spec
+
+def batch_size(spec, total):
+    """Resolve the batch size (see 'Rolling') of running 'total' hosts, at least 1.
+
+    Percentages round up."""
+    if isinstance(spec, str):
+        return max(1, math.ceil(total * float(spec[:-1]) / 100))
+    return max(1, spec)
+
+def natural_key(label):
+    """sort key ordering labels by their numeric parts, e.g. 'vm2' before 'vm10'."""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', label)]
+
+class BatchAbortedError(Exception):
+    """Reported for hosts skipped as a rolling run exceeded its failure threshold."""
+    def __init__(self, host, failures):
+        super().__init__(
+            "skipped host '{}', {} host(s) failed in earlier batches".format(host, failures))
+        self.host = host
+        self.failures = failures
+
+def run_rolling(run_batch, hosts, batch_size, max_failures=0, pause=0):
+    """Run 'hosts' in consecutive batches of 'batch_size', yielding a 'HostResult' per host.
+
+    run_batch    - fn(hosts) yielding a 'HostResult' per host of the batch (e.g. using 'run')
+    max_failures - once more hosts failed, the remaining batches are skipped, their
+                   hosts are reported as failing with 'BatchAbortedError'
+    pause        - time (seconds) to wait between batches
+
+    Each batch completes before the next is started."""
+    if batch_size < 1:
+        raise ValueError("'batch_size' must be at least 1")
+    hosts = list(hosts)
+    n_batches = -(-len(hosts) // batch_size)
+    failures = 0
+    for ndx in range(n_batches):
+        batch = hosts[ndx * batch_size:(ndx + 1) * batch_size]
+        if failures > max_failures:
+            for host in hosts[ndx * batch_size:]:
+                yield HostResult(host, None, 0, BatchAbortedError(host, failures), None)
+            return
+        if ndx and pause:
+            sleep(pause)
+        started = monotonic()
+        for res in run_batch(batch):
+            if res.error is not None:
+                failures += 1
+            yield res
+        instrument.record(
+            'batch', started, monotonic() - started,
+            detail="{}/{} ({} hosts)".format(ndx + 1, n_batches, len(batch)))
@@ -0,0 +1,346 @@
+"""
+Delta-sync of a local directory tree to hosts.
+
+Only what changed is sent, in two ways:
+
+1) per host label, a manifest of the files last synced (size, mtime, mode
+   & digest of each local file) is kept in prefab's cache directory. Files
+   whose size & mtime still match the manifest are not looked at again -
+   hosts without changes are not even connected to. 'full=True' ignores
+   the manifests, comparing every file against the host.
+
+2) files which did change are sent as a delta (the rsync algorithm): the
+   host reports the checksums of the blocks of its copy, blocks found in
+   the local file (at any offset, by a rolling checksum) are copied from
+   the host's copy, only the rest is sent.
+
+Each host costs two commands: one reporting block checksums, one applying
+the deltas (files are written to a temporary file, verified & moved into
+place). Both are small python scripts, hosts require 'python3'. Files
+removed locally are removed from hosts with 'delete=True'. Empty
+directories are not synced.
+
+NOTE: files modified on a host behind prefab's back go unnoticed until
+      changed locally, or synced with 'full=True'.
+"""
+import os
+import json
+import shlex
+import base64
+import hashlib
+import posixpath
+from os import path
+from urllib.parse import quote
+from collections import namedtuple
+from .config.cache import cache_dir
+from . import aio
+from . import instrument
+
+BLOCK_SIZE = 2048
+
+_MOD = 1 << 16
+
+# Outcome of syncing a host
+#
+# files   - paths (relative to the tree) of the files written
+# deleted - paths of the files removed
+# literal - bytes of file content sent
+# matched - bytes of file content copied from the host's old copies
+Synced = namedtuple('Synced', ['files', 'deleted', 'literal', 'matched'])
+
+# Local file
+#
+# size     - size (bytes)
+# mtime_ns - modification time (nanoseconds)
+# mode     - permission bits
+LocalFile = namedtuple('LocalFile', ['size', 'mtime_ns', 'mode'])
+
+# reads {'block_size': n, 'paths': [...]}, writes path => None (missing) or
+# {'sha256': digest, 'mode': mode, 'blocks': [[weak, strong], ...]} of its full blocks
+_SIGNATURE_SCRIPT = r"""
+import os, sys, json, hashlib
+req = json.load(sys.stdin)
+bs = req['block_size']
+out = {}
+for p in req['paths']:
+    try:
+        f = open(p, 'rb')
+    except OSError:
+        out[p] = None
+        continue
+    digest, blocks = hashlib.sha256(), []
+    with f:
+        while True:
+            blk = f.read(bs)
+            digest.update(blk)
+            if len(blk) < bs:
+                break
+            a = sum(blk) % 65536
+            b = sum((bs - i) * x for (i, x) in enumerate(blk)) % 65536
+            blocks.append([a | b << 16, hashlib.sha1(blk).hexdigest()])
+        mode = os.fstat(f.fileno()).st_mode & 0o7777
+    out[p] = {'sha256': digest.hexdigest(), 'mode': mode, 'blocks': blocks}
+json.dump(out, sys.stdout)
+"""
+
+# reads {'block_size': n, 'files': {path: {'ops', 'sha256', 'mode'}}, 'delete': [...]},
+# ops being [block, count] (copy blocks of the old file) or base64 literals
+_APPLY_SCRIPT = r"""
+import os, sys, json, base64, hashlib, tempfile
+req = json.load(sys.stdin)
+bs = req['block_size']
+for (p, f) in req['files'].items():
+    d = os.path.dirname(p)
+    os.makedirs(d, exist_ok=True)
+    old = open(p, 'rb') if any(isinstance(op, list) for op in f['ops']) else None
+    fd, tmp = tempfile.mkstemp(dir=d, prefix='.prefab-sync-')
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for op in f['ops']:
+                if isinstance(op, list):
+                    old.seek(op[0] * bs)
+                    chunk = old.read(op[1] * bs)
+                else:
+                    chunk = base64.b64decode(op)
+                digest.update(chunk)
+                out.write(chunk)
+        if digest.hexdigest() != f['sha256']:
+            raise ValueError('checksum mismatch writing ' + p)
+        os.chmod(tmp, f['mode'])
+        os.replace(tmp, p)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+for p in req['delete']:
+    try:
+        os.unlink(p)
+    except FileNotFoundError:
+        pass
+"""
+
+def _script_command(script):
+    """command running the python 'script' on a host."""
+    return "python3 -c {}".format(shlex.quote(script))
+
+def weak_checksum(block):
+    """rolling (adler-32 like) checksum of 'block'."""
+    size = len(block)
+    a = sum(block) % _MOD
+    b = sum((size - ndx) * byte for (ndx, byte) in enumerate(block)) % _MOD
+    return a | b << 16
+
+def _strong_checksum(block):
+    """checksum confirming blocks whose weak checksums match."""
+    return hashlib.sha1(block).hexdigest()
+
+def delta(data, blocks, block_size=BLOCK_SIZE):
+    """Ops rebuilding 'data' from the old file whose full blocks have checksums 'blocks'.
+
+    Ops are either [first block, count] (copy blocks of the old file) or
+    bytes (literal data), see 'encode_ops'."""
+    index = {}
+    for (ndx, (weak, strong)) in enumerate(blocks):
+        index.setdefault(weak, {}).setdefault(strong, ndx)
+    ops, literal, pos, size = [], bytearray(), 0, len(data)
+
+    def emit_copy(ndx):
+        if literal:
+            ops.append(bytes(literal))
+            literal.clear()
+        if ops and isinstance(ops[-1], list) and sum(ops[-1]) == ndx:
+            ops[-1][1] += 1
+        else:
+            ops.append([ndx, 1])
+
+    a = b = None
+    while index and pos + block_size <= size:
+        if a is None:
+            weak = weak_checksum(data[pos:pos + block_size])
+            (a, b) = (weak & (_MOD - 1), weak >> 16)
+        candidates = index.get(a | b << 16)
+        if candidates is not None:
+            ndx = candidates.get(_strong_checksum(data[pos:pos + block_size]))
+            if ndx is not None:
+                emit_copy(ndx)
+                pos += block_size
+                a = None
+                continue
+        # roll the window one byte forward
+        out = data[pos]
+        literal.append(out)
+        if pos + block_size < size:
+            a = (a - out + data[pos + block_size]) % _MOD
+            b = (b - block_size * out + a) % _MOD
+        pos += 1
+    literal.extend(data[pos:])
+    if literal:
+        ops.append(bytes(literal))
+    return ops
+
+def encode_ops(ops):
+    """JSON-serializable form of 'ops' (literals base64-encoded)."""
+    return [op if isinstance(op, list) else base64.b64encode(op).decode('ascii') for op in ops]
+
+def scan_tree(local_dir):
+    """Files of the tree at 'local_dir', relative path ('/'-separated) => 'LocalFile'."""
+    files = {}
+    for (dirpath, _, filenames) in os.walk(local_dir):
+        for fname in filenames:
+            fpath = path.join(dirpath, fname)
+            st = os.stat(fpath)
+            rel = path.relpath(fpath, local_dir).replace(os.sep, '/')
+            files[rel] = LocalFile(st.st_size, st.st_mtime_ns, st.st_mode & 0o7777)
+    return files
+
+class Manifests:
+    """Manifests of the files synced to each host, one JSON file per host label.
+
+    Each maps remote directory => relative path => [size, mtime_ns, mode, sha256].
+    Failing to read or write manifests is not an error, files are then
+    compared against the hosts."""
+    def __init__(self, directory=None):
+        self.directory = directory or path.join(cache_dir(), 'sync')
+
+    def _path(self, label):
+        return path.join(self.directory, quote(label, safe='') + '.json')
+
+    def _read(self, label):
+        try:
+            with open(self._path(label)) as fp:
+                manifests = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        return manifests if isinstance(manifests, dict) else {}
+
+    def load(self, label, remote_dir):
+        """Manifest of the files synced to 'remote_dir' of host 'label' (empty if unknown)."""
+        return self._read(label).get(remote_dir, {})
+
+    def store(self, label, remote_dir, manifest):
+        """Record 'manifest' as the files synced to 'remote_dir' of host 'label'."""
+        manifests = self._read(label)
+        manifests[remote_dir] = manifest
+        entry_path = self._path(label)
+        tmp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, mode='w') as fp:
+                json.dump(manifests, fp)
+            os.replace(tmp_path, entry_path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+class _Tree:
+    """local tree being synced, digests & deltas computed once for all hosts."""
+    def __init__(self, local_dir, block_size):
+        self.local_dir = local_dir
+        self.block_size = block_size
+        self.files = scan_tree(local_dir)
+        self._digests = {}
+        self._deltas = {}
+
+    def read(self, rel):
+        with open(path.join(self.local_dir, *rel.split('/')), 'rb') as fobj:
+            return fobj.read()
+
+    def digest(self, rel):
+        """SHA-256 of the local file 'rel'."""
+        if rel not in self._digests:
+            self._digests[rel] = hashlib.sha256(self.read(rel)).hexdigest()
+        return self._digests[rel]
+
+    def manifest_entry(self, rel):
+        local = self.files[rel]
+        return [local.size, local.mtime_ns, local.mode, self.digest(rel)]
+
+    def delta(self, rel, signature):
+        """ops rebuilding 'rel' from the host's copy of 'signature' (hosts with equal copies share it)."""
+        key = (rel, signature and signature['sha256'])
+        if key not in self._deltas:
+            data = self.read(rel)
+            blocks = signature['blocks'] if signature else []
+            self._deltas[key] = delta(data, blocks, self.block_size)
+        return self._deltas[key]
+
+    def pending(self, manifest, delete):
+        """(changed, removed) relative paths, given the 'manifest' of a host."""
+        changed = [
+            rel for (rel, local) in self.files.items()
+            if (manifest.get(rel) or [None] * 3)[:3] != list(local)]
+        removed = [rel for rel in manifest if rel not in self.files] if delete else []
+        return changed, removed
+
+async def _sync_host(host, tree, remote_dir, changed, removed, manifests):
+    """bring 'remote_dir' of 'host' up to date, returning its 'Synced'."""
+    remote = {rel: posixpath.join(remote_dir, rel) for rel in changed}
+    block_size = tree.block_size
+    signatures = {}
+    if changed:
+        with instrument.span('sync.signatures', host=host.label):
+            res = await host.run(_script_command(_SIGNATURE_SCRIPT), stdin=json.dumps({
+                'block_size': block_size, 'paths': list(remote.values())}))
+        signatures = json.loads(res)
+    files, literal, matched = {}, 0, 0
+    for rel in changed:
+        sig = signatures.get(remote[rel])
+        if sig is not None and (sig['sha256'], sig['mode']) == (
+                tree.digest(rel), tree.files[rel].mode):
+            continue
+        ops = tree.delta(rel, sig)
+        literal += sum(len(op) for op in ops if not isinstance(op, list))
+        matched += sum(op[1] for op in ops if isinstance(op, list)) * block_size
+        files[remote[rel]] = {
+            'ops': encode_ops(ops), 'sha256': tree.digest(rel), 'mode': tree.files[rel].mode}
+    if files or removed:
+        with instrument.span('sync.apply', host=host.label, detail=remote_dir):
+            await host.run(_script_command(_APPLY_SCRIPT), stdin=json.dumps({
+                'block_size': block_size, 'files': files,
+                'delete': [posixpath.join(remote_dir, rel) for rel in removed]}))
+    manifests.store(host.label, remote_dir, {rel: tree.manifest_entry(rel) for rel in tree.files})
+    written = [rel for rel in changed if remote[rel] in files]
+    return Synced(written, removed, literal, matched)
+
+def sync(conf, local_dir, remote_dir, roles=None, hosts=None, delete=False, full=False,
+         block_size=BLOCK_SIZE, manifests=None, concurrency=aio.DEFAULT_CONCURRENCY,
+         timeout=None, transport=None):
+    """Sync the tree at 'local_dir' to 'remote_dir' of the hosts of 'roles'/'hosts'.
+
+    delete      - remove files (previously synced) which no longer exist locally
+    full        - ignore the manifests, comparing all files against the hosts
+    block_size  - size (bytes) of the blocks files are compared by
+    manifests   - 'Manifests' of the files synced to each host
+    concurrency - max. number of hosts connected to at a time
+    timeout     - time limit (seconds) of each host, None for no limit
+    transport   - 'aio.Transport' opening connections (see 'aio.execute')
+
+    Returns label => 'Synced', hosts which failed map to the exception raised."""
+    manifests = manifests or Manifests()
+    with instrument.span('sync.scan', detail=local_dir):
+        tree = _Tree(local_dir, block_size)
+    labels = aio._task_hosts(conf, sync, hosts, roles)
+    results, work = {}, {}
+    for label in labels:
+        manifest = {} if full else manifests.load(label, remote_dir)
+        (changed, removed) = tree.pending(manifest, delete)
+        if changed or removed:
+            work[label] = (changed, removed)
+        else:
+            results[label] = Synced([], [], 0, 0)
+    if not work:
+        return results
+
+    async def sync_host(host):
+        (changed, removed) = work[host.label]
+        return await _sync_host(host, tree, remote_dir, changed, removed, manifests)
+    sync_host.__name__ = 'sync'
+    results.update(aio.execute(
+        conf, sync_host, hosts=list(work), concurrency=concurrency, timeout=timeout,
+        transport=transport))
+    return {label: results[label] for label in labels}
@@ -0,0 +1,259 @@
+"""
+Tests the asyncio execution backend against an in-memory transport
+(& the asyncssh transport against a mock SSH server).
+"""
+import asyncio
+import threading
+import pytest
+import paramiko
+from .config.core import parse_config
+from . import aio
+from . import hoststore as hs
+from .test_probe import AuthServer, serve, host_key # pylint: disable=W0611 (fixtures)
+
+VAR_ENV = {'home': '/home/user', 'cwd': '/srv'}
+
+class MemoryConnection(aio.Connection):
+    """connection answering commands from the transport's 'handler'."""
+    def __init__(self, transport, label):
+        self.transport = transport
+        self.label = label
+
+    async def execute(self, command, stdin=None):
+        self.transport.commands.append((self.label, command, stdin))
+        await asyncio.sleep(self.transport.delay)
+        return self.transport.handler(self.label, command)
+
+    async def put(self, local_path, remote_path):
+        with open(local_path, 'rb') as fobj:
+            self.transport.files[(self.label, remote_path)] = fobj.read()
+
+    async def close(self):
+        self.transport.active -= 1
+
+class MemoryTransport(aio.Transport):
+    """in-process transport, tracking the peak number of open connections."""
+    def __init__(self, handler=None, delay=0.0, unreachable=()):
+        self.handler = handler or (lambda label, command: (label + "\n", "", 0))
+        self.delay = delay
+        self.unreachable = unreachable
+        self.commands = []
+        self.files = {}
+        self.active = self.peak = 0
+
+    async def connect(self, label, host_entry):
+        if label in self.unreachable:
+            raise ConnectionRefusedError("refused")
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        return MemoryConnection(self, label)
+
+def make_conf(count, password='secret'):
+    """config of hosts 'vm<n>', all in role 'web'."""
+    return parse_config({
+        'hosts': {
+            'vm{}'.format(ndx): {
+                'address': '10.0.0.{}'.format(ndx), 'user': 'admin',
+                'method': 'password', 'password': password}
+            for ndx in range(count)},
+        'roles': {'web': ['vm{}'.format(ndx) for ndx in range(count)]}
+    }, VAR_ENV)
+
+async def hostname(host):
+    return await host.run("hostname")
+
+def test_execute_label_keyed():
+    """Ensure results are keyed by host label."""
+    transport = MemoryTransport()
+    results = aio.execute(make_conf(3), hostname, roles=['web'], transport=transport)
+    assert results == {'vm0': 'vm0', 'vm1': 'vm1', 'vm2': 'vm2'}
+    assert results['vm0'].return_code == 0 and results['vm0'].succeeded
+    assert transport.active == 0
+
+def test_execute_concurrency():
+    """Ensure at most 'concurrency' hosts are connected to at a time."""
+    transport = MemoryTransport(delay=0.01)
+    results = aio.execute(
+        make_conf(50), hostname, roles=['web'], concurrency=8, transport=transport)
+    assert len(results) == 50
+    assert transport.peak == 8
+
+def test_execute_errors():
+    """Ensure failing hosts map to their error, without affecting the others."""
+    def handler(label, command):
+        return ("", "no such file", 1) if label == 'vm1' else ("ok", "", 0)
+    transport = MemoryTransport(handler, unreachable=('vm2',))
+    results = aio.execute(make_conf(3), hostname, roles=['web'], transport=transport)
+    assert results['vm0'] == 'ok'
+    assert isinstance(results['vm1'], aio.CommandError)
+    assert results['vm1'].result.stderr == "no such file"
+    assert isinstance(results['vm2'], ConnectionRefusedError)
+
+def test_execute_warn_only():
+    """Ensure failing commands are returned when run with 'warn_only'."""
+    transport = MemoryTransport(lambda label, command: ("", "", 3))
+    res = aio.execute(make_conf(1), hostname, hosts=['vm0'], transport=transport,
+                      warn_only=True)['vm0']
+    assert res.failed and res.return_code == 3
+
+def test_execute_timeout():
+    """Ensure hosts exceeding the timeout are reported as such."""
+    transport = MemoryTransport(delay=5)
+    results = aio.execute(make_conf(1), hostname, hosts=['vm0'], timeout=0.1, transport=transport)
+    assert isinstance(results['vm0'], aio.HostTimeoutError)
+
+def test_execute_task_roles_and_args():
+    """Ensure the task's @roles are used by default & arguments are passed on."""
+    async def echo(host, word, suffix=''):
+        return await host.run("echo " + word + suffix)
+    echo.roles = ['web']
+    transport = MemoryTransport(lambda label, command: (command, "", 0))
+    results = aio.execute(make_conf(2), echo, 'hi', suffix='!', transport=transport)
+    assert results == {'vm0': 'echo hi!', 'vm1': 'echo hi!'}
+    with pytest.raises(ValueError):
+        aio.execute(make_conf(2), hostname, transport=transport)
+    with pytest.raises(KeyError):
+        aio.execute(make_conf(2), hostname, hosts=['nope'], transport=transport)
+
+def test_sudo_password():
+    """Ensure sudo is given the configured password of password logins."""
+    async def whoami(host):
+        return await host.sudo("whoami", user="www-data")
+    transport = MemoryTransport(lambda label, command: ("www-data", "", 0))
+    assert aio.execute(make_conf(1), whoami, hosts=['vm0'], transport=transport) == {
+        'vm0': 'www-data'}
+    [(_, command, stdin)] = transport.commands
+    assert command == "sudo -S -p '' -H -u www-data /bin/sh -c whoami"
+    assert stdin == "secret\n"
+
+def test_put(tmp_path):
+    """Ensure files are uploaded to each host."""
+    local = tmp_path / "app.conf"
+    local.write_bytes(b"port = 80\n")
+    async def upload(host):
+        await host.put(str(local), "/etc/app.conf")
+    transport = MemoryTransport()
+    aio.execute(make_conf(2), upload, roles=['web'], transport=transport)
+    assert transport.files == {
+        ('vm0', '/etc/app.conf'): b"port = 80\n", ('vm1', '/etc/app.conf'): b"port = 80\n"}
+
+def test_execute_host_store(tmp_path):
+    """Ensure hosts are ordered & skipped by the host store, recording connections."""
+    store = hs.HostStore(str(tmp_path / "hosts.sqlite"))
+    store.record_success('vm0', connect=2.0)
+    store.record_success('vm2', connect=0.1)
+    for _ in range(3):
+        store.record_failure('vm1')
+    transport = MemoryTransport()
+    results = aio.execute(make_conf(3), hostname, roles=['web'], concurrency=1,
+                          transport=transport, store=store, breaker=hs.DEFAULT_BREAKER)
+    assert isinstance(results['vm1'], hs.HostUnavailableError)
+    assert [label for (label, _, _) in transport.commands] == ['vm2', 'vm0']
+    assert store.stats(['vm0'])['vm0'].successes == 2
+
+def test_connect_options(tmp_path):
+    """Ensure logins are configured like fabric's (see 'ssh_settings')."""
+    key = tmp_path / "id_rsa"
+    key.write_text("key")
+    key.chmod(0o600)
+    conf = parse_config({'hosts': {
+        'pw': {'address': 'a', 'method': 'password', 'password': 'secret'},
+        'nopw': {'address': 'b', 'method': 'password'},
+        'key': {'address': 'c', 'method': 'key', 'keys': [str(key)]},
+    }}, VAR_ENV)
+    opts = aio._connect_options(conf['hosts']['pw'])
+    assert (opts['host'], opts['port'], opts['password']) == ('a', 22, 'secret')
+    assert opts['client_keys'] is None and opts['agent_path'] is None
+    assert aio._connect_options(conf['hosts']['key'])['client_keys'] == [str(key)]
+    with pytest.raises(ValueError):
+        aio._connect_options(conf['hosts']['nopw'])
+
+class ExecServer(AuthServer):
+    """SSH server (see 'AuthServer') answering each command with its own text."""
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        def reply():
+            channel.sendall(command + b"\n")
+            channel.send_exit_status(0)
+            channel.close()
+        threading.Thread(target=reply, daemon=True).start()
+        return True
+
+@pytest.fixture
+def exec_server(serve, host_key):
+    """mock SSH server (see 'ExecServer')."""
+    transports = []
+    def handle(conn):
+        transport = paramiko.Transport(conn)
+        transports.append(transport)
+        transport.add_server_key(host_key)
+        try:
+            transport.start_server(server=ExecServer())
+        except (paramiko.SSHException, EOFError):
+            pass
+    yield serve(handle)
+    for transport in transports:
+        transport.close()
+
+def known_hosts_line(server, key):
+    """known_hosts line of the mock 'server' presenting 'key'."""
+    return "{} {} {}\n".format(
+        hs.known_host_name('127.0.0.1', server.port), key.get_name(), key.get_base64())
+
+@pytest.mark.parametrize("known,checking,ok", [
+    ('same', 'yes', True),
+    (None, 'yes', False),
+    (None, 'accept-new', True),
+    ('other', 'accept-new', False),
+    ('other', 'no', True)])
+def test_asyncssh_host_keys(exec_server, host_key, tmp_path, known, checking, ok):
+    """Ensure host keys are verified against known_hosts, accepting any only if asked to."""
+    pytest.importorskip('asyncssh')
+    known_hosts = tmp_path / "known_hosts"
+    key = {'same': host_key, 'other': paramiko.RSAKey.generate(1024), None: None}[known]
+    known_hosts.write_text(known_hosts_line(exec_server, key) if key else "")
+    conf = parse_config({'hosts': {'vm0': {
+        'address': '127.0.0.1', 'port': exec_server.port, 'user': 'probe',
+        'method': 'password', 'password': 'secret'}}}, VAR_ENV)
+    transport = aio.AsyncSSHTransport(
+        known_hosts=str(known_hosts), host_key_checking=checking, connect_timeout=5)
+    results = aio.execute(conf, hostname, hosts=['vm0'], transport=transport)
+    if ok:
+        assert results['vm0'] == "hostname"
+    else:
+        assert "not trusted" in str(results['vm0'])
+
+def test_asyncssh_host_store(exec_server, host_key, tmp_path, monkeypatch):
+    """Ensure host keys recorded by the host store are accepted by the default transport."""
+    pytest.importorskip('asyncssh')
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / "cache"))
+    conf = parse_config({'hosts': {'vm0': {
+        'address': '127.0.0.1', 'port': exec_server.port, 'user': 'probe',
+        'method': 'password', 'password': 'secret'}}}, VAR_ENV)
+    store = hs.HostStore(str(tmp_path / "hosts.sqlite"))
+    assert "not trusted" in str(aio.execute(conf, hostname, hosts=['vm0'], store=store)['vm0'])
+    store.record_success('vm0', host_key=(
+        hs.known_host_name('127.0.0.1', exec_server.port), host_key.get_name(),
+        host_key.get_base64()))
+    assert aio.execute(conf, hostname, hosts=['vm0'], store=store) == {'vm0': "hostname"}
+
+def test_asyncssh_host_key_checking():
+    """Ensure unknown host key checking policies are refused."""
+    pytest.importorskip('asyncssh')
+    with pytest.raises(ValueError):
+        aio.AsyncSSHTransport(host_key_checking='maybe')
+
+def test_asyncssh_optional():
+    """Ensure a missing asyncssh is reported when the default transport is used."""
+    try:
+        import asyncssh # pylint: disable=W0611
+    except ImportError:
+        with pytest.raises(ImportError, match="asyncssh"):
+            aio.execute(make_conf(1), hostname, hosts=['vm0'])
+    else:
+        pytest.skip("asyncssh is installed")
@@ -0,0 +1,112 @@
+"""
+Tests batching run()/sudo() calls, running the batch scripts locally.
+"""
+import subprocess
+import pytest
+import fabric.api
+import fabric.operations
+from . import api as fab
+from . import batching
+
+@pytest.fixture
+def scripts(monkeypatch):
+    """scripts run (over a channel), executed by the local shell.
+
+    As over a channel, stderr is merged into stdout given a pty or
+    combine_stderr. Streams are kept apart by default."""
+    ran = []
+    def execute(channel, command, pty=True, combine_stderr=None, invoke_shell=False,
+                stdout=None, stderr=None, timeout=None, capture_buffer_size=None):
+        ran.append(command)
+        env = fabric.api.env
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+        merged = (pty and env.always_use_pty) or combine_stderr
+        proc = subprocess.run(['/bin/sh', '-c', command], stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT if merged else subprocess.PIPE,
+                              universal_newlines=True)
+        return proc.stdout.strip(), (proc.stderr or "").strip(), proc.returncode
+    monkeypatch.setattr(fabric.operations, '_execute', execute)
+    monkeypatch.setattr(fabric.operations, 'default_channel', lambda: None)
+    with fabric.api.settings(fabric.api.hide('everything'), host_string='root@vm1:22',
+                             use_shell=False, always_use_pty=False, combine_stderr=False):
+        yield ran
+
+def test_batch(scripts):
+    """Ensure queued commands run as one script, each resolving to its own result."""
+    with fab.batch():
+        first = fab.run("echo one")
+        with fabric.api.cd('/'):
+            second = fab.run("pwd")
+        third = fab.run("echo err >&2; exit 3", warn_only=True)
+        assert scripts == []
+    assert len(scripts) == 1
+    assert (first, second) == ("one", "/")
+    assert first.succeeded and first.return_code == 0 and first.command == "echo one"
+    assert third.failed and third.return_code == 3 and third.stderr == "err"
+
+@pytest.mark.parametrize("flags", [
+    {'always_use_pty': True}, {'combine_stderr': True}])
+def test_batch_merged(scripts, flags):
+    """Ensure results are resolved when stderr is merged into stdout (pty or combine_stderr)."""
+    with fabric.api.settings(**flags):
+        with fab.batch():
+            results = [fab.run("echo {}".format(word)) for word in ("one", "two", "three")]
+            failed = fab.run("echo err >&2; exit 3", warn_only=True)
+            last = fab.run("echo four")
+    assert len(scripts) == 1 and ">&2" not in scripts[0].replace("echo err >&2", "")
+    assert results == ["one", "two", "three"]
+    assert (failed, failed.return_code, failed.stderr) == ("err", 3, "")
+    assert last == "four"
+
+def test_batch_flush_on_use(scripts):
+    """Ensure using a pending result runs the commands queued so far."""
+    with fab.batch():
+        first = fab.run("echo one")
+        assert "one" in first
+        second = fab.run("echo two")
+        assert len(scripts) == 1
+    assert second == "two"
+    assert len(scripts) == 2
+
+def test_batch_abort(scripts):
+    """Ensure a failing command stops the script & aborts."""
+    with pytest.raises(SystemExit):
+        with fab.batch():
+            fab.run("exit 1")
+            fab.run("touch /nonexistent/never")
+    assert "exit 1" in scripts[0]
+    assert "case $__prefab_rc" in scripts[0]
+
+def test_batch_unbatchable(scripts):
+    """Ensure calls which cannot be queued run the queue first, then on their own."""
+    with fab.batch():
+        first = fab.run("echo one")
+        second = fab.run("echo two", timeout=10)
+        assert len(scripts) == 2 and second == "two"
+        assert scripts[1] == "echo two"
+    assert first == "one"
+
+def test_batch_discard(scripts):
+    """Ensure commands queued when the block raises are not run."""
+    with pytest.raises(ValueError):
+        with fab.batch():
+            res = fab.run("echo one")
+            raise ValueError()
+    assert scripts == []
+    with pytest.raises(batching.BatchedCommandError):
+        str(res)
+
+def test_batch_sudo(scripts):
+    """Ensure sudo() calls are queued wrapped in the sudo prefix."""
+    # 'env -u "admin"' stands in for sudo, unsetting variable 'admin'
+    with fabric.api.settings(sudo_prefix="env"):
+        with fab.batch():
+            res = fab.sudo("echo root", user="admin")
+    assert 'env -u "admin"  echo root' in scripts[0]
+    assert res == "root" and res.real_command.endswith("echo root")
+
+def test_split():
+    """Ensure script output is split at the markers, tolerating pty line endings."""
+    text = "one\r\ntok:0\r\n\r\ntok:2\r\ntwo\nlines\ntok:1"
+    assert batching._split(text, "tok") == [("one", 0), ("", 2), ("two\nlines", 1)]
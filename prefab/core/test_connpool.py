@@ -0,0 +1,161 @@
+"""
+Tests the SSH connection pool.
+"""
+import pytest
+import fabric.network
+from .connpool import ConnectionPool
+from .hoststore import HostStore, HostUnavailableError, Breaker
+
+class FakeTransport:
+    """stand-in for paramiko's transport."""
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        if not self.active:
+            raise EOFError()
+
+    def get_remote_server_key(self):
+        return FakeKey()
+
+class FakeKey:
+    """stand-in for paramiko's PKey."""
+    def get_name(self):
+        return 'ssh-ed25519'
+
+    def get_base64(self):
+        return 'AAAA'
+
+class FakeClient:
+    """stand-in for paramiko's SSHClient."""
+    def __init__(self, host):
+        self.host = host
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def connects(monkeypatch):
+    """replace fabric's connect function, recording the hosts connected to."""
+    made = []
+    def fake_connect(user, host, port, cache, seek_gateway=True):
+        made.append(host)
+        return FakeClient(host)
+    monkeypatch.setattr(fabric.network, 'connect', fake_connect)
+    return made
+
+LABELS = {
+    'root@vm1.example.com:22': 'vm1',
+    'root@vm2.example.com:22': 'vm2',
+    'root@vm3.example.com:22': 'vm3'
+}
+
+def test_pool_reuse(connects):
+    """Ensure connections are reused & keyed by host label."""
+    pool = ConnectionPool(key_fn=LABELS.get)
+    client = pool['root@vm1.example.com:22']
+    assert pool['root@vm1.example.com:22'] is client
+    assert list(pool.keys()) == ['vm1']
+    assert 'vm1' in pool and 'root@vm1.example.com:22' in pool
+    assert connects == ['vm1.example.com']
+
+def test_pool_unknown_host(connects):
+    """Ensure hosts without a label are keyed by host string."""
+    pool = ConnectionPool(key_fn=LABELS.get)
+    pool['root@gw.example.com:22']
+    assert list(pool.keys()) == ['root@gw.example.com:22']
+
+def test_pool_max_connections(connects):
+    """Ensure the least recently used connection is closed when the cap is reached."""
+    pool = ConnectionPool(key_fn=LABELS.get, max_connections=2)
+    vm1 = pool['root@vm1.example.com:22']
+    pool['root@vm2.example.com:22']
+    pool['root@vm1.example.com:22']
+    pool['root@vm3.example.com:22']
+    assert set(pool.keys()) == {'vm1', 'vm3'}
+    assert not vm1.closed
+
+def test_pool_idle_eviction(connects):
+    """Ensure connections idle beyond the timeout are closed."""
+    pool = ConnectionPool(key_fn=LABELS.get, idle_timeout=0)
+    vm1 = pool['root@vm1.example.com:22']
+    pool['root@vm2.example.com:22']
+    assert vm1.closed
+    assert list(pool.keys()) == ['vm2']
+
+def test_pool_unhealthy(connects):
+    """Ensure dead connections are replaced."""
+    pool = ConnectionPool(key_fn=LABELS.get, check_interval=0)
+    vm1 = pool['root@vm1.example.com:22']
+    vm1.transport.active = False
+    assert pool['root@vm1.example.com:22'] is not vm1
+    assert vm1.closed
+    assert connects == ['vm1.example.com', 'vm1.example.com']
+
+def test_pool_discard(connects):
+    """Ensure connections can be discarded by label."""
+    pool = ConnectionPool(key_fn=LABELS.get)
+    vm1 = pool['root@vm1.example.com:22']
+    pool.discard('vm1')
+    assert vm1.closed and 'vm1' not in pool
+
+def test_pool_reconnect_label(connects):
+    """Ensure evicted connections are reconnected by label to the host string used before."""
+    pool = ConnectionPool(key_fn=LABELS.get, idle_timeout=0)
+    pool['root@vm1.example.com:22']
+    pool.evict_idle()
+    assert 'vm1' not in pool
+    pool['vm1']
+    assert list(pool.keys()) == ['vm1']
+    assert connects == ['vm1.example.com', 'vm1.example.com']
+
+def test_pool_max_connections_fn(connects):
+    """Ensure the cap can be set at runtime, overriding 'max_connections'."""
+    limit = [None]
+    pool = ConnectionPool(key_fn=LABELS.get, max_connections=3,
+                          max_connections_fn=lambda: limit[0])
+    pool['root@vm1.example.com:22']
+    pool['root@vm2.example.com:22']
+    limit[0] = 1
+    pool['root@vm3.example.com:22']
+    assert list(pool.keys()) == ['vm3']
+
+def test_pool_close_all(connects):
+    """Ensure closing all connections does not reconnect dead ones first."""
+    pool = ConnectionPool(key_fn=LABELS.get, check_interval=0)
+    vm1 = pool['root@vm1.example.com:22']
+    vm2 = pool['root@vm2.example.com:22']
+    vm1.transport.active = False
+    pool.close_all()
+    assert vm1.closed and vm2.closed and not pool
+    assert connects == ['vm1.example.com', 'vm2.example.com']
+
+def test_pool_host_store(connects, tmp_path, monkeypatch):
+    """Ensure connections are recorded & hosts whose circuit is open are refused."""
+    store = HostStore(str(tmp_path / "hosts.sqlite"))
+    pool = ConnectionPool(
+        key_fn=LABELS.get, store_fn=lambda: store, breaker_fn=lambda: Breaker(2, 60))
+    pool['root@vm1.example.com:22']
+    vm1 = store.stats(['vm1'])['vm1']
+    assert vm1.successes == 1 and vm1.connect_latency is not None
+    assert (vm1.key_host, vm1.key_type, vm1.key) == ('vm1.example.com', 'ssh-ed25519', 'AAAA')
+
+    def failing_connect(user, host, port, cache, seek_gateway=True):
+        connects.append(host)
+        raise fabric.network.NetworkError("unreachable")
+    monkeypatch.setattr(fabric.network, 'connect', failing_connect)
+    for _ in range(2):
+        with pytest.raises(fabric.network.NetworkError):
+            pool['root@vm2.example.com:22']
+    with pytest.raises(HostUnavailableError):
+        pool['root@vm2.example.com:22']
+    assert connects == ['vm1.example.com', 'vm2.example.com', 'vm2.example.com']
+    assert store.stats(['vm2'])['vm2'].failures == 2
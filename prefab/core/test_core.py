@@ -0,0 +1,16 @@
+"""
+Tests the core prefab API.
+"""
+import sys
+import subprocess
+from os import path
+
+ROOT = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+
+def test_import_defers_fabric():
+    """Ensure importing prefab.core loads neither fabric nor voluptuous."""
+    out = subprocess.check_output([sys.executable, '-c', (
+        "import sys, prefab.core\n"
+        "print(sorted(m for m in ('fabric', 'paramiko', 'voluptuous') if m in sys.modules))")],
+        cwd=ROOT)
+    assert out.decode('utf-8').strip() == '[]'
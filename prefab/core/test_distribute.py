@@ -0,0 +1,148 @@
+"""
+Tests distributing files against an in-memory transport.
+"""
+import os
+import shlex
+import hashlib
+import subprocess
+import pytest
+from .test_aio import MemoryTransport, make_conf
+from . import distribute as dist
+from . import hoststore as hs
+
+class FileTransport(MemoryTransport):
+    """in-memory transport emulating the commands run to distribute files."""
+    def __init__(self, conf, broken=()):
+        super().__init__(self.handle)
+        self.addresses = {entry['address']: label for (label, entry) in conf['hosts'].items()}
+        self.broken = broken
+        self.relays = []
+        self.pinned = []
+
+    def handle(self, label, command):
+        if command.startswith('kh='):
+            # scp with a pinned host key: record the known_hosts line written
+            self.pinned.append(shlex.split(command)[4])
+            command = command.split(' && ')[-1].split(';')[0]
+        args = shlex.split(command)
+        if args[0] == 'sha256sum':
+            data = self.files.get((label, args[-1]))
+            if data is None:
+                return ("", "No such file or directory", 1)
+            return ("{}  {}".format(hashlib.sha256(data).hexdigest(), args[-1]), "", 0)
+        if args[0] == 'mv':
+            self.files[(label, args[-1])] = self.files.pop((label, args[-2]))
+        elif args[0] == 'rm':
+            self.files.pop((label, args[-1]), None)
+        elif args[0] == 'scp':
+            if label in self.broken:
+                return ("", "Permission denied (publickey)", 1)
+            (dest, dst_path) = args[-1].split('@')[1].split(':')
+            self.files[(self.addresses[dest], dst_path)] = self.files[(label, args[-2])]
+            self.relays.append((label, self.addresses[dest]))
+        return ("", "", 0)
+
+def test_distribute(tmp_path):
+    """Ensure the file is uploaded to hosts lacking it, skipping those holding it."""
+    local = tmp_path / "bundle.tgz"
+    local.write_bytes(b"bundle")
+    conf = make_conf(3)
+    transport = FileTransport(conf)
+    transport.files[('vm1', '/opt/bundle.tgz')] = b"bundle"
+    transport.files[('vm2', '/opt/bundle.tgz')] = b"stale"
+    results = dist.distribute(conf, str(local), "/opt/bundle.tgz", roles=['web'],
+                              transport=transport)
+    assert results == {
+        'vm0': dist.Delivery('uploaded', None),
+        'vm1': dist.Delivery('unchanged', None),
+        'vm2': dist.Delivery('uploaded', None)}
+    assert transport.files == {
+        (label, '/opt/bundle.tgz'): b"bundle" for label in ('vm0', 'vm1', 'vm2')}
+
+def test_distribute_fanout(tmp_path):
+    """Ensure hosts holding the file serve it to the others."""
+    local = tmp_path / "bundle.tgz"
+    local.write_bytes(b"bundle")
+    conf = make_conf(10)
+    transport = FileTransport(conf)
+    results = dist.distribute(conf, str(local), "/opt/bundle.tgz", roles=['web'], fanout=2,
+                              transport=transport)
+    relayed = [res.source for res in results.values() if res.status == 'relayed']
+    assert relayed and len(relayed) == len(transport.relays)
+    assert all(results[source].status != 'unchanged' for source in relayed)
+    assert sum(1 for res in results.values() if res.status == 'uploaded') == 10 - len(relayed)
+    assert all(transport.files[(label, '/opt/bundle.tgz')] == b"bundle" for label in results)
+
+def test_distribute_fanout_fallback(tmp_path):
+    """Ensure hosts which cannot be served by a peer are uploaded to instead."""
+    local = tmp_path / "bundle.tgz"
+    local.write_bytes(b"bundle")
+    conf = make_conf(4)
+    transport = FileTransport(conf, broken=('vm0',))
+    transport.files[('vm0', '/opt/bundle.tgz')] = b"bundle"
+    results = dist.distribute(conf, str(local), "/opt/bundle.tgz", roles=['web'], fanout=1,
+                              concurrency=1, transport=transport)
+    assert results['vm0'] == dist.Delivery('unchanged', None)
+    assert results['vm1'] == dist.Delivery('uploaded', None)
+    assert results['vm2'] == dist.Delivery('relayed', 'vm1')
+    assert results['vm3'] == dist.Delivery('relayed', 'vm2')
+    assert all(transport.files[(label, '/opt/bundle.tgz')] == b"bundle" for label in results)
+
+def test_distribute_mismatch(tmp_path):
+    """Ensure corrupted transfers are reported & removed."""
+    local = tmp_path / "bundle.tgz"
+    local.write_bytes(b"bundle")
+    conf = make_conf(1)
+    class Corrupting(FileTransport):
+        """transport truncating uploaded files."""
+        async def connect(self, label, host_entry):
+            conn = await super().connect(label, host_entry)
+            async def put(local_path, remote_path):
+                self.files[(label, remote_path)] = b"bund"
+            conn.put = put
+            return conn
+    transport = Corrupting(conf)
+    results = dist.distribute(conf, str(local), "/opt/bundle.tgz", hosts=['vm0'],
+                              transport=transport)
+    assert isinstance(results['vm0'], dist.ChecksumMismatchError)
+    assert transport.files == {}
+
+def test_distribute_host_keys(tmp_path):
+    """Ensure relays check host keys, pinning those recorded in the host store."""
+    local = tmp_path / "bundle.tgz"
+    local.write_bytes(b"bundle")
+    conf = make_conf(3)
+    store = hs.HostStore(str(tmp_path / "hosts.sqlite"))
+    for (label, entry) in conf['hosts'].items():
+        store.record_success(label, host_key=(
+            hs.known_host_name(entry['address'], entry['port']), 'ssh-ed25519', label))
+    transport = FileTransport(conf)
+    results = dist.distribute(conf, str(local), "/opt/bundle.tgz", roles=['web'], fanout=1,
+                              concurrency=1, transport=transport, store=store)
+    assert sorted(res.status for res in results.values()) == ['relayed', 'relayed', 'uploaded']
+    assert sorted(transport.pinned) == sorted(
+        "{} ssh-ed25519 {}".format(conf['hosts'][label]['address'], label)
+        for (label, res) in results.items() if res.status == 'relayed')
+    with pytest.raises(ValueError):
+        dist.distribute(conf, str(local), "/opt/bundle.tgz", hosts=['vm0'],
+                        transport=transport, host_key_checking='off')
+
+def test_scp_command(tmp_path):
+    """Ensure scp checks host keys, against a temporary known_hosts file if pinned."""
+    entry = {'user': 'root', 'address': 'vm1.example.com', 'port': 2222}
+    assert "StrictHostKeyChecking=yes" in dist._scp_command(entry, "/src", "/dst")
+    assert "StrictHostKeyChecking=accept-new" in dist._scp_command(
+        entry, "/src", "/dst", 'accept-new')
+    # stand-in scp printing the known_hosts file it is given
+    scp = tmp_path / "scp"
+    scp.write_text("#!/bin/sh\nfor arg; do case $arg in UserKnownHostsFile=*)"
+                   " cat \"${arg#UserKnownHostsFile=}\";; esac; done\nexit 3\n")
+    scp.chmod(0o755)
+    command = dist._scp_command(
+        entry, "/src", "/dst", 'no', known_host="[vm1.example.com]:2222 ssh-ed25519 AAAA")
+    assert "StrictHostKeyChecking=yes" in command
+    proc = subprocess.run(
+        ['/bin/sh', '-c', command], stdout=subprocess.PIPE, universal_newlines=True,
+        env=dict(os.environ, PATH="{}:{}".format(tmp_path, os.environ['PATH'])))
+    assert proc.stdout == "[vm1.example.com]:2222 ssh-ed25519 AAAA\n"
+    assert proc.returncode == 3
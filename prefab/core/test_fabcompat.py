@@ -2,10 +2,19 @@
 Tests ability derive fabric-specific data structures from
 prefab's configuration file.
 """
+import copy
 import pytest
+import fabric.api
+import fabric.state
 from prefab.test import data as testdata
-from .fabcompat import _compile_passwords, _compile_roledefs
+from .fabcompat import (
+    _compile_passwords, _compile_roledefs, LazyRoledefs, LazyPasswords, reload, rolling,
+    execute_iter, _pool_key, initialize)
+from .connpool import ConnectionPool
+from . import scheduler
+from . import hoststore
 from .config import confparse as cp
+from .config.core import parse_config
 
 def test_compile_roledefs():
     """test ability to compile a fabric-style roledefs datastructure."""
@@ -29,4 +38,192 @@ def test_compile_passwds():
     """test ability to compile a fabric-style password lookup dict."""
     assert _compile_passwords(testdata.config) == {
         cp.host_string(cp.host_entry(testdata.config, 'vm4')): 's3cr3t!'
-    }
\ No newline at end of file
+    }
+
+def test_lazy_roledefs():
+    """Ensure roles are compiled on first access & match the eager roledefs."""
+    roledefs = LazyRoledefs(testdata.config)
+    assert 'swarm-managers' in roledefs and 'bogus' not in roledefs
+    assert dict.__len__(roledefs) == 0
+    assert roledefs['swarm-managers']['hosts'] == [
+        cp.host_string(cp.host_entry(testdata.config, 'vm3'))]
+    assert dict.__len__(roledefs) == 1
+    with pytest.raises(KeyError):
+        roledefs['bogus']
+    roledefs['custom'] = {'hosts': []}
+    assert roledefs == {**_compile_roledefs(testdata.config), 'custom': {'hosts': []}}
+
+def test_lazy_passwords():
+    """Ensure passwords are looked up per host & match the eager passwords."""
+    passwords = LazyPasswords(testdata.config)
+    vm3, vm4 = (cp.host_string(cp.host_entry(testdata.config, lbl)) for lbl in ('vm3', 'vm4'))
+    assert passwords.get(vm3, 'default') == 'default'
+    assert passwords.get(vm4) == 's3cr3t!'
+    passwords[vm3] = 'prompted'
+    assert passwords == {**_compile_passwords(testdata.config), vm3: 'prompted'}
+
+@pytest.mark.parametrize("roles,valid", [({}, True), ({'web': {'hosts': []}}, False)])
+def test_initialize_plain_copy(monkeypatch, roles, valid):
+    """Ensure plain copies of parsed configs (holding host records) are validated as such."""
+    conf = parse_config({
+        'profiles': {'default': {'connection': {'method': 'password'}}},
+        'hosts': {'vm1': {'address': 'srv1', 'profile': 'default'}},
+        'roles': {}}, {'home': '/home/user', 'cwd': '/srv'})
+    plain = {**conf, 'roles': roles}
+    for key in ('__prefab_conf', 'roledefs', 'passwords'):
+        monkeypatch.setitem(fabric.api.env, key, None)
+    try:
+        if valid:
+            initialize(plain)
+            assert fabric.api.env['__prefab_conf'] is plain
+        else:
+            # reported as invalid, the config (host records & all) being printed
+            with pytest.raises(ValueError):
+                initialize(plain)
+    finally:
+        # forget the (run once) call
+        initialize.__dict__.clear()
+
+class FakeClient:
+    """stands in for a pooled SSH client."""
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+def test_reload(monkeypatch):
+    """Ensure reloading only invalidates state derived from changed entries."""
+    old = testdata.config
+    new = copy.deepcopy(old)
+    new['hosts']['vm3']['port'] = 2203
+    vm3, vm4 = (cp.host_string(cp.host_entry(old, lbl)) for lbl in ('vm3', 'vm4'))
+    roledefs, passwords = LazyRoledefs(old), LazyPasswords(old)
+    managers, workers = roledefs['swarm-managers'], roledefs['swarm-workers']
+    passwords[vm3] = 'prompted'
+    passwords.get(vm4)
+    pool = ConnectionPool()
+    clients = {label: FakeClient() for label in ('vm1', 'vm3')}
+    for (label, client) in clients.items():
+        dict.__setitem__(pool, label, client)
+    monkeypatch.setitem(fabric.api.env, '__prefab_conf', old)
+    monkeypatch.setitem(fabric.api.env, 'roledefs', roledefs)
+    monkeypatch.setitem(fabric.api.env, 'passwords', passwords)
+    monkeypatch.setattr(fabric.state, 'connections', pool)
+
+    changes = reload(new)
+    assert changes.hosts.changed == {'vm3'}
+    assert fabric.api.env['__prefab_conf'] is new
+    assert roledefs == _compile_roledefs(new)
+    assert roledefs['swarm-managers'] is not managers
+    assert roledefs['swarm-workers'] is not workers
+    assert vm3 not in passwords and passwords.get(vm4) == 's3cr3t!'
+    assert clients['vm3'].closed and not clients['vm1'].closed
+    assert 'vm1' in pool and 'vm3' not in pool
+
+def test_execute_rolling(monkeypatch):
+    """Ensure tasks decorated with @rolling run across their role in batches, ordered by label."""
+    batches = []
+    def fake_run(work_fn, hosts, pool_size, timeout=None, capture=False):
+        batches.append([cp.host_label(testdata.config, host) for host in hosts])
+        for host in hosts:
+            yield scheduler.HostResult(host, None, 0, None, None)
+    monkeypatch.setattr(scheduler, 'run', fake_run)
+    monkeypatch.setitem(fabric.api.env, '__prefab_conf', testdata.config)
+    monkeypatch.setitem(fabric.api.env, 'roledefs', LazyRoledefs(testdata.config))
+
+    @rolling(2)
+    @fabric.api.roles('swarm-workers')
+    def task():
+        pass
+    labels = [res.host for res in execute_iter(task)]
+    assert batches == [['vm1', 'vm2'], ['vm3']]
+    assert labels == ['vm1', 'vm2', 'vm3']
+
+def test_execute_serial_streams(monkeypatch, capfd):
+    """Ensure hosts run in turn stream their output (e.g. prompts) rather than capture it."""
+    monkeypatch.setitem(fabric.api.env, '__prefab_conf', testdata.config)
+    monkeypatch.setitem(fabric.api.env, 'roledefs', LazyRoledefs(testdata.config))
+
+    @fabric.api.roles('swarm-workers')
+    def task():
+        print("Password for {}: ".format(fabric.api.env.host_string))
+        assert "Password for" in capfd.readouterr().out
+    results = list(execute_iter(task))
+    assert len(results) == 3
+    assert all(res.error is None and res.output is None for res in results)
+
+def test_execute_host_store(monkeypatch, tmp_path):
+    """Ensure parallel runs order hosts by the host store, skipping hosts whose circuit is open."""
+    runs = []
+    def fake_run(work_fn, hosts, pool_size, timeout=None, capture=False):
+        runs.append([cp.host_label(testdata.config, host) for host in hosts])
+        for host in hosts:
+            yield scheduler.HostResult(host, None, 0, None, None)
+    store = hoststore.HostStore(str(tmp_path / "hosts.sqlite"))
+    store.record_success('vm1', connect=3.0)
+    store.record_success('vm3', connect=0.5)
+    for _ in range(3):
+        store.record_failure('vm2')
+    monkeypatch.setattr(scheduler, 'run', fake_run)
+    monkeypatch.setitem(fabric.api.env, '__prefab_conf', testdata.config)
+    monkeypatch.setitem(fabric.api.env, 'roledefs', LazyRoledefs(testdata.config))
+    monkeypatch.setitem(fabric.api.env, 'prefab_parallel', 3)
+    monkeypatch.setitem(fabric.api.env, 'prefab_host_store', store)
+    monkeypatch.setitem(fabric.api.env, 'prefab_known_hosts', str(tmp_path / "known_hosts"))
+    monkeypatch.setitem(fabric.api.env, 'prefab_breaker', hoststore.DEFAULT_BREAKER)
+
+    @fabric.api.roles('swarm-workers')
+    def task():
+        pass
+    results = {res.host: res for res in execute_iter(task)}
+    assert runs == [['vm3', 'vm1']]
+    assert isinstance(results['vm2'].error, hoststore.HostUnavailableError)
+
+def test_disconnect_all(monkeypatch):
+    """Ensure disconnect_all() closes pooled connections without reconnecting dead ones."""
+    import fabric.network
+    from . import api # pylint: disable=W0611 (installs the wrappers)
+    from .test_connpool import FakeClient, LABELS
+    connects = []
+    def fake_connect(user, host, port, cache, seek_gateway=True):
+        connects.append(host)
+        return FakeClient(host)
+    monkeypatch.setattr(fabric.network, 'connect', fake_connect)
+    pool = ConnectionPool(key_fn=LABELS.get, check_interval=0)
+    monkeypatch.setattr(fabric.state, 'connections', pool)
+    vm1 = pool['root@vm1.example.com:22']
+    vm1.transport.active = False
+    with fabric.api.hide('everything'):
+        fabric.network.disconnect_all()
+    assert vm1.closed and not pool
+    assert connects == ['vm1.example.com']
+
+def test_execute_serial_host_store(monkeypatch, tmp_path):
+    """Ensure serial runs skip hosts whose circuit is open as unreachable hosts."""
+    import fabric.network
+    from . import api
+    from .test_connpool import FakeClient
+    connects = []
+    def fake_connect(user, host, port, cache, seek_gateway=True):
+        connects.append(host)
+        return FakeClient(host)
+    monkeypatch.setattr(fabric.network, 'connect', fake_connect)
+    store = hoststore.HostStore(str(tmp_path / "hosts.sqlite"))
+    for _ in range(3):
+        store.record_failure('vm2')
+    monkeypatch.setattr(fabric.state, 'connections', ConnectionPool(
+        key_fn=_pool_key, store_fn=lambda: store, breaker_fn=lambda: hoststore.DEFAULT_BREAKER))
+    monkeypatch.setitem(fabric.api.env, '__prefab_conf', testdata.config)
+    monkeypatch.setitem(fabric.api.env, 'roledefs', LazyRoledefs(testdata.config))
+    monkeypatch.setitem(fabric.api.env, 'skip_bad_hosts', True)
+
+    @fabric.api.roles('swarm-workers')
+    def task():
+        return fabric.state.connections[fabric.api.env.host_string].host
+    with fabric.api.hide('everything'):
+        results = api.execute(task)
+    labels = {host_str: cp.host_label(testdata.config, host_str) for host_str in results}
+    assert sorted(labels.values()) == ['vm1', 'vm2', 'vm3']
+    by_label = {labels[host_str]: res for (host_str, res) in results.items()}
+    assert isinstance(by_label['vm2'], hoststore.HostUnavailableError)
+    assert len(connects) == 2
@@ -0,0 +1,126 @@
+"""
+Tests caching facts gathered from hosts.
+"""
+import multiprocessing
+import pytest
+import fabric.api
+from prefab.test import data as testdata
+from .config import confparse as cp
+from . import facts
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """fact cache in a temporary directory, used by @cached_fact."""
+    fact_cache = facts.FactCache(str(tmp_path / "facts.sqlite"), max_entries=3)
+    monkeypatch.setattr(facts, 'cache', fact_cache)
+    return fact_cache
+
+def test_cache_roundtrip(cache):
+    """Ensure stored facts are retrieved per host & command."""
+    assert cache.put('vm1', 'cat /etc/issue', "Debian\n")
+    assert cache.get('vm1', 'cat /etc/issue') == "Debian\n"
+    assert cache.get('vm2', 'cat /etc/issue') is None
+    assert cache.get('vm1', 'uname', default='miss') == 'miss'
+
+def test_cache_ttl(cache, monkeypatch):
+    """Ensure facts older than the TTL register as a miss."""
+    cache.put('vm1', 'uname', "Linux")
+    monkeypatch.setattr(facts, 'time', lambda: 2e10)
+    assert cache.get('vm1', 'uname', ttl=60) is None
+    assert cache.get('vm1', 'uname') == "Linux"
+
+def test_cache_lru(cache):
+    """Ensure the least recently used facts are evicted beyond 'max_entries'."""
+    for cmd in ('a', 'b', 'c'):
+        cache.put('vm1', cmd, cmd)
+    cache.get('vm1', 'a')
+    cache.put('vm1', 'd', 'd')
+    assert len(cache) == 3
+    assert cache.get('vm1', 'b') is None
+    assert cache.get('vm1', 'a') == 'a'
+
+def test_cache_unserializable(cache):
+    """Ensure results which cannot be stored are skipped."""
+    assert not cache.put('vm1', 'obj', object())
+    assert cache.get('vm1', 'obj') is None
+
+def test_cache_get_readonly(cache, monkeypatch):
+    """Ensure lookups do not write, uses being written in one go."""
+    cache.put('vm1', 'a', 1)
+    db = cache._conn()
+    (used,) = db.execute("SELECT used FROM facts").fetchone()
+    monkeypatch.setattr(facts, 'time', lambda: used + 60)
+    changes = db.total_changes
+    assert cache.get('vm1', 'a') == cache.get('vm1', 'a') == 1
+    assert db.total_changes == changes
+    cache.flush()
+    assert db.execute("SELECT used FROM facts").fetchone()[0] == used + 60
+    assert db.total_changes == changes + 1
+
+def test_cache_invalidate(cache):
+    """Ensure facts can be forgotten per host."""
+    cache.put('vm1', 'a', 1)
+    cache.put('vm2', 'a', 2)
+    cache.invalidate(label='vm1')
+    assert (cache.get('vm1', 'a'), cache.get('vm2', 'a')) == (None, 2)
+
+def test_cache_shared_with_forked(cache):
+    """Ensure facts stored by forked workers are seen by the parent."""
+    cache.get('vm1', 'a') # open the connection before forking
+    proc = multiprocessing.get_context('fork').Process(target=cache.put, args=('vm1', 'a', 1))
+    proc.start()
+    proc.join()
+    assert cache.get('vm1', 'a') == 1
+
+@pytest.fixture
+def on_host(monkeypatch):
+    """run as if executing a task against host 'vm1'."""
+    monkeypatch.setitem(fabric.api.env, '__prefab_conf', testdata.config)
+    monkeypatch.setitem(
+        fabric.api.env, 'host_string', cp.host_string(cp.host_entry(testdata.config, 'vm1')))
+    monkeypatch.setitem(fabric.api.env, 'prefab_refresh_facts', False)
+
+class Output(str):
+    """stands in for the output of run(), with its 'failed' attribute."""
+    failed = False
+
+def test_cached_fact(cache, on_host):
+    """Ensure decorated tasks run once per host & arguments until refreshed."""
+    calls = []
+    @facts.cached_fact(ttl=60)
+    def issue(flavor='short'):
+        calls.append(flavor)
+        return Output("Debian " + flavor)
+    assert issue() == issue() == "Debian short"
+    assert issue(flavor='long') == "Debian long"
+    assert calls == ['short', 'long']
+    assert cache.get('vm1', 'prefab.core.test_facts.test_cached_fact.<locals>.issue@{}'.format(
+        facts._source_digest(issue.__wrapped__))) == "Debian short"
+    fabric.api.env['prefab_refresh_facts'] = True
+    issue()
+    assert calls == ['short', 'long', 'short']
+
+def test_cached_fact_failed(cache, on_host):
+    """Ensure failed commands are not cached."""
+    calls = []
+    @facts.cached_fact(key='issue')
+    def issue():
+        calls.append(1)
+        out = Output("command not found")
+        out.failed = True
+        return out
+    issue()
+    issue()
+    assert len(calls) == 2
+
+def test_cached_fact_edited(cache, on_host):
+    """Ensure editing a fact's task invalidates its cached results."""
+    def issue():
+        return "Debian"
+    def edited():
+        return "Debian 12"
+    edited.__qualname__ = issue.__qualname__
+    assert facts.cached_fact()(issue)() == "Debian"
+    assert facts.cached_fact()(edited)() == "Debian 12"
+    assert facts.cached_fact()(issue)() == "Debian"
+    assert len(cache) == 2
@@ -0,0 +1,80 @@
+"""
+Tests the persistent host store.
+"""
+import pytest
+from prefab.test import data as testdata
+from .config import confparse as cp
+from . import hoststore as hs
+
+@pytest.fixture
+def store(tmp_path):
+    """host store in a temporary directory."""
+    return hs.HostStore(str(tmp_path / "hosts.sqlite"))
+
+def test_record(store):
+    """Ensure successes & failures are recorded per host, averaging latencies."""
+    store.record_success('vm1', connect=1.0, host_key=('vm1.example.com', 'ssh-ed25519', 'AAAA'))
+    store.record_success('vm1', connect=2.0, auth=0.5)
+    store.record_failure('vm1')
+    vm1 = store.stats(['vm1', 'vm2'])['vm1']
+    assert vm1.connect_latency == pytest.approx(1.3)
+    assert vm1.auth_latency == 0.5
+    assert (vm1.successes, vm1.failures, vm1.total_failures) == (2, 1, 1)
+    assert (vm1.key_host, vm1.key_type, vm1.key) == ('vm1.example.com', 'ssh-ed25519', 'AAAA')
+    store.record_many([('vm1', True, 1.3, None), ('vm2', False, None, None)])
+    stats = store.stats(['vm1', 'vm2'])
+    assert (stats['vm1'].failures, stats['vm1'].total_failures) == (0, 1)
+    assert stats['vm2'].failures == 1
+
+def test_order(store):
+    """Ensure hosts are ordered fastest first, unknown latency next & failing hosts last."""
+    store.record_success('slow', connect=2.0)
+    store.record_success('fast', connect=0.1)
+    store.record_failure('flaky')
+    store.record_failure('dead')
+    store.record_failure('dead')
+    labels = ['dead', 'flaky', 'new', 'slow', 'fast']
+    assert store.order(labels) == ['fast', 'slow', 'new', 'flaky', 'dead']
+    assert store.order(['x@dead', 'x@fast'], key=lambda host: host[2:]) == ['x@fast', 'x@dead']
+
+def test_unavailable(store):
+    """Ensure hosts failing repeatedly are skipped until the cooldown passed."""
+    for _ in range(3):
+        store.record_failure('dead')
+    store.record_failure('flaky')
+    breaker = hs.Breaker(threshold=3, cooldown=60)
+    last_failure = store.stats(['dead'])['dead'].last_failure
+    refused = store.unavailable(['dead', 'flaky', 'new'], breaker)
+    assert list(refused) == ['dead']
+    assert refused['dead'].failures == 3
+    assert store.unavailable(['dead'], breaker, now=last_failure + 61) == {}
+    assert store.unavailable(['dead'], None) == {}
+    store.record_success('dead')
+    assert store.unavailable(['dead'], breaker) == {}
+
+def test_write_known_hosts(store, tmp_path):
+    """Ensure host keys are exported for the hosts' current addresses."""
+    conf = testdata.config
+    vm1, vm2 = (cp.host_entry(conf, label) for label in ('vm1', 'vm2'))
+    store.record_success('vm1', host_key=(
+        hs.known_host_name(vm1['address'], vm1['port']), 'ssh-ed25519', 'AAAA1'))
+    store.record_success('vm2', host_key=('moved.example.com', 'ssh-ed25519', 'AAAA2'))
+    fpath = tmp_path / "known_hosts"
+    assert store.write_known_hosts(conf, str(fpath))
+    assert fpath.read_text() == "{} ssh-ed25519 AAAA1\n".format(
+        hs.known_host_name(vm1['address'], vm1['port']))
+    store.forget('vm1')
+    assert not store.write_known_hosts(conf, str(tmp_path / "none"))
+
+def test_known_host_name():
+    """Ensure non-standard ports are given in brackets, like OpenSSH does."""
+    assert hs.known_host_name('srv1', 22) == 'srv1'
+    assert hs.known_host_name('srv1', '2222') == '[srv1]:2222'
+
+def test_unusable_db(tmp_path):
+    """Ensure a database which cannot be opened is treated as empty."""
+    (tmp_path / "dir").mkdir()
+    store = hs.HostStore(str(tmp_path / "dir"))
+    store.record_failure('vm1')
+    assert store.stats(['vm1']) == {}
+    assert store.order(['b', 'a']) == ['b', 'a']
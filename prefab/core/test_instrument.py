@@ -0,0 +1,75 @@
+"""
+Tests timing instrumentation.
+"""
+import json
+import pytest
+from . import instrument, scheduler
+
+@pytest.fixture
+def recorder():
+    """a recorder subscribed for the duration of the test."""
+    rec = instrument.Recorder()
+    instrument.subscribe(rec)
+    yield rec
+    instrument.unsubscribe(rec)
+
+def test_span_disabled():
+    """Ensure spans record nothing without subscribers."""
+    assert not instrument.enabled()
+    with instrument.span('phase') as span:
+        pass
+    assert span.start is None
+
+def test_span(recorder):
+    """Ensure spans report phase, host & timings."""
+    with instrument.span('connect', host='vm1', detail='x'):
+        pass
+    (event,) = recorder.events
+    assert (event.phase, event.host, event.detail, event.error) == ('connect', 'vm1', 'x', None)
+    assert event.duration >= 0
+
+def test_span_error(recorder):
+    """Ensure exceptions are recorded & propagated."""
+    @instrument.span('command', host='vm1')
+    def fail():
+        raise ValueError("boom")
+    with pytest.raises(ValueError):
+        fail()
+    assert recorder.events[0].error == "ValueError: boom"
+
+def test_recorder_summary(recorder):
+    """Ensure events are aggregated per phase & host."""
+    for (host, duration) in [('vm1', 0.5), ('vm2', 2.0), ('vm1', 1.0)]:
+        instrument.record('execute', 0.0, duration, host=host)
+    instrument.record('config.load', 0.0, 0.1)
+    phases = recorder.phases()
+    assert list(phases) == ['execute', 'config.load']
+    assert phases['execute'] == (3, 3.5, 2.0, 'vm2', 0)
+    assert list(recorder.hosts()) == ['vm2', 'vm1']
+    summary = recorder.summary()
+    assert 'execute' in summary and '3.50s' in summary and '100.0ms' in summary
+
+def test_recorder_trace(recorder, tmp_path):
+    """Ensure the trace holds a complete event per phase & a named track per host."""
+    instrument.record('connect', 10.0, 0.25, host='vm1')
+    instrument.record('initialize', 9.0, 0.5)
+    fpath = str(tmp_path / "trace.json")
+    recorder.write_trace(fpath)
+    with open(fpath) as fp:
+        events = json.load(fp)['traceEvents']
+    assert events[0]['ts'] == 1e6 and events[0]['dur'] == 0.25e6
+    assert events[0]['args'] == {'host': 'vm1'}
+    assert events[1]['tid'] == 0
+    assert events[2] == {
+        'name': 'thread_name', 'ph': 'M', 'pid': events[0]['pid'],
+        'tid': events[0]['tid'], 'args': {'name': 'vm1'}}
+
+def test_worker_events(recorder):
+    """Ensure events raised in forked workers are replayed in the parent."""
+    def work(host):
+        with instrument.span('execute', host=host):
+            if host == 'h2':
+                raise ValueError(host)
+    list(scheduler.run(work, ['h1', 'h2'], 2))
+    assert sorted((e.host, e.error) for e in recorder.events) == [
+        ('h1', None), ('h2', 'ValueError: h2')]
@@ -0,0 +1,168 @@
+"""
+Tests probing hosts against local mock servers.
+"""
+import socket
+import threading
+import pytest
+import paramiko
+from .config.core import parse_config
+from .hoststore import HostStore
+from . import probe as pr
+
+VAR_ENV = {'home': '/home/user', 'cwd': '/srv'}
+
+class MockServer:
+    """TCP server on localhost, handing each connection to 'handle(sock)' in a thread."""
+    def __init__(self, handle):
+        self.handle = handle
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.conns = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.conns.append(conn)
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+        for conn in self.conns:
+            conn.close()
+
+@pytest.fixture
+def serve():
+    """start mock servers, stopping them after the test."""
+    servers = []
+    def start(handle):
+        server = MockServer(handle)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.close()
+
+def send_lines(*lines):
+    """connection handler sending 'lines', keeping the connection open."""
+    def handle(conn):
+        conn.sendall(b''.join(line + b'\r\n' for line in lines))
+        conn.recv(1)
+    return handle
+
+class AuthServer(paramiko.ServerInterface):
+    """SSH server accepting the password 'secret' for user 'probe'."""
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == ('probe', 'secret'):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+@pytest.fixture(scope='module')
+def host_key():
+    return paramiko.RSAKey.generate(1024)
+
+@pytest.fixture
+def ssh_server(serve, host_key):
+    """mock SSH server (see 'AuthServer')."""
+    transports = []
+    def handle(conn):
+        transport = paramiko.Transport(conn)
+        transports.append(transport)
+        transport.add_server_key(host_key)
+        try:
+            transport.start_server(server=AuthServer())
+        except (paramiko.SSHException, EOFError):
+            pass
+    yield serve(handle)
+    for transport in transports:
+        transport.close()
+
+def closed_port():
+    """a local port nothing listens on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def make_conf(ports, password='secret'):
+    """config of hosts 'vm<n>' at the local 'ports', all in role 'web'."""
+    return parse_config({
+        'hosts': {
+            'vm{}'.format(ndx): {
+                'address': '127.0.0.1', 'port': port, 'user': 'probe',
+                'method': 'password', 'password': password}
+            for (ndx, port) in enumerate(ports)},
+        'roles': {'web': ['vm{}'.format(ndx) for ndx in range(len(ports))]}
+    }, VAR_ENV)
+
+def test_probe_banner(serve):
+    """Ensure reachable SSH servers pass, skipping lines sent before the banner."""
+    plain = serve(send_lines(b'SSH-2.0-Mock'))
+    chatty = serve(send_lines(b'welcome', b'SSH-2.0-Chatty'))
+    conf = make_conf([plain.port, chatty.port])
+    results = pr.probe(conf, ['vm0', 'vm1'], timeout=2, auth=False)
+    assert [res.banner for res in results] == ['SSH-2.0-Mock', 'SSH-2.0-Chatty']
+    assert all(res.ok and set(res.latency) == {'tcp', 'banner'} for res in results)
+
+def test_probe_failures(serve):
+    """Ensure the failing stage of each host is reported."""
+    silent = serve(send_lines())
+    http = serve(lambda conn: (conn.sendall(b'HTTP/1.1 400 Bad Request\r\n'), conn.close()))
+    conf = make_conf([closed_port(), silent.port, http.port])
+    results = pr.probe(conf, ['vm0', 'vm1', 'vm2'], timeout=0.5, auth=False)
+    assert [(res.ok, res.failed) for res in results] == [
+        (False, 'tcp'), (False, 'banner'), (False, 'banner')]
+    assert 'timed out' in results[1].error
+    assert set(results[1].latency) == {'tcp'}
+
+def test_probe_host_store(serve, tmp_path):
+    """Ensure probing records the latency or failure of each host."""
+    store = HostStore(str(tmp_path / "hosts.sqlite"))
+    server = serve(send_lines(b'SSH-2.0-Mock'))
+    conf = make_conf([server.port, closed_port()])
+    pr.probe(conf, ['vm0', 'vm1'], timeout=2, auth=False, store=store)
+    stats = store.stats(['vm0', 'vm1'])
+    assert stats['vm0'].connect_latency is not None and stats['vm0'].failures == 0
+    assert stats['vm1'].failures == 1
+
+@pytest.mark.parametrize("password,ok", [('secret', True), ('wrong', False)])
+def test_probe_auth(ssh_server, password, ok):
+    """Ensure logging in with the configured password is checked."""
+    conf = make_conf([ssh_server.port], password=password)
+    res, = pr.probe(conf, ['vm0'], timeout=5)
+    assert res.banner.startswith('SSH-2.0-')
+    assert res.ok == ok
+    assert res.failed == (None if ok else 'auth')
+
+def test_select_hosts():
+    """Ensure hosts of the given roles are selected once each."""
+    conf = parse_config({
+        'hosts': {lbl: {'address': lbl, 'method': 'password'} for lbl in ('a', 'b', 'c')},
+        'roles': {'web': ['a', 'b'], 'db': ['b', 'c']}
+    }, VAR_ENV)
+    assert pr.select_hosts(conf, ['web', 'db']) == ['a', 'b', 'c']
+    assert pr.select_hosts(conf) == ['a', 'b', 'c']
+    with pytest.raises(KeyError):
+        pr.select_hosts(conf, ['nope'])
+
+def test_summarize():
+    """Ensure roles are summarized by latency percentiles of the hosts completing each stage."""
+    conf = make_conf([22] * 4)
+    results = [
+        pr.ProbeResult('vm{}'.format(ndx), True, None, None, 'SSH-2.0', {'tcp': ndx / 100})
+        for ndx in range(3)
+    ] + [pr.ProbeResult('vm3', False, 'tcp', 'refused', None, {})]
+    web, total = pr.summarize(conf, results)
+    assert (web.role, web.hosts, web.ok) == ('web', 4, 3)
+    assert web.latency == {'tcp': (0.01, 0.02, 0.02)}
+    assert total.role == '*'
+    assert 'vm3' in pr.format_report(conf, results)
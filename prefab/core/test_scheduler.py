@@ -0,0 +1,155 @@
+"""
+Tests the process-based host scheduler.
+"""
+import os
+import sys
+import time
+import multiprocessing
+import pytest
+from . import scheduler
+
+def test_run_results():
+    """Ensure each host yields its result."""
+    hosts = ['h1', 'h2', 'h3']
+    results = {res.host: res for res in scheduler.run(lambda h: h.upper(), hosts, 2)}
+    assert {h: r.result for (h, r) in results.items()} == {'h1': 'H1', 'h2': 'H2', 'h3': 'H3'}
+    assert all(r.error is None and r.duration >= 0 for r in results.values())
+
+def test_run_streams_in_completion_order():
+    """Ensure fast hosts are reported before slow ones."""
+    def work(host):
+        time.sleep(host)
+        return host
+    order = [res.host for res in scheduler.run(work, [0.4, 0.0], 2)]
+    assert order == [0.0, 0.4]
+
+@pytest.mark.parametrize("pool_size", [1, 3])
+def test_run_bounded(pool_size):
+    """Ensure at most 'pool_size' hosts are processed concurrently."""
+    active = multiprocessing.Value('i', 0)
+    peak = multiprocessing.Value('i', 0)
+    def work(_):
+        with active.get_lock():
+            active.value += 1
+            peak.value = max(peak.value, active.value)
+        time.sleep(0.05)
+        with active.get_lock():
+            active.value -= 1
+    list(scheduler.run(work, range(8), pool_size))
+    assert peak.value <= pool_size
+
+@pytest.mark.parametrize("exc", [ValueError("boom"), SystemExit(1)])
+def test_run_error(exc):
+    """Ensure exceptions are reported as the host's error."""
+    def work(_):
+        raise exc
+    [res] = scheduler.run(work, ['h1'], 1)
+    assert type(res.error) is type(exc)
+    assert res.result is None
+
+def test_run_unpicklable_result():
+    """Ensure results which cannot be sent back are reported as errors."""
+    [res] = scheduler.run(lambda _: (lambda: None), ['h1'], 1)
+    assert isinstance(res.error, scheduler.RemoteError)
+
+def test_run_timeout():
+    """Ensure hosts exceeding the timeout are terminated & reported."""
+    def work(host):
+        time.sleep(host)
+        return host
+    results = {res.host: res for res in scheduler.run(work, [0.0, 5], 2, timeout=0.3)}
+    assert results[0.0].result == 0.0
+    assert isinstance(results[5].error, scheduler.HostTimeoutError)
+    assert results[5].duration < 5
+
+def emit(host):
+    """write to stdout from python & a subprocess, and to stderr."""
+    print("py", host)
+    os.system("echo sub {}".format(host))
+    sys.stderr.write("err {}\n".format(host))
+    return host
+
+@pytest.mark.parametrize("run", [
+    lambda fn, hosts: scheduler.run(fn, hosts, 2, capture=True),
+    lambda fn, hosts: scheduler.run_serial(fn, hosts, capture=True),
+])
+def test_capture(run, capfd):
+    """Ensure output is buffered per host instead of being written out."""
+    results = {res.host: res for res in run(emit, ['h1', 'h2'])}
+    assert results['h1'].output == "py h1\nsub h1\nerr h1\n"
+    assert results['h2'].output == "py h2\nsub h2\nerr h2\n"
+    out, err = capfd.readouterr()
+    assert 'h1' not in out + err
+
+def test_capture_timeout():
+    """Ensure output produced before a timeout is retained."""
+    def work(host):
+        print("started", flush=True)
+        time.sleep(5)
+    [res] = scheduler.run(work, ['h1'], 1, timeout=0.3, capture=True)
+    assert res.output == "started\n"
+
+def test_run_serial():
+    """Ensure hosts are run in turn & errors are reported per host."""
+    def work(host):
+        if host == 'h2':
+            raise ValueError(host)
+        return host.upper()
+    results = list(scheduler.run_serial(work, ['h1', 'h2', 'h3']))
+    assert [res.host for res in results] == ['h1', 'h2', 'h3']
+    assert [res.result for res in results] == ['H1', None, 'H3']
+    assert isinstance(results[1].error, ValueError)
+    assert results[0].output is None
+
+def fake_batches(failing=()):
+    """'run_batch' recording the batches run, hosts in 'failing' fail."""
+    batches = []
+    def run_batch(batch):
+        batches.append(list(batch))
+        for host in batch:
+            error = ValueError(host) if host in failing else None
+            yield scheduler.HostResult(host, host, 0, error, None)
+    return batches, run_batch
+
+def test_run_rolling_batches():
+    """Ensure hosts run in consecutive batches, in order."""
+    batches, run_batch = fake_batches()
+    results = list(scheduler.run_rolling(run_batch, range(7), 3))
+    assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+    assert [res.host for res in results] == list(range(7))
+
+@pytest.mark.parametrize("max_failures,n_batches", [(0, 2), (1, 3)])
+def test_run_rolling_abort(max_failures, n_batches):
+    """Ensure remaining batches are skipped once more than 'max_failures' hosts failed."""
+    batches, run_batch = fake_batches(failing={2, 5})
+    results = list(scheduler.run_rolling(run_batch, range(8), 2, max_failures))
+    assert len(batches) == n_batches
+    skipped = [res.host for res in results if isinstance(res.error, scheduler.BatchAbortedError)]
+    assert skipped == list(range(2 * n_batches, 8))
+
+def test_run_rolling_pause(monkeypatch):
+    """Ensure the scheduler pauses between (not after) batches."""
+    pauses = []
+    monkeypatch.setattr(scheduler, 'sleep', pauses.append)
+    _, run_batch = fake_batches()
+    list(scheduler.run_rolling(run_batch, range(5), 2, pause=1.5))
+    assert pauses == [1.5, 1.5]
+
+@pytest.mark.parametrize("spec,total,size", [(3, 10, 3), ('25%', 10, 3), ('1%', 10, 1), ('100%', 7, 7)])
+def test_batch_size(spec, total, size):
+    """Ensure batch sizes resolve counts & percentages (rounding up)."""
+    assert scheduler.batch_size(spec, total) == size
+
+@pytest.mark.parametrize("kwargs", [
+    {'batch': 0}, {'batch': '0%'}, {'batch': '150%'}, {'batch': 'x'}, {'batch': 1.5},
+    {'batch': 1, 'max_failures': -1}, {'batch': 1, 'pause': -1}, {'batch': 1, 'order': 'random'},
+])
+def test_rolling_settings_invalid(kwargs):
+    """Ensure invalid rolling settings are rejected."""
+    with pytest.raises(ValueError):
+        scheduler.rolling_settings(**kwargs)
+
+def test_natural_key():
+    """Ensure labels are ordered by their numeric parts."""
+    labels = ['vm10', 'vm2', 'db1', 'vm1']
+    assert sorted(labels, key=scheduler.natural_key) == ['db1', 'vm1', 'vm2', 'vm10']
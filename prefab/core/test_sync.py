@@ -0,0 +1,145 @@
+"""
+Tests delta-syncing trees, running the host side locally.
+"""
+import os
+import random
+import shutil
+import asyncio
+import pytest
+from .test_aio import make_conf
+from . import aio
+from . import sync as sy
+
+class LocalConnection(aio.Connection):
+    """connection running commands on the local machine."""
+    async def execute(self, command, stdin=None):
+        proc = await asyncio.create_subprocess_shell(
+            command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate(stdin.encode('utf-8') if stdin else b'')
+        return stdout.decode('utf-8'), stderr.decode('utf-8'), proc.returncode
+
+    async def put(self, local_path, remote_path):
+        shutil.copyfile(local_path, remote_path)
+
+    async def close(self):
+        pass
+
+class LocalTransport(aio.Transport):
+    """transport treating the local machine as each host."""
+    def __init__(self):
+        self.connects = 0
+
+    async def connect(self, label, host_entry):
+        self.connects += 1
+        return LocalConnection()
+
+def apply_ops(old, ops, block_size):
+    """rebuild a file from 'old' & delta 'ops'."""
+    return b''.join(
+        old[op[0] * block_size:(op[0] + op[1]) * block_size] if isinstance(op, list) else op
+        for op in ops)
+
+def blocks_of(data, block_size):
+    """checksums of the full blocks of 'data', as reported by hosts."""
+    return [
+        (sy.weak_checksum(data[pos:pos + block_size]),
+         sy._strong_checksum(data[pos:pos + block_size]))
+        for pos in range(0, len(data) - block_size + 1, block_size)]
+
+@pytest.mark.parametrize("edit", ['insert', 'delete', 'replace', 'none'])
+def test_delta(edit):
+    """Ensure deltas rebuild the new file, sending little more than the edit."""
+    rnd = random.Random(edit)
+    old = bytes(rnd.getrandbits(8) for _ in range(64 * 1024))
+    new = {
+        'insert': old[:10000] + b"inserted" + old[10000:],
+        'delete': old[:10000] + old[10100:],
+        'replace': old[:10000] + b"x" * 100 + old[10100:],
+        'none': old,
+    }[edit]
+    ops = sy.delta(new, blocks_of(old, 512), 512)
+    assert apply_ops(old, ops, 512) == new
+    assert sum(len(op) for op in ops if not isinstance(op, list)) <= 1024
+
+def test_delta_rolling_checksum():
+    """Ensure the rolled checksum equals the checksum of the shifted window."""
+    rnd = random.Random(0)
+    data = bytes(rnd.getrandbits(8) for _ in range(1024))
+    ops = sy.delta(data[7:], blocks_of(data, 64), 64)
+    assert [op for op in ops if isinstance(op, list)] == [[1, 15]]
+
+@pytest.fixture
+def trees(tmp_path):
+    """(local tree, remote directory, manifests)."""
+    local = tmp_path / "local"
+    (local / "conf.d").mkdir(parents=True)
+    (local / "app.conf").write_bytes(b"".join(b"setting%d = %d\n" % (n, n) for n in range(2000)))
+    (local / "conf.d" / "extra.conf").write_text("extra = 1\n")
+    return local, str(tmp_path / "remote"), sy.Manifests(str(tmp_path / "manifests"))
+
+def run_sync(trees, transport, **kwargs):
+    """sync the local tree to host 'vm0', returning its 'Synced'."""
+    (local, remote, manifests) = trees
+    return sy.sync(make_conf(1), str(local), remote, hosts=['vm0'], block_size=256,
+                   manifests=manifests, transport=transport, **kwargs)['vm0']
+
+def read_tree(root):
+    """relative path => content of the files of the tree at 'root'."""
+    return {
+        os.path.relpath(os.path.join(dirpath, fname), root): open(
+            os.path.join(dirpath, fname), 'rb').read()
+        for (dirpath, _, fnames) in os.walk(root) for fname in fnames}
+
+def test_sync(trees):
+    """Ensure trees are synced, repeat syncs only sending changes."""
+    (local, remote, _) = trees
+    transport = LocalTransport()
+    res = run_sync(trees, transport)
+    assert sorted(res.files) == ['app.conf', 'conf.d/extra.conf']
+    assert read_tree(remote) == read_tree(str(local))
+
+    # unchanged: the host is not contacted
+    assert run_sync(trees, transport) == sy.Synced([], [], 0, 0)
+    assert transport.connects == 1
+
+    # edits: only the changed blocks are sent
+    app = local / "app.conf"
+    app.write_bytes(app.read_bytes().replace(b"setting1000 = 1000", b"setting1000 = 42"))
+    os.chmod(str(local / "conf.d" / "extra.conf"), 0o600)
+    res = run_sync(trees, transport)
+    assert sorted(res.files) == ['app.conf', 'conf.d/extra.conf']
+    assert res.literal < 600 and res.matched > 30000
+    assert read_tree(remote) == read_tree(str(local))
+    assert os.stat(os.path.join(remote, "conf.d", "extra.conf")).st_mode & 0o777 == 0o600
+
+def test_sync_delete(trees):
+    """Ensure files removed locally are removed from hosts with 'delete'."""
+    (local, remote, _) = trees
+    transport = LocalTransport()
+    run_sync(trees, transport)
+    os.remove(str(local / "conf.d" / "extra.conf"))
+    assert run_sync(trees, transport).deleted == []
+    assert os.path.exists(os.path.join(remote, "conf.d", "extra.conf"))
+    assert run_sync(trees, transport, delete=True).deleted == ['conf.d/extra.conf']
+    assert read_tree(remote) == read_tree(str(local))
+
+def test_sync_full(trees):
+    """Ensure 'full' syncs repair files changed on the host, skipping matching ones."""
+    (local, remote, _) = trees
+    transport = LocalTransport()
+    run_sync(trees, transport)
+    with open(os.path.join(remote, "app.conf"), 'ab') as fobj:
+        fobj.write(b"tampered\n")
+    assert run_sync(trees, transport).files == []
+    res = run_sync(trees, transport, full=True)
+    assert res.files == ['app.conf']
+    assert read_tree(remote) == read_tree(str(local))
+
+def test_manifests(tmp_path):
+    """Ensure manifests are kept per host label & remote directory."""
+    manifests = sy.Manifests(str(tmp_path))
+    manifests.store('web/1', '/etc/app', {'a': [1, 2, 0o644, 'x']})
+    manifests.store('web/1', '/etc/other', {})
+    assert manifests.load('web/1', '/etc/app') == {'a': [1, 2, 0o644, 'x']}
+    assert manifests.load('web/2', '/etc/app') == {}
@@ -1 +1,2 @@
 from .core import *
+from .compiler import CompiledSchema, compile_schema
@@ -0,0 +1,296 @@
+"""
+Compile voluptuous schemas into specialized validator functions.
+
+voluptuous validates by raising & catching exceptions at every level -
+each element checked by 'seqof' & 'dictof' passes through a Schema call,
+every 'Any' tries its alternatives by catching the errors of those which
+fail. On large configurations, this control flow dominates validation.
+
+'compile_schema' walks a schema once, producing a tree of functions
+'fn(data) => (value, errors)' which return errors rather than raising
+them: 'errors' is None on success, otherwise a list of 'Invalid' errors
+(with paths relative to 'data'). Each element is validated exactly once &
+errors are reported as voluptuous does: 'Any' reports the alternative
+which got the furthest, errors of 'seqof' & 'dictof' elements are nested
+(one 'MultipleInvalid' per element) and missing keys are reported in
+voluptuous' order - the compiled schema raises the same errors as the
+schema it was compiled from.
+
+Supported are Schema objects (over mappings keyed on literal values,
+optionally marked Required/Optional), All, Any, types, literal values,
+'seqof', 'dictof' and 'pred' - other callables (e.g. Range, Length) are
+called as-is, they only raise on failure. Anything else is validated by
+voluptuous itself.
+"""
+import inspect
+from collections.abc import Mapping
+from voluptuous import Schema, All, Any, Required, Optional, ALLOW_EXTRA, PREVENT_EXTRA
+from voluptuous.schema_builder import Undefined, primitive_types
+from voluptuous.error import (
+    Invalid, MultipleInvalid, TypeInvalid, ValueInvalid, ScalarInvalid, DictInvalid,
+    RequiredFieldInvalid, AnyInvalid, AllInvalid)
+from .core import KeyInvalid, MappingSchema
+
+class CompiledSchema:
+    """Validator compiled from a (voluptuous) schema, see 'compile_schema'.
+
+    Called with data, returns the validated data or raises 'MultipleInvalid'
+    - as would the schema it was compiled from."""
+    __slots__ = ('schema', 'validate')
+
+    def __init__(self, schema):
+        self.schema = schema
+        # fn(data) => (value, errors), errors being None on success
+        self.validate = _compile(schema)
+
+    def __call__(self, data):
+        value, errors = self.validate(data)
+        if errors:
+            raise MultipleInvalid(errors)
+        return value
+
+    def __repr__(self):
+        return "CompiledSchema({!r})".format(self.schema)
+
+def compile_schema(schema):
+    """Compile 'schema' into a specialized validator (see 'CompiledSchema')."""
+    return CompiledSchema(schema)
+
+def _errors(exc):
+    """list of the errors making up 'exc'."""
+    if isinstance(exc, MultipleInvalid):
+        return list(exc.errors)
+    return [exc]
+
+def _element_error(errors):
+    """error of a 'seqof'/'dictof' element failing with 'errors'.
+
+    Elements are validated by a Schema of their own, which voluptuous
+    reports as one (nested) 'MultipleInvalid'."""
+    return MultipleInvalid(errors)
+
+def _compile(node, extra=PREVENT_EXTRA, required=False):
+    """compile 'node' of a schema.
+
+    extra, required - policies of the enclosing Schema, apply to plain mappings."""
+    if isinstance(node, CompiledSchema):
+        return node.validate
+    if isinstance(node, MappingSchema):
+        return _compile_as_dict(_compile(node.schema, node.extra, node.required))
+    if isinstance(node, Schema):
+        return _compile(node.schema, node.extra, node.required)
+    if isinstance(node, dict):
+        return _compile_mapping(node, extra, required)
+    if isinstance(node, (All, Any)) and node.discriminant is None:
+        funcs = [_compile(sub, extra, node.required) for sub in node.validators]
+        return (_compile_all if isinstance(node, All) else _compile_any)(funcs, node.msg)
+    if hasattr(node, 'seqof'):
+        return _compile_seqof(_compile(node.seqof))
+    if hasattr(node, 'dictof'):
+        key_validator, value_validator = node.dictof
+        return _compile_dictof(_compile(key_validator), _compile(value_validator))
+    if hasattr(node, 'pred'):
+        return _compile_pred(*node.pred)
+    if inspect.isclass(node):
+        return _compile_type(node)
+    if callable(node):
+        return _compile_callable(node)
+    if node is None or type(node) in primitive_types:
+        return _compile_value(node)
+    return _compile_callable(Schema(node, extra=extra, required=required))
+
+def _compile_as_dict(validate):
+    """validator passing mappings other than dicts to 'validate' as dicts (see 'MappingSchema')."""
+    def validate_as_dict(data):
+        if isinstance(data, Mapping) and not isinstance(data, dict):
+            data = dict(data)
+        return validate(data)
+    return validate_as_dict
+
+def _compile_type(cls):
+    """validator accepting instances of 'cls'."""
+    msg = "expected {}".format(cls.__name__)
+    def validate_type(data):
+        if isinstance(data, cls):
+            return data, None
+        return None, [TypeInvalid(msg)]
+    return validate_type
+
+def _compile_value(literal):
+    """validator accepting values equal to 'literal'."""
+    def validate_value(data):
+        if data == literal:
+            return data, None
+        return None, [ScalarInvalid('not a valid value')]
+    return validate_value
+
+def _compile_callable(fn):
+    """validator calling 'fn', which raises 'Invalid' (or ValueError) on failure."""
+    def validate_callable(data):
+        try:
+            return fn(data), None
+        except ValueError:
+            return None, [ValueInvalid('not a valid value')]
+        except Invalid as exc:
+            return None, _errors(exc)
+    return validate_callable
+
+def _compile_pred(predfn, msg):
+    """validator accepting values satisfying 'predfn' (see 'pred')."""
+    def validate_pred(data):
+        if predfn(data):
+            return data, None
+        return None, [ValueInvalid(msg)]
+    return validate_pred
+
+def _compile_all(funcs, msg):
+    """validator passing data through each of 'funcs' in turn (see 'All')."""
+    def validate_all(data):
+        for fn in funcs:
+            data, errors = fn(data)
+            if errors:
+                return None, errors if msg is None else [AllInvalid(msg)]
+        return data, None
+    return validate_all
+
+def _compile_any(funcs, msg):
+    """validator returning the result of the first of 'funcs' to succeed (see 'Any').
+
+    On failure, reports the errors of the alternative which got the
+    furthest (the deepest error path), as does voluptuous."""
+    def validate_any(data):
+        best = None
+        for fn in funcs:
+            value, errors = fn(data)
+            if not errors:
+                return value, None
+            if best is None or len(errors[0].path) > len(best[0].path):
+                best = errors
+        if msg is not None or best is None:
+            return None, [AnyInvalid(msg or 'no valid value found')]
+        return None, best
+    return validate_any
+
+def _compile_seqof(validate_elem):
+    """validator of sequences, each element validated by 'validate_elem' (see 'seqof')."""
+    def validate_seq(data):
+        if not isinstance(data, (tuple, list)):
+            return None, [Invalid("expected sequence")]
+        result, errors = [], None
+        for ndx, elem in enumerate(data):
+            value, elem_errors = validate_elem(elem)
+            if elem_errors:
+                err = _element_error(elem_errors)
+                err.prepend([ndx])
+                errors = (errors or []) + [err]
+            else:
+                result.append(value)
+        if errors:
+            return None, errors
+        if isinstance(data, tuple):
+            return tuple(result), None
+        return result, None
+    return validate_seq
+
+def _compile_dictof(validate_key, validate_value):
+    """validator of mappings (yielding dicts), keys & values validated by 'validate_key' & 'validate_value' (see 'dictof')."""
+    def validate_dict(data):
+        if not isinstance(data, Mapping):
+            return None, [DictInvalid("expected dict")]
+        result, errors = {}, None
+        for (k, v) in data.items():
+            key, key_errors = validate_key(k)
+            value, value_errors = validate_value(v)
+            if not (key_errors or value_errors):
+                result[key] = value
+                continue
+            errors = errors or []
+            if key_errors:
+                # wrap in KeyInvalid to aid distinction between key- and value errors
+                err = KeyInvalid(key_errors[0].msg)
+                err.__cause__ = key_errors[0]
+                errors.append(err)
+            if value_errors:
+                err = _element_error(value_errors)
+                err.prepend([k])
+                errors.append(err)
+        if errors:
+            return None, errors
+        return result, None
+    return validate_dict
+
+def _compile_mapping(schema, extra, required):
+    """validator of dicts against a mapping schema, keys being literal values (or markers thereof).
+
+    Falls back to voluptuous for schemas using other kinds of keys."""
+    fields = {}
+    for (skey, svalue) in schema.items():
+        if type(skey) in (Required, Optional):
+            key = skey.schema
+        else:
+            key = skey
+        if type(key) not in primitive_types:
+            return _compile_callable(Schema(schema, extra=extra, required=required))
+        is_required = (
+            isinstance(skey, Required) or (required and not isinstance(skey, Optional)))
+        default = getattr(skey, 'default', None)
+        if isinstance(default, Undefined):
+            default = None
+        fields[key] = (skey, _compile(svalue, extra, required), is_required, default)
+    # keys absent from data are handled in the order voluptuous does: it iterates
+    # sets of the schema keys (built alike), filling in defaults first
+    def key_of(skey):
+        return skey.schema if type(skey) in (Required, Optional) else skey
+    defaults = [
+        key_of(skey) for skey in set(skey for skey in schema if type(skey) in (Required, Optional))
+        if fields[key_of(skey)][3] is not None]
+    missing = [
+        (key_of(skey), skey) for skey in set(skey for skey in schema if fields[key_of(skey)][2])
+        if fields[key_of(skey)][3] is None]
+
+    def validate_mapping(data):
+        if not isinstance(data, dict):
+            return None, [DictInvalid('expected a dictionary')]
+        out, errors, present = data.__class__(), None, 0
+        for (key, value) in data.items():
+            field = fields.get(key)
+            if field is None:
+                if extra == ALLOW_EXTRA:
+                    out[key] = value
+                elif extra == PREVENT_EXTRA:
+                    errors = (errors or []) + [Invalid('extra keys not allowed', [key])]
+                continue
+            present += 1
+            value, value_errors = field[1](value)
+            if value_errors:
+                for err in value_errors:
+                    if not err.path:
+                        err.error_type = 'dictionary value'
+                    err.prepend([key])
+                errors = (errors or []) + value_errors
+            else:
+                out[key] = value
+        if present < len(fields):
+            # fill in defaults & report missing required keys
+            for key in defaults:
+                if key in data:
+                    continue
+                (_, validate_field, _, default) = fields[key]
+                value, value_errors = validate_field(default())
+                if value_errors:
+                    for err in value_errors:
+                        if not err.path:
+                            err.error_type = 'dictionary value'
+                        err.prepend([key])
+                    errors = (errors or []) + value_errors
+                else:
+                    out[key] = value
+            for (key, skey) in missing:
+                if key in data:
+                    continue
+                msg = getattr(skey, 'msg', None) or 'required key not provided'
+                errors = (errors or []) + [RequiredFieldInvalid(msg, [skey])]
+        if errors:
+            return None, errors
+        return out, None
+    return validate_mapping
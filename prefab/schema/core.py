@@ -1,6 +1,7 @@
 """
 Core functionality for augmenting voluptuous schemas.
 """
+from collections.abc import Mapping
 from voluptuous.error import MultipleInvalid, Invalid, DictInvalid, ValueInvalid
 from voluptuous import Schema, All, Length, ALLOW_EXTRA
 from voluptuous.humanize import humanize_error
@@ -16,19 +17,22 @@ def seqof(validator):
     def __inner(input):
         if not isinstance(input, (tuple, list)):
             raise Invalid("expected sequence")
-        errs = MultipleInvalid()
+        errs = None
         result = []
         for ndx, elem in enumerate(input):
             try:
                 result.append(validator(elem))
             except Invalid as exc:
-                exc.path.append(ndx)
+                exc.prepend([ndx])
+                errs = errs or MultipleInvalid()
                 errs.add(exc)
-        if errs.errors:
+        if errs is not None:
             raise errs
         if isinstance(input, tuple):
             result = tuple(result)
         return result
+    # introspected by 'compile_schema'
+    __inner.seqof = validator
     return __inner
 
 def non_empty(schema):
@@ -38,8 +42,17 @@ def non_empty(schema):
     """
     return All(schema, Length(min=1))
 
+class MappingSchema(Schema):
+    """Schema of a mapping (see 'mapping'), also accepting read-only mappings (e.g. host records).
+
+    Mappings other than dicts are validated (& returned) as dicts."""
+    def __call__(self, data):
+        if isinstance(data, Mapping) and not isinstance(data, dict):
+            data = dict(data)
+        return super().__call__(data)
+
 def mapping(dct, **kwargs):
-    """Map keys to values, yielding a schema with which to check dictionaries.
+    """Map keys to values, yielding a schema with which to check dictionaries (or other mappings).
 
     NOTE: use because the default strategy in voluptuous (error'ing)
     """
@@ -49,7 +62,7 @@ def mapping(dct, **kwargs):
         raise ValueError(
             "you MUST not use the 'extra' keyword - these "
             "policies lead to errors and ruin schema composition")
-    return Schema(dct, **kwargs, extra=ALLOW_EXTRA)
+    return MappingSchema(dct, **kwargs, extra=ALLOW_EXTRA)
 
 def __schema_validate(validator, val):
     try:
@@ -70,7 +83,7 @@ def __wrap_err(WrapperType, err):
     return wrapped
 
 def dictof(key_validator, value_validator):
-    """Validate entries against key & value validators
+    """Validate entries against key & value validators, yielding a dict (of any mapping).
     
     NOTE: while callables can be validators, know that they must raise
     an 'Invalid' exception to register as failed."""
@@ -80,27 +93,30 @@ def dictof(key_validator, value_validator):
         value_validator = Schema(value_validator)
 
     def __inner(dct):
-        if not isinstance(dct, dict):
+        if not isinstance(dct, Mapping):
             raise DictInvalid("expected dict")
-        errs = MultipleInvalid()
+        errs = None
         result = {}
         for k, v in dct.items():
             key, key_err = __schema_validate(key_validator, k)
             val, val_err = __schema_validate(value_validator, v)
             if not (key_err or val_err):
-                result[key_validator(key)] = value_validator(val)
+                result[key] = val
             else:
+                errs = errs or MultipleInvalid()
                 if key_err:
                     # wrap in KeyInvalid to aid distinction
                     # between key- and value errors
                     err = __wrap_err(KeyInvalid, key_err)
                     errs.add(err)
                 if val_err:
-                    val_err.path.append(k)
+                    val_err.prepend([k])
                     errs.add(val_err)
-        if errs.errors:
+        if errs is not None:
             raise errs
         return result
+    # introspected by 'compile_schema'
+    __inner.dictof = (key_validator, value_validator)
     return __inner
 
 def pred(predfn, msg=None):
@@ -110,6 +126,8 @@ def pred(predfn, msg=None):
         if not predfn(val):
             raise ValueInvalid(msg)
         return val
+    # introspected by 'compile_schema'
+    _inner.pred = (predfn, msg)
     return _inner
 
 def valid(schema, data):
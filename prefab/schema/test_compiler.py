@@ -0,0 +1,131 @@
+"""
+Tests compiling schemas into specialized validators.
+"""
+import random
+import pytest
+import voluptuous as v
+from voluptuous.error import MultipleInvalid
+from .core import seqof, dictof, pred, mapping, non_empty, KeyInvalid
+from .compiler import compile_schema
+
+def errors_of(schema, data):
+    """sorted descriptions of the errors raised validating 'data'."""
+    with pytest.raises(MultipleInvalid) as exc:
+        schema(data)
+    return sorted(str(err) for err in exc.value.errors)
+
+host = mapping({
+    v.Required('address'): str,
+    v.Required('port', default=22): v.All(int, v.Range(min=1, max=65535)),
+    'tags': non_empty(seqof(str)),
+    'env': dictof(str, v.Any(str, int, None)),
+    'method': v.Any('key', 'password'),
+})
+
+@pytest.mark.parametrize("data", [
+    {'address': 'srv1'},
+    {'address': 'srv1', 'port': 2222, 'extra': [1]},
+    {'address': 'srv1', 'tags': ('a', 'b'), 'env': {'x': 1, 'y': None}, 'method': 'key'},
+])
+def test_compiled_ok(data):
+    """Ensure compiled schemas produce the same results, defaults included."""
+    assert compile_schema(host)(data) == v.Schema(host)(data)
+
+@pytest.mark.parametrize("data", [
+    [],
+    {},
+    {'address': 1, 'port': 0},
+    {'address': 'srv1', 'port': '22'},
+    {'address': 'srv1', 'tags': []},
+    {'address': 'srv1', 'tags': ['a', 2, 3]},
+    {'address': 'srv1', 'env': {'x': 1.5, 'y': []}},
+    {'address': 'srv1', 'method': 'agent'},
+])
+def test_compiled_errors(data):
+    """Ensure compiled schemas report the same errors."""
+    assert errors_of(compile_schema(host), data) == errors_of(v.Schema(host), data)
+
+def test_compiled_key_errors():
+    """Ensure invalid keys of 'dictof' are reported as such."""
+    with pytest.raises(MultipleInvalid) as exc:
+        compile_schema(dictof(str, int))({'one': 1, 2: 2})
+    assert isinstance(exc.value.errors[0], KeyInvalid)
+
+def test_compiled_any_deepest():
+    """Ensure 'Any' reports the errors of the alternative which got the furthest."""
+    schema = v.Any(mapping({v.Required('a'): int}), mapping({v.Required('b'): {'c': int}}))
+    data = {'b': {'c': 'x'}}
+    assert errors_of(compile_schema(schema), data) == errors_of(v.Schema(schema), data)
+
+def test_compiled_pred():
+    """Ensure predicates are applied without calling them through voluptuous."""
+    calls = []
+    def positive(val):
+        calls.append(val)
+        return val > 0
+    schema = compile_schema(seqof(pred(positive)))
+    assert schema([1, 2]) == [1, 2]
+    assert calls == [1, 2]
+    assert errors_of(schema, [1, -1]) == ["predicate 'positive' failed @ data[1]"]
+
+def test_compiled_fallback():
+    """Ensure schemas the compiler does not specialize are validated by voluptuous."""
+    schema = compile_schema(mapping({str: [int]}))
+    assert schema({'a': [1, 2]}) == {'a': [1, 2]}
+    with pytest.raises(MultipleInvalid):
+        schema({'a': ['x']})
+
+def random_schema(rnd, depth=0):
+    """random schema combining the constructs the compiler specializes."""
+    kind = rnd.randrange(7 if depth < 3 else 3)
+    if kind == 0:
+        return rnd.choice([int, str])
+    if kind == 1:
+        return rnd.choice(['a', 1, None])
+    if kind == 2:
+        return v.All(int, v.Range(min=0, max=5))
+    if kind == 3:
+        alternatives = [random_schema(rnd, depth + 1) for _ in range(rnd.randrange(1, 4))]
+        return v.Any(*alternatives, msg=rnd.choice([None, None, 'no match']))
+    if kind == 4:
+        return seqof(random_schema(rnd, depth + 1))
+    if kind == 5:
+        return dictof(str, random_schema(rnd, depth + 1))
+    fields = {}
+    for key in rnd.sample('xyz', rnd.randrange(1, 4)):
+        default = rnd.choice([0, 'a', 7])
+        skey = rnd.choice([
+            key, v.Required(key), v.Optional(key), v.Required(key, default=default),
+            v.Optional(key, default=default)])
+        fields[skey] = random_schema(rnd, depth + 1)
+    if rnd.random() < 0.3:
+        return v.Schema(fields, required=True)
+    return mapping(fields)
+
+def random_data(rnd, depth=0):
+    """random data, mostly failing validation somewhere."""
+    kind = rnd.randrange(6 if depth < 3 else 3)
+    if kind == 0:
+        return rnd.choice([0, 3, 9, -1])
+    if kind == 1:
+        return rnd.choice(['a', 'b'])
+    if kind == 2:
+        return None
+    if kind == 3:
+        return [random_data(rnd, depth + 1) for _ in range(rnd.randrange(3))]
+    return {rnd.choice('xyzw'): random_data(rnd, depth + 1) for _ in range(rnd.randrange(3))}
+
+def outcome(schema, data):
+    """validated data, or the (type, description, path) of each error raised."""
+    try:
+        return schema(data)
+    except MultipleInvalid as exc:
+        return [(type(err), str(err), err.path) for err in exc.errors]
+
+@pytest.mark.parametrize("seed", range(10))
+def test_compiled_differential(seed):
+    """Ensure compiled schemas report exactly the errors voluptuous does, in order."""
+    rnd = random.Random(seed)
+    for _ in range(300):
+        schema, data = random_schema(rnd), random_data(rnd)
+        assert outcome(compile_schema(schema), data) == outcome(v.Schema(schema), data)
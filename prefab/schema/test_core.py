@@ -111,4 +111,11 @@ def test_pred_truthy(retval):
         return retval
     s = Schema(pred(__myfn))
     data = 1337
-    assert s(data) == data
\ No newline at end of file
+    assert s(data) == data
+
+def test_dictof_err_nested_path():
+    """Ensure paths of errors in nested entries run from the outermost key inwards."""
+    s = Schema(dictof(str, dictof(str, seqof(int))))
+    with pytest.raises(MultipleInvalid) as exc:
+        s({'a': {'b': [1, 'x']}})
+    assert exc.value.errors[0].path == ['a', 'b', 1]
@@ -0,0 +1,68 @@
+"""
+Memoized filesystem checks.
+
+Validating a large configuration checks the same (SSH key) files over and
+over - once per host sharing a profile, on every validation pass. On
+network-backed home directories each check is a slow syscall, so results
+are cached for the duration of the run.
+"""
+import os
+import stat as st
+from collections import namedtuple
+
+# exists   - path exists
+# isfile   - path is a regular file
+# mtime    - modification time (ns), None if missing
+# mode     - permission bits, None if missing
+# readable - file is readable by the current user
+FileStat = namedtuple('FileStat', ['exists', 'isfile', 'mtime', 'mode', 'readable'])
+
+MISSING = FileStat(exists=False, isfile=False, mtime=None, mode=None, readable=False)
+
+class StatCache:
+    """Cache of path => FileStat, each path is stat'ed at most once."""
+    def __init__(self):
+        self._stats = {}
+
+    def stat(self, fpath):
+        """Retrieve FileStat of 'fpath', stat'ing it on first use."""
+        try:
+            return self._stats[fpath]
+        except KeyError:
+            pass
+        try:
+            res = os.stat(fpath)
+            fstat = FileStat(
+                exists=True,
+                isfile=st.S_ISREG(res.st_mode),
+                mtime=res.st_mtime_ns,
+                mode=st.S_IMODE(res.st_mode),
+                readable=os.access(fpath, os.R_OK))
+        except (OSError, ValueError):
+            fstat = MISSING
+        self._stats[fpath] = fstat
+        return fstat
+
+    def prime(self, paths):
+        """Check all (distinct) 'paths' in one go, returning a path => FileStat dict."""
+        return {fpath: self.stat(fpath) for fpath in set(paths)}
+
+    def isfile(self, fpath):
+        """True iff 'fpath' is a regular file."""
+        return self.stat(fpath).isfile
+
+    def forget(self, paths):
+        """Forget the cached results of 'paths', they are stat'ed again on next use."""
+        for fpath in paths:
+            self._stats.pop(fpath, None)
+
+    def clear(self):
+        """Forget all cached results (e.g. when files may have changed)."""
+        self._stats.clear()
+
+# cache shared by the schemas & config parsing for the duration of the run
+stats = StatCache()
+
+def isfile(fpath):
+    """True iff 'fpath' is a regular file (memoized)."""
+    return stats.isfile(fpath)
@@ -0,0 +1,53 @@
+"""
+Test module for memoized filesystem checks.
+"""
+import os
+import pytest
+from .fscache import StatCache
+
+@pytest.fixture
+def stat_calls(monkeypatch):
+    """count calls to os.stat."""
+    calls = []
+    real_stat = os.stat
+    def counting_stat(fpath, *args, **kwargs):
+        calls.append(fpath)
+        return real_stat(fpath, *args, **kwargs)
+    monkeypatch.setattr(os, 'stat', counting_stat)
+    return calls
+
+def test_stat_memoized(tmp_path, stat_calls):
+    """Ensure each path is stat'ed once."""
+    fpath = str(tmp_path / "id_rsa")
+    open(fpath, 'w').close()
+    cache = StatCache()
+    assert cache.isfile(fpath) and cache.isfile(fpath)
+    assert cache.stat(fpath).readable
+    assert stat_calls == [fpath]
+
+def test_stat_missing(tmp_path):
+    """Ensure missing paths are reported as such."""
+    cache = StatCache()
+    fstat = cache.stat(str(tmp_path / "nope"))
+    assert not (fstat.exists or fstat.isfile or fstat.readable)
+
+def test_stat_dir(tmp_path):
+    """Ensure directories don't pass as files."""
+    assert not StatCache().isfile(str(tmp_path))
+
+def test_prime_distinct(tmp_path, stat_calls):
+    """Ensure priming checks each distinct path once."""
+    fpath = str(tmp_path / "id_rsa")
+    cache = StatCache()
+    assert set(cache.prime([fpath, fpath, fpath])) == {fpath}
+    assert stat_calls == [fpath]
+
+def test_clear(tmp_path):
+    """Ensure cleared caches observe changes."""
+    fpath = str(tmp_path / "id_rsa")
+    cache = StatCache()
+    assert not cache.isfile(fpath)
+    open(fpath, 'w').close()
+    assert not cache.isfile(fpath)
+    cache.clear()
+    assert cache.isfile(fpath)
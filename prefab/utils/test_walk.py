@@ -3,7 +3,7 @@ Test module for walk code.
 """
 from collections import OrderedDict
 import pytest
-from .walk import prewalk, postwalk
+from .walk import prewalk, postwalk, Walker, WALKERS
 
 def identity(x):
     """Identity function, returns its input value."""
@@ -101,3 +101,52 @@ def test_walk_order(walkfn, data, order):
         return x
     walkfn(observe, data)
     assert observed == order
+
+@pytest.mark.parametrize("walkfn", [prewalk, postwalk])
+def test_walk_shares_unchanged(walkfn):
+    """Ensure containers whose elements are unchanged are returned as-is."""
+    data = {'hosts': {'vm1': {'keys': ['a', 'b']}}, 'roles': ({1, 2}, [3])}
+    assert walkfn(identity, data) is data
+
+@pytest.mark.parametrize("walkfn", [prewalk, postwalk])
+def test_walk_shares_unchanged_siblings(walkfn):
+    """Ensure only the containers on the path to a changed element are rebuilt."""
+    def exclaim(x):
+        if x == "b":
+            return x + "!"
+        return x
+    data = {'one': ['a', 'b'], 'two': ['c'], 'three': {'d': 'e'}}
+    result = walkfn(exclaim, data)
+    assert result == {'one': ['a', 'b!'], 'two': ['c'], 'three': {'d': 'e'}}
+    assert result is not data and result['one'] is not data['one']
+    assert result['two'] is data['two'] and result['three'] is data['three']
+
+@pytest.mark.parametrize("walkfn", [prewalk, postwalk])
+def test_walk_deep(walkfn):
+    """Ensure nesting beyond the recursion limit is supported."""
+    data = 1
+    for _ in range(10000):
+        data = [data]
+    result = walkfn(inc_ints, data)
+    for _ in range(10000):
+        result = result[0]
+    assert result == 2
+
+def inc_ints(x):
+    """Increment ints, pass anything else through."""
+    if isinstance(x, int):
+        return x + 1
+    return x
+
+@pytest.mark.parametrize("walkfn", [prewalk, postwalk])
+def test_walk_custom_walker(walkfn):
+    """Ensure additional container types can be walked."""
+    walkers = {**WALKERS, frozenset: Walker(list, lambda _, elems: frozenset(elems))}
+    assert walkfn(inc_ints, [frozenset({1, 2})], walkers) == [frozenset({2, 3})]
+    assert walkfn(inc_ints, [frozenset({1, 2})]) == [frozenset({1, 2})]
+
+@pytest.mark.parametrize("walkfn", [prewalk, postwalk])
+def test_walk_dict_subclass(walkfn):
+    """Ensure dict subclasses are walked as dicts."""
+    data = OrderedDict([('one', 1), ('two', 2)])
+    assert walkfn(inc_ints, data) == {'one': 2, 'two': 3}
@@ -3,54 +3,113 @@ Provide ability to walk (& thus apply a transformation) to all
 elements of a nested data structure.
 
 Inspired by Clojure.walk (src/clj/clojure/walk.clj)
+
+The walk is iterative (using an explicit stack), so deeply nested structures
+do not exhaust the recursion limit. Containers are only rebuilt if one or
+more of their elements changed (by identity) - otherwise the original
+container is returned, sharing structure with the input.
 """
-def __identity(x):
+from collections import namedtuple
+from itertools import chain
+
+# Describes how to walk a container type
+#
+# children - fn(container) => sequence of elements to walk
+# build    - fn(container, elements) => new container from the (walked) elements
+Walker = namedtuple('Walker', ['children', 'build'])
+
+def _dict_children(dct):
+    """keys & values, interleaved."""
+    return list(chain.from_iterable(dct.items()))
+
+def _dict_build(_, elems):
+    """dict from interleaved keys & values."""
+    pairs = iter(elems)
+    return dict(zip(pairs, pairs))
+
+def _identity(x):
     """identity function, returns its input."""
     return x
 
-def _walk_dict(inner, outer, dct):
-    """Apply 'inner' to all dictionary keys & values, apply 'outer' to resulting dict."""
-    return outer({inner(k): inner(v) for (k, v) in dct.items()})
-
-def _walk_list(inner, outer, lst):
-    """Apply 'inner' to all list elements, apply 'outer' to the resulting list."""
-    return outer([inner(v) for v in lst])
+WALKERS = {
+    dict: Walker(_dict_children, _dict_build),
+    list: Walker(_identity, lambda _, elems: elems),
+    tuple: Walker(_identity, lambda _, elems: tuple(elems)),
+    set: Walker(list, lambda _, elems: set(elems)),
+}
 
-def _walk_tuple(inner, outer, tpl):
-    """Apply 'inner' to all tuple elements, apply 'outer' to the resulting tuple."""
-    return outer(tuple([inner(v) for v in tpl]))
+_UNRESOLVED = object()
 
-def _walk_set(inner, outer, s):
-    """Apply 'inner' to all set elements, apply 'outer' to the resulting set."""
-    return outer({inner(v) for v in s})
+def _resolve(walkers, resolved, typ):
+    """Find walker for type (None for leaf types) by subclass, memoizing the result in 'resolved'."""
+    walker = next(
+        (type_walker for (base, type_walker) in walkers.items() if issubclass(typ, base)),
+        None)
+    resolved[typ] = walker
+    return walker
 
-def _walk_leaf(_, outer, leaf):
-    """walk leaf element."""
-    return outer(leaf)
+def walk(pre, post, elem, walkers=WALKERS):
+    """Depth-first traversal of 'elem', applying 'pre' to each element before
+    descending into it and 'post' to the (rebuilt) element afterwards.
 
+    Either function may be None, meaning no transformation.
+    'walkers' maps container types to their 'Walker', types absent from the
+    mapping are treated as leaf elements."""
+    # type => walker, filled in as new types are encountered
+    resolved = dict(walkers)
+    lookup = resolved.get
+    if pre is not None:
+        elem = pre(elem)
+    walker = lookup(type(elem), _UNRESOLVED)
+    if walker is _UNRESOLVED:
+        walker = _resolve(walkers, resolved, type(elem))
+    if walker is None:
+        return post(elem) if post is not None else elem
 
-def _walk(inner, outer, elem):
-    """Function which dispatches to a concrete walk function depending on element type.
+    # frames: [node, walker, children, walked elements, changed?]
+    children = walker.children(elem)
+    frame = [elem, walker, children, [], False]
+    stack = [frame]
+    elems = frame[3]
+    while True:
+        ndx = len(elems)
+        if ndx < len(children):
+            child = orig = children[ndx]
+            if pre is not None:
+                child = pre(child)
+            walker = lookup(type(child), _UNRESOLVED)
+            if walker is _UNRESOLVED:
+                walker = _resolve(walkers, resolved, type(child))
+            if walker is not None:
+                children = walker.children(child)
+                frame = [child, walker, children, [], False]
+                stack.append(frame)
+                elems = frame[3]
+                continue
+            if post is not None:
+                child = post(child)
+            if child is not orig:
+                frame[4] = True
+            elems.append(child)
+            continue
 
-    Default walk function used in prewalk/postwalk - reimplement/wrap to support custom types.
-    """
-    if isinstance(elem, list):
-        return _walk_list(inner, outer, elem)
-    elif isinstance(elem, tuple):
-        return _walk_tuple(inner, outer, elem)
-    elif isinstance(elem, dict):
-        return _walk_dict(inner, outer, elem)
-    elif isinstance(elem, set):
-        return _walk_set(inner, outer, elem)
-    else:
-        return _walk_leaf(inner, outer, elem)
+        # all elements walked, rebuild (if needed) & hand result to parent
+        stack.pop()
+        node = frame[1].build(frame[0], elems) if frame[4] else frame[0]
+        if post is not None:
+            node = post(node)
+        if not stack:
+            return node
+        frame = stack[-1]
+        children, elems = frame[2], frame[3]
+        if node is not children[len(elems)]:
+            frame[4] = True
+        elems.append(node)
 
-def prewalk(fun, elem, walkfn=_walk):
+def prewalk(fun, elem, walkers=WALKERS):
     """Perform pre-order, depth-first traversal of the datastructure 'elem'."""
-    inner = lambda elem: prewalk(fun, elem, walkfn)
-    return walkfn(inner, __identity, fun(elem))
+    return walk(fun, None, elem, walkers)
 
-def postwalk(fun, elem, walkfn=_walk):
+def postwalk(fun, elem, walkers=WALKERS):
     """Perform post-order, depth-first traversal of the datastructure 'elem'."""
-    inner = lambda elem: postwalk(fun, elem, walkfn)
-    return walkfn(inner, fun, elem)
+    return walk(None, fun, elem, walkers)
@@ -14,6 +14,9 @@ setup(
     install_requires = [
         'click', 'Fabric3', 'voluptuous', 'funcy'
     ],
+    extras_require = {
+        'asyncio': ['asyncssh']
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Programming Language :: Python :: 3',
@@ -22,5 +25,6 @@ setup(
     entry_points='''
         [console_scripts]
         prefab=app:cli
+        prefab-bench=prefab.bench.cli:main
     '''
 )
\ No newline at end of file